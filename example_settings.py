@@ -31,9 +31,70 @@ PLANB_STORAGE_POOLS = {
         'BINARY': PLANB_ZFS_BIN,
         'SUDOBIN': PLANB_SUDO_BIN,
         'POOLNAME': 'tank/BACKUP',
+        # Name the datasets POOLNAME/hostgroup/friendly_name instead of
+        # POOLNAME/hostgroup-friendly_name, so hostgroup renames and
+        # properties apply to a single parent dataset. Move existing
+        # datasets with "planb bnestdatasets zfs".
+        # 'LAYOUT': 'nested',
+        # Optionally replicate all snapshots to a secondary pool, local
+        # or remote. See planb.storage.replication.ZfsReplication.
+        # 'REPLICATION': {
+        #     'POOLNAME': 'tank2/BACKUP',
+        #     'COMMAND': ('/usr/bin/ssh', 'planb@backup2.example.com',
+        #                 '/usr/bin/sudo', '/sbin/zfs'),
+        # },
     },
+    # Same as ZfsStorage, but uses the pyzfs libzfs_core bindings for
+    # snapshot/list/property calls instead of calling sudo+zfs. Falls
+    # back to BINARY/SUDOBIN if the bindings are unavailable.
+    # 'zfs-native': {
+    #     'ENGINE': 'planb.storage.libzfs.LibZfsStorage',
+    #     'NAME': 'ZFS Pool (native)',
+    #     'BINARY': PLANB_ZFS_BIN,
+    #     'SUDOBIN': PLANB_SUDO_BIN,
+    #     'POOLNAME': 'tank/BACKUP',
+    # },
+    # Without ZFS: plain directories on ext4/xfs/..., with snapshots as
+    # hardlink ('cp -al') copies. See planb.storage.hardlink.
+    # 'plain': {
+    #     'ENGINE': 'planb.storage.hardlink.HardlinkStorage',
+    #     'NAME': 'Hardlink storage',
+    #     'ROOT': '/srv/backups',
+    # },
 }
 
+# Sizes are taken from ZFS after every backup. Rebuild the per-path disk
+# usage summary (a full walk of the snapshot) only once a week.
+# PLANB_SNAPSHOT_LISTING_MAX_AGE = 7 * 86400
+
+# Or keep the summary current cheaply: only stat the paths listed by
+# 'zfs diff' against the snapshot of the previous summary. (Requires the
+# 'diff' permission for the planb sudo zfs rule.)
+# PLANB_SNAPSHOT_LISTING_ENGINE = 'incremental'
+# Or walk huge trees with multiple threads:
+# PLANB_SNAPSHOT_LISTING_ENGINE = 'parallel'
+# PLANB_SNAPSHOT_LISTING_WORKERS = 8
+
+# Run up to 4 dutree scans at once, one per pool, but not while the
+# zpool is busy (average IO wait above 50ms).
+# Q_DUTREE_WORKERS = 4
+# PLANB_DUTREE_POOL_CONCURRENCY = 1
+# PLANB_DUTREE_MAX_IO_LATENCY = 0.05
+
+# Keep a catalog of all file versions in the snapshots, to quickly find
+# the snapshots to restore a file from ("planb bcatalog ID PATH").
+# PLANB_SNAPSHOT_CATALOG = True
+
+# Restores ("planb brestore" or the admin) push with 4 rsync streams,
+# sharing 10 MiB/s.
+# PLANB_RESTORE_SHARDS = 4
+# PLANB_RESTORE_BWLIMIT = '10M'
+
+# Let "planb brebalance --enqueue" migrate at most 2 filesets and 500 GiB
+# per run.
+# PLANB_REBALANCE_MAX_MOVES = 2
+# PLANB_REBALANCE_MAX_SIZE = 500 << 30
+
 
 MANAGERS = ADMINS = (
     # ('My Name', 'myname@example.com'),
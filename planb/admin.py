@@ -1,5 +1,11 @@
+import sqlite3
+
 from django.conf import settings
-from django.contrib import admin
+from django.conf.urls import url
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.html import format_html_join, escape as htmlesc
@@ -8,9 +14,13 @@ from django.utils.translation import ugettext as _
 
 from planb.common import human
 
-from .forms import FilesetAdminForm
-from .models import BOGODATE, BackupRun, HostGroup, Fileset
-from .tasks import async_backup_job, async_rename_job
+from .catalog import lookup_catalog
+from .forms import FilesetAdminForm, FilesetRestoreForm
+from .models import BOGODATE, BackupRun, BackupRunRollup, HostGroup, Fileset
+from .quota import apply_quota
+from .tasks import (
+    async_backup_job, async_migrate_job, async_rename_hostgroup_job,
+    async_rename_job, async_restore_job)
 
 
 def enqueue_multiple(modeladmin, request, queryset):
@@ -23,14 +33,34 @@ enqueue_multiple.short_description = _(  # noqa
     'Enqueue selected hosts for immediate backup')
 
 
+def restore_fileset(modeladmin, request, queryset):
+    if queryset.count() != 1:
+        modeladmin.message_user(
+            request, _('Select a single fileset to restore'),
+            level=messages.ERROR)
+        return None
+    return redirect(
+        'admin:planb_fileset_restore', object_id=queryset.get().pk)
+restore_fileset.short_description = _(  # noqa
+    'Restore snapshot data to the host')
+
+
 class BackupRunAdmin(admin.ModelAdmin):
     list_display = (
         'started', 'fileset', 'success', 'total_size_mb',
-        'snapshot_size_mb')
+        'snapshot_size_mb', 'written_mb', 'anomalies')
+
+
+class BackupRunRollupAdmin(admin.ModelAdmin):
+    list_display = (
+        'date', 'fileset', 'runs', 'successful_runs', 'duration',
+        'total_size_mb', 'written_mb')
+    list_select_related = ('fileset',)
+    date_hierarchy = 'date'
 
 
 class HostGroupAdmin(admin.ModelAdmin):
-    list_display = ('name', 'notify_email', 'filesets')
+    list_display = ('name', 'notify_email', 'filesets', 'quota_gb')
 
     def filesets(self, object):
         return format_html_join(
@@ -43,12 +73,16 @@ class HostGroupAdmin(admin.ModelAdmin):
                 .order_by('friendly_name')):
             yield (reverse('admin:planb_fileset_change', args=(pk,)), name)
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and 'quota_gb' in form.changed_data:
+            # Not before every backup run: it changes this rarely.
+            apply_quota(obj)
+
     def save_related(self, request, form, formsets, change):
         super().save_related(request, form, formsets, change)
         if change and 'name' in form.changed_data:
-            for fileset in form.instance.filesets.iterator():
-                async_rename_job(
-                    fileset, form.instance.name, fileset.friendly_name)
+            async_rename_hostgroup_job(form.instance, form.initial['name'])
             self.message_user(
                 request, _('A rename task has been queued for all filesets in '
                            'the hostgroup'))
@@ -63,7 +97,8 @@ class FilesetAdmin(admin.ModelAdmin):
         ('Status', {'fields': (
             'first_ok', 'last_ok', 'disk_usage', 'run_time',
             'last_run', 'first_fail', 'is_queued', 'is_running',
-            'last_error', 'last_ok_snapshot',
+            'last_error', 'last_ok_snapshot', 'snapshot_size_listing_at',
+            'anomalies',
         )}),
         ('Retention', {'fields': (
             'daily_retention', 'weekly_retention',
@@ -79,25 +114,25 @@ class FilesetAdmin(admin.ModelAdmin):
         [dict_ for title, dict_ in fieldsets
          if title == 'Status'][0]['fields'])
     readonly_change_fields = (
-        # Don't allow _direct_ changes to storage_alias and storage_path as
-        # they are used for the storage location. Friendly name and hostgroup
-        # changes _are_ allowed.
-        # These changes are consolidated to the storage_path when the dataset
-        # move is successful.
-        'storage_alias',)
+        # Changes of friendly name, hostgroup and storage_alias are not
+        # saved directly. They are consolidated to dataset_name and
+        # storage_alias when the dataset rename/migration task is
+        # successful.
+    )
 
     list_display = (
         'friendly_name', 'hostgroup', 'tags',
         'disk_usage', 'run_time', 'retention',
-        'last_ok_', 'first_fail_',
+        'last_ok_', 'first_fail_', 'anomalies',
         'storage_alias', 'enabled_x', 'queued_q', 'running_r',
     )
+    list_select_related = ('hostgroup', 'last_successful_backuprun')
     list_filter = ('is_enabled',)
     if len(settings.PLANB_STORAGE_POOLS) != 1:
         list_filter += ('storage_alias',)
     list_filter += ('hostgroup', 'is_running', 'first_fail')
 
-    actions = [enqueue_multiple]
+    actions = [enqueue_multiple, restore_fileset]
     form = FilesetAdminForm
     search_fields = ('friendly_name', 'hostgroup__name', 'notes')
 
@@ -106,6 +141,69 @@ class FilesetAdmin(admin.ModelAdmin):
             return self.readonly_change_fields + self.readonly_fields
         return self.readonly_fields
 
+    def get_urls(self):
+        return [
+            url(r'^(?P<object_id>\d+)/catalog/$',
+                self.admin_site.admin_view(self.catalog_view),
+                name='planb_fileset_catalog'),
+            url(r'^(?P<object_id>\d+)/restore/$',
+                self.admin_site.admin_view(self.restore_view),
+                name='planb_fileset_restore'),
+        ] + super().get_urls()
+
+    def catalog_view(self, request, object_id):
+        "Look up a path in the snapshot catalog (PLANB_SNAPSHOT_CATALOG)"
+        fileset = self.get_object(request, object_id)
+        if fileset is None or not self.has_view_permission(request, fileset):
+            raise PermissionDenied()
+
+        path = request.GET.get('path', '').strip()
+        entries = error = None
+        if path:
+            try:
+                entries = lookup_catalog(fileset.get_dataset(), path)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                error = str(e)
+            else:
+                if entries is None:
+                    error = _('There is no catalog for this fileset.')
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta, original=fileset,
+            title=_('Snapshot catalog of %s') % (fileset,),
+            path=path, entries=entries, error=error)
+        return TemplateResponse(
+            request, 'admin/planb/fileset/catalog.html', context)
+
+    def restore_view(self, request, object_id):
+        "Enqueue a restore_run pushing snapshot data back to the host"
+        fileset = self.get_object(request, object_id)
+        if fileset is None or not self.has_change_permission(
+                request, fileset):
+            raise PermissionDenied()
+
+        form = FilesetRestoreForm(fileset, request.POST or None)
+        if form.is_valid():
+            async_restore_job(
+                fileset, form.cleaned_data['snapshot'],
+                form.cleaned_data['subpath'],
+                dest=(form.cleaned_data['dest'] or None),
+                shards=form.cleaned_data['shards'],
+                bwlimit=form.cleaned_data['bwlimit'])
+            self.message_user(request, _(
+                'The restore of %(fileset)s@%(snapshot)s has been '
+                'queued') % {'fileset': fileset,
+                             'snapshot': form.cleaned_data['snapshot']})
+            return redirect('admin:planb_fileset_change', fileset.pk)
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta, original=fileset,
+            title=_('Restore %s') % (fileset,), form=form)
+        return TemplateResponse(
+            request, 'admin/planb/fileset/restore.html', context)
+
     def tags(self, object):
         "Take first line of notes"
         ret = object.notes.split('\n', 1)[0].strip()
@@ -124,14 +222,9 @@ class FilesetAdmin(admin.ModelAdmin):
     run_time.short_description = _('run time')  # "last run time"
 
     def first_ok(self, object):
-        try:
-            ret = (
-                object.backuprun_set.filter(success=True)
-                .order_by('started').values_list('started', flat=True)
-                .first()).strftime('%Y-%m-%d')
-        except BackupRun.DoesNotExist:
-            ret = '-'
-        return ret
+        if not object.first_ok:
+            return '-'
+        return object.first_ok.strftime('%Y-%m-%d')
     first_ok.short_description = _('First backup success')
 
     def last_ok_(self, object):
@@ -143,18 +236,20 @@ class FilesetAdmin(admin.ModelAdmin):
     last_ok_.short_description = _('-ok')
 
     def last_error(self, object):
-        if object.first_fail is None:
+        if object.first_fail is None or object.last_backuprun is None:
             return '-'
-        try:
-            run = object.backuprun_set.order_by('-id')[0]
-        except IndexError:
+        return object.last_backuprun.error_text or '-'
+
+    def anomalies(self, object):
+        run = object.last_successful_backuprun
+        if run is None or not run.anomalies:
             return '-'
-        return run.error_text or '-'
+        return ', '.join(run.get_anomalies())
+    anomalies.short_description = _('unusual')  # of the last success
 
     def last_ok_snapshot(self, object):
-        try:
-            run = object.last_successful_backuprun
-        except BackupRun.DoesNotExist:
+        run = object.last_successful_backuprun
+        if run is None:
             return '-'
 
         ret = ['<table>']
@@ -211,6 +306,19 @@ class FilesetAdmin(admin.ModelAdmin):
             ret.append('%dy' % object.yearly_retention)
         return '/'.join(ret)
 
+    def save_model(self, request, obj, form, change):
+        if change and 'storage_alias' in form.changed_data:
+            # Keep the old pool until the migration task has moved it.
+            storage_alias = obj.storage_alias
+            obj.storage_alias = form.initial['storage_alias']
+            super().save_model(request, obj, form, change)
+            async_migrate_job(obj, storage_alias)
+            self.message_user(request, _(
+                'A migration task to %s has been queued for the fileset') % (
+                    storage_alias,))
+        else:
+            super().save_model(request, obj, form, change)
+
     def save_related(self, request, form, formsets, change):
         super().save_related(request, form, formsets, change)
         if change and (
@@ -224,5 +332,6 @@ class FilesetAdmin(admin.ModelAdmin):
 
 
 admin.site.register(BackupRun, BackupRunAdmin)
+admin.site.register(BackupRunRollup, BackupRunRollupAdmin)
 admin.site.register(HostGroup, HostGroupAdmin)
 admin.site.register(Fileset, FilesetAdmin)
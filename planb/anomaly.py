@@ -0,0 +1,106 @@
+"""
+Detection of unusual backup runs.
+
+Every successful run of a fileset is compared with exponentially
+weighted moving averages (and variances) of its earlier runs, kept on
+the Fileset, so no run history is queried:
+
+- growth: the increase of the total size since the previous successful
+  run is unusually large (data ballooned);
+- shrinkage: the snapshot size dropped unusually much (data deleted on
+  the host, or a changed include list). The total size hardly shows this,
+  as the older snapshots keep the data;
+- slowdown: the run took unusually long.
+
+A value is unusual when it is more than PLANB_ANOMALY_ZSCORE standard
+deviations from its average, and the change is more than
+PLANB_ANOMALY_MIN_CHANGE (fraction) of the previous size or duration.
+Nothing is flagged before PLANB_ANOMALY_MIN_RUNS runs are in the
+averages. The flags are stored on the BackupRun and sent with the
+backup_done signal.
+
+The per-run values themselves are the BackupRun columns (total_size_mb,
+snapshot_size_mb, written_mb and duration) and, once compacted, the
+daily BackupRunRollups.
+"""
+import math
+
+from django.conf import settings
+
+ANOMALIES = ('growth', 'shrinkage', 'slowdown')
+
+
+def update_ewma(average, variance, value, alpha):
+    """
+    Return the (average, variance) after adding value to the exponentially
+    weighted moving average and variance, with weight alpha for value.
+    """
+    diff = value - average
+    return (
+        average + alpha * diff,
+        (1 - alpha) * (variance + alpha * diff ** 2))
+
+
+def get_zscore(average, variance, value):
+    """
+    Return the number of standard deviations value is from the average
+    (infinite for any change if there was no spread so far).
+    """
+    if variance <= 0:
+        if value == average:
+            return 0.0
+        return math.copysign(math.inf, value - average)
+    return (value - average) / math.sqrt(variance)
+
+
+def _get_deviation(average, variance, value, previous):
+    """
+    Return 1 if value is unusually high, -1 if unusually low, or 0.
+    """
+    zscore = get_zscore(average, variance, value)
+    if abs(zscore) <= settings.PLANB_ANOMALY_ZSCORE:
+        return 0
+    if abs(value - average) <= settings.PLANB_ANOMALY_MIN_CHANGE * previous:
+        return 0
+    return 1 if zscore > 0 else -1
+
+
+def get_run_anomalies(fileset, total_size_mb, snapshot_size_mb, duration):
+    """
+    Return the anomalies (see ANOMALIES) of a successful run of fileset,
+    and the Fileset field values that add the run to the averages.
+
+    The fileset holds the values from before the run.
+    """
+    previous_run = fileset.last_successful_backuprun
+    if previous_run is None:
+        return [], {}
+
+    alpha = settings.PLANB_ANOMALY_EWMA_ALPHA
+    growth = total_size_mb - fileset.total_size_mb
+    snapshot_growth = snapshot_size_mb - previous_run.snapshot_size_mb
+
+    anomalies = []
+    if fileset.trend_runs >= settings.PLANB_ANOMALY_MIN_RUNS:
+        if _get_deviation(
+                fileset.growth_average, fileset.growth_variance, growth,
+                fileset.total_size_mb) == 1:
+            anomalies.append('growth')
+        if _get_deviation(
+                fileset.snapshot_growth_average,
+                fileset.snapshot_growth_variance, snapshot_growth,
+                previous_run.snapshot_size_mb) == -1:
+            anomalies.append('shrinkage')
+        if _get_deviation(
+                fileset.average_duration, fileset.duration_variance,
+                duration, fileset.average_duration) == 1:
+            anomalies.append('slowdown')
+
+    values = {'trend_runs': fileset.trend_runs + 1}
+    values['growth_average'], values['growth_variance'] = update_ewma(
+        fileset.growth_average, fileset.growth_variance, growth, alpha)
+    (values['snapshot_growth_average'],
+     values['snapshot_growth_variance']) = update_ewma(
+        fileset.snapshot_growth_average, fileset.snapshot_growth_variance,
+        snapshot_growth, alpha)
+    return anomalies, values
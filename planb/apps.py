@@ -10,3 +10,6 @@ class PlanbAppConfig(AppConfig):
         from django.views import debug
         from .monkeypatch import PlanbExceptionReporter
         debug.ExceptionReporter = PlanbExceptionReporter
+
+        # Connect the fileset status updates and quotas.
+        from . import quota, status  # noqa
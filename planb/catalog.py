@@ -0,0 +1,286 @@
+"""
+Catalog of the files in the snapshots of a fileset, to answer "which
+snapshots have (this version of) this file" without walking them all.
+
+The catalog is an SQLite database in the dataset metadata directory (next
+to 'data'). Every cataloged snapshot gets a generation number; every
+version (path, size, mtime) of a file is a row with the first and last
+generation it was seen in. Snapshots taken at the same time (daily,
+weekly, ...) share a generation.
+
+A new snapshot is added using the snapshot diff against the previous one
+when the storage supports it, or by a walk comparing every file with its
+last known version otherwise.
+"""
+from collections import namedtuple
+from datetime import datetime
+import logging
+import os
+import sqlite3
+from stat import S_ISDIR
+
+from planb.common.subprocess2 import CalledProcessError
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILENAME = 'planb-catalog.sqlite3'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS files (
+    path BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    first_generation INTEGER NOT NULL,
+    last_generation INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS files_path ON files (path, last_generation);
+CREATE INDEX IF NOT EXISTS files_last_generation ON files (last_generation);
+'''
+
+
+class CatalogEntry(namedtuple(
+        'CatalogEntry', 'path size mtime snapshots')):
+    @property
+    def mtime_datetime(self):
+        return datetime.utcfromtimestamp(self.mtime)
+
+
+def walk_files(path, relpath=''):
+    """
+    Yield (relpath, stat) of all non-directories below path + relpath.
+    """
+    todo = [relpath]
+    while todo:
+        relpath = todo.pop()
+        try:
+            entries = os.scandir(path + relpath)
+        except OSError as e:
+            logger.warning('Cannot scan %r: %s', path + relpath, e)
+            continue
+
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue  # vanished
+            if S_ISDIR(st.st_mode):
+                todo.append(relpath + '/' + entry.name)
+            else:
+                yield relpath + '/' + entry.name, st
+
+
+class SnapshotCatalog(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def _key(relpath):
+        return os.fsencode(relpath)
+
+    @staticmethod
+    def _subtree(key):
+        # All paths below key: '/' + 1 == '0'.
+        return key + b'/', key + b'0'
+
+    def get_generation(self):
+        """
+        Return the generation of the last added snapshot, even if that
+        snapshot is gone already.
+        """
+        return self.conn.execute(
+            'SELECT MAX(COALESCE((SELECT MAX(generation) FROM snapshots), 0), '
+            'COALESCE((SELECT MAX(last_generation) FROM files), 0))'
+        ).fetchone()[0]
+
+    def get_last_snapshot(self):
+        """
+        Return the name of the last added snapshot if it still exists.
+        """
+        row = self.conn.execute(
+            'SELECT name, generation FROM snapshots '
+            'ORDER BY generation DESC LIMIT 1').fetchone()
+        if row and row[1] == self.get_generation():
+            return row[0]
+        return None
+
+    def add_snapshot(self, snapnames, path, changes=None):
+        """
+        Catalog the snapshot at path, known by snapnames. If changes (see
+        Dataset.get_snapshot_diff) against the last cataloged snapshot are
+        passed, only those paths are looked at.
+        """
+        prev = self.get_generation()
+        new = prev + 1
+        with self.conn:
+            if changes is None:
+                self._add_by_walk(path, prev, new)
+            else:
+                self._add_by_diff(path, changes, prev, new)
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO snapshots VALUES (?, ?)',
+                [(name, new) for name in snapnames])
+
+    def _add_by_walk(self, path, prev, new):
+        for relpath, st in walk_files(path):
+            key = self._key(relpath)
+            row = self.conn.execute(
+                'SELECT rowid, size, mtime FROM files '
+                'WHERE path = ? AND last_generation = ?',
+                (key, prev)).fetchone()
+            if row and row[1:] == (st.st_size, int(st.st_mtime)):
+                self.conn.execute(
+                    'UPDATE files SET last_generation = ? WHERE rowid = ?',
+                    (new, row[0]))
+            else:
+                self._insert(key, st, new)
+
+    def _add_by_diff(self, path, changes, prev, new):
+        # Everything that did not change is still there.
+        self.conn.execute(
+            'UPDATE files SET last_generation = ? WHERE last_generation = ?',
+            (new, prev))
+
+        for change, is_dir, relpath, new_relpath in changes:
+            if is_dir and change in '+M':
+                continue  # the new files are listed separately
+            self._close(relpath, is_dir, prev, new)
+            if change == 'R':
+                self._add_path(path, new_relpath, is_dir, prev, new)
+            elif change != '-':
+                self._add_path(path, relpath, is_dir, prev, new)
+
+    def _close(self, relpath, is_dir, prev, new):
+        """
+        Mark the versions of relpath (and below) as gone in generation new.
+        """
+        key = self._key(relpath)
+        where = 'last_generation = ? AND (path = ?'
+        args = [new, key]
+        if is_dir:
+            where += ' OR (path >= ? AND path < ?)'
+            args.extend(self._subtree(key))
+        where += ')'
+        # Added in this generation (listed twice): gone entirely.
+        self.conn.execute(
+            'DELETE FROM files WHERE first_generation = ? AND ' + where,
+            [new] + args)
+        self.conn.execute(
+            'UPDATE files SET last_generation = ? WHERE ' + where,
+            [prev] + args)
+
+    def _add_path(self, path, relpath, is_dir, prev, new):
+        if is_dir:
+            files = walk_files(path, relpath)
+        else:
+            try:
+                files = [(relpath, os.lstat(path + relpath))]
+            except FileNotFoundError:
+                return
+        for relpath, st in files:
+            self._close(relpath, False, prev, new)
+            self._insert(self._key(relpath), st, new)
+
+    def _insert(self, key, st, generation):
+        self.conn.execute(
+            'INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+            (key, st.st_size, int(st.st_mtime), generation, generation))
+
+    def prune(self, existing_snapnames):
+        """
+        Forget the snapshots that no longer exist and the file versions
+        that are only found in those.
+        """
+        existing = set(existing_snapnames)
+        with self.conn:
+            self.conn.executemany(
+                'DELETE FROM snapshots WHERE name = ?', [
+                    (name,) for (name,) in self.conn.execute(
+                        'SELECT name FROM snapshots')
+                    if name not in existing])
+            self.conn.execute(
+                'DELETE FROM files WHERE last_generation < COALESCE(('
+                'SELECT MIN(generation) FROM snapshots), ?)',
+                (self.get_generation() + 1,))
+
+    def lookup(self, relpath, limit=1000):
+        """
+        Return the CatalogEntry versions of relpath and everything below
+        it, with the existing snapshots they can be found in.
+        """
+        key = self._key('/' + relpath.strip('/') if relpath.strip('/') else '')
+        generations = {}
+        for name, generation in self.conn.execute(
+                'SELECT name, generation FROM snapshots ORDER BY name'):
+            generations.setdefault(generation, []).append(name)
+
+        ret = []
+        for path, size, mtime, first, last in self.conn.execute(
+                'SELECT path, size, mtime, first_generation, '
+                'last_generation FROM files '
+                'WHERE path = ? OR (path >= ? AND path < ?) '
+                'ORDER BY path, first_generation LIMIT ?',
+                (key,) + self._subtree(key) + (limit,)):
+            snapnames = []
+            for generation in range(first, last + 1):
+                snapnames.extend(generations.get(generation, ()))
+            if snapnames:
+                ret.append(CatalogEntry(
+                    os.fsdecode(path), size, mtime, snapnames))
+        return ret
+
+
+def get_catalog_filename(dataset):
+    return os.path.join(dataset.get_metadata_path(), CATALOG_FILENAME)
+
+
+def update_catalog(dataset, snapnames, existing_snapnames):
+    """
+    Add the snapshot snapnames[0] (also known as the other snapnames) of
+    dataset to its catalog. Returns the number of cataloged snapshots.
+    """
+    snapshot = snapnames[0]
+    with SnapshotCatalog(get_catalog_filename(dataset)) as catalog:
+        catalog.prune(existing_snapnames)
+        previous = catalog.get_last_snapshot()
+        if previous != snapshot:
+            changes = None
+            if previous:
+                try:
+                    changes = dataset.get_snapshot_diff(previous, snapshot)
+                except (CalledProcessError, NotImplementedError) as e:
+                    logger.info(
+                        'No diff from %s@%s, walking everything: %s',
+                        dataset.name, previous, e)
+            catalog.add_snapshot(
+                snapnames, dataset.get_snapshot_path(snapshot), changes)
+        return catalog.conn.execute(
+            'SELECT COUNT(*) FROM snapshots').fetchone()[0]
+
+
+def lookup_catalog(dataset, relpath, limit=1000):
+    """
+    Return the CatalogEntry versions of relpath (and below) in the catalog
+    of dataset, or None if it has no catalog.
+
+    Used by the web interface, so no workon(): that changes the working
+    directory of the process and unmounts without the FilesetLock.
+    """
+    dataset.mount()
+    filename = get_catalog_filename(dataset)
+    if not os.path.exists(filename):
+        return None
+    with SnapshotCatalog(filename) as catalog:
+        return catalog.lookup(relpath, limit=limit)
@@ -0,0 +1,54 @@
+"""
+Duration histograms kept in redis, so the observations of all worker
+processes add up. Exported by planb.metrics.
+"""
+from bisect import bisect_left
+
+from django_q.brokers.redis_broker import Redis
+
+HISTOGRAM_CACHE_KEY = 'planb:histogram:{}'
+
+# Upper bounds in seconds; the last bucket is +Inf.
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def observe(name, labels, seconds):
+    """
+    Add a duration to the histogram name, for the labels tuple (of
+    strings without tabs).
+    """
+    label = '\t'.join(labels)
+    pipe = Redis.get_connection().pipeline(transaction=False)
+    pipe.hincrby(
+        HISTOGRAM_CACHE_KEY.format(name),
+        '{}\t{}'.format(label, bisect_left(BUCKETS, seconds)), 1)
+    pipe.hincrbyfloat(
+        HISTOGRAM_CACHE_KEY.format(name), '{}\tsum'.format(label), seconds)
+    pipe.execute()
+
+
+def get_histogram(name):
+    """
+    Return {labels: (cumulative bucket counts, sum)} of histogram name; the
+    counts are for BUCKETS and +Inf.
+    """
+    histogram = {}
+    for key, value in Redis.get_connection().hgetall(
+            HISTOGRAM_CACHE_KEY.format(name)).items():
+        key = key.decode('utf-8').split('\t')
+        labels, field = tuple(key[:-1]), key[-1]
+        counts, sum_ = histogram.get(labels, ([0] * (len(BUCKETS) + 1), 0))
+        if field == 'sum':
+            sum_ = float(value)
+        else:
+            counts[int(field)] += int(value)
+        histogram[labels] = (counts, sum_)
+
+    for labels, (counts, sum_) in histogram.items():
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+    return histogram
+
+
+def clear_histogram(name):
+    Redis.get_connection().delete(HISTOGRAM_CACHE_KEY.format(name))
@@ -1,9 +1,11 @@
 from __future__ import absolute_import
 from re import compile as re_compile
 from shlex import quote as shell_quote
+from signal import SIGPIPE
 from subprocess import (
     CalledProcessError as OrigCalledProcessError,
     PIPE, Popen)
+from tempfile import TemporaryFile
 
 
 class CalledProcessError(OrigCalledProcessError):
@@ -118,6 +120,42 @@ def check_output(cmd, *, env=None, return_stderr=None, shell=False,
     return stdout
 
 
+def check_pipe(cmd1, cmd2, *, env=None):
+    """
+    Run "cmd1 | cmd2" and return the output of cmd2.
+
+    Raises CalledProcessError for the command that failed. If both
+    failed, the one that did not merely die of a broken pipe is blamed.
+    """
+    fp1, fp2, stdout, stderr = None, None, '', ''
+    with TemporaryFile() as stderr1:
+        try:
+            # Write cmd1 stderr to a file, so we need not read both
+            # stderrs concurrently to avoid a deadlock.
+            fp1 = Popen(
+                cmd1, stdin=None, stdout=PIPE, stderr=stderr1, env=env)
+            fp2 = Popen(
+                cmd2, stdin=fp1.stdout, stdout=PIPE, stderr=PIPE, env=env)
+            fp1.stdout.close()  # so cmd1 gets SIGPIPE if cmd2 exits
+            stdout, stderr = fp2.communicate()
+            ret2 = fp2.wait()
+            ret1 = fp1.wait()
+            fp1 = fp2 = None
+            if ret1 not in (0, -SIGPIPE):
+                stderr1.seek(0)
+                raise CalledProcessError(ret1, cmd1, b'', stderr1.read())
+            if ret2 != 0:
+                raise CalledProcessError(ret2, cmd2, stdout, stderr)
+            if ret1 != 0:
+                raise CalledProcessError(ret1, cmd1, b'', b'Broken pipe\n')
+        finally:
+            for fp in (fp1, fp2):
+                if fp:
+                    fp.kill()
+
+    return stdout
+
+
 def argsjoin(cmd):
     """
     Return cmd-tuple as a quoted string, safe to pass to a shell.
@@ -1,7 +1,7 @@
 from os import environ
 from unittest import TestCase
 
-from .subprocess2 import CalledProcessError, check_call
+from .subprocess2 import CalledProcessError, check_call, check_pipe
 
 
 class Subprocess2Test(TestCase):
@@ -28,3 +28,16 @@ class Subprocess2Test(TestCase):
                 del environ['LC_LANG']
             else:
                 environ['LC_LANG'] = lc_lang_old
+
+    def test_check_pipe(self):
+        self.assertEqual(
+            check_pipe(['/bin/echo', 'hello pipe'], ['/bin/cat']),
+            b'hello pipe\n')
+
+        # The failing command gets the blame.
+        with self.assertRaises(CalledProcessError) as ctx:
+            check_pipe(['/bin/false'], ['/bin/cat'])
+        self.assertEqual(ctx.exception.cmd, ['/bin/false'])
+        with self.assertRaises(CalledProcessError) as ctx:
+            check_pipe(['/bin/echo'], ['/bin/false'])
+        self.assertEqual(ctx.exception.cmd, ['/bin/false'])
@@ -100,14 +100,122 @@ PLANB_TRANSPORTS = [
     'transport_exec.Config',    # rare
 ]
 
+# The per-path disk usage summary (dutree) walks all files of a snapshot.
+# The total/snapshot sizes are taken from the storage (ZFS properties) on
+# every run anyway, so the walk can be done less often: only when the
+# previous summary is older than this many seconds. 0 means every run.
+PLANB_SNAPSHOT_LISTING_MAX_AGE = 0
+
+# How the per-path disk usage summary is made:
+# - 'dutree': walk the entire snapshot every time;
+# - 'incremental': keep a per-directory size tree next to the dataset
+#   'data' dir and update only the paths that changed since the previous
+#   summary (zfs diff). Storages without snapshot diffs walk everything.
+# - 'parallel': walk the entire snapshot using
+#   PLANB_SNAPSHOT_LISTING_WORKERS threads, keeping only the large
+#   directories in memory.
+PLANB_SNAPSHOT_LISTING_ENGINE = 'dutree'
+PLANB_SNAPSHOT_LISTING_WORKERS = 4
+
+# Keep a catalog of all files in the snapshots (planb-catalog.sqlite3
+# next to the dataset 'data' dir), updated after every backup in the
+# dutree queue. Query it with "planb bcatalog" or from the fileset admin.
+PLANB_SNAPSHOT_CATALOG = False
+
+# New filesets may be placed on a storage pool automatically (the
+# default choice in the admin, and the bprovision command). Pools are
+# scored on the space left after the growth of the last GROWTH_DAYS,
+# projected over HORIZON_DAYS, and on the part of the nightly backup
+# window (NIGHT_SECONDS for every qcluster worker) that is still free.
+# Pools that would have less than MIN_FREE (fraction) left are skipped.
+PLANB_PLACEMENT_GROWTH_DAYS = 30
+PLANB_PLACEMENT_HORIZON_DAYS = 90
+PLANB_PLACEMENT_MIN_FREE = 0.1
+PLANB_PLACEMENT_NIGHT_SECONDS = 8 * 3600
+
+# The duration estimate of a fileset is an exponentially weighted moving
+# average (and variance) of its successful runs, with weight ALPHA for
+# the last run. Its p90 decides whether a backup is due for the day.
+PLANB_DURATION_EWMA_ALPHA = 0.2
+
+# Successful runs are flagged for unusual growth, shrinkage of the
+# snapshot size or slowdown (see planb.anomaly) when the value is more
+# than ZSCORE standard deviations from its exponentially weighted
+# average (weight EWMA_ALPHA for the last run) and differs more than
+# MIN_CHANGE (fraction) from the previous size or average duration.
+# Nothing is flagged until MIN_RUNS runs are averaged.
+PLANB_ANOMALY_ZSCORE = 3.0
+PLANB_ANOMALY_EWMA_ALPHA = 0.1
+PLANB_ANOMALY_MIN_CHANGE = 0.1
+PLANB_ANOMALY_MIN_RUNS = 7
+
+# Backups of a hostgroup with a quota are refused when the hostgroup
+# usage plus the largest growth of the fileset in its last GROWTH_RUNS
+# runs would exceed the quota, and warned about above WARN (fraction).
+PLANB_QUOTA_GROWTH_RUNS = 10
+PLANB_QUOTA_WARN = 0.9
+
+# Keep the full detail of the last KEEP BackupRuns of every fileset; the
+# planb.tasks.compact_runs task (schedule it daily) sums older runs into
+# daily BackupRunRollups.
+PLANB_BACKUPRUN_KEEP = 60
+
+# The backup failure banner on the admin pages is cached in redis. It is
+# cleared after every backup and enable/disable of a fileset, and
+# expires after TIMEOUT seconds for other changes.
+PLANB_GLOBAL_MESSAGES_CACHE_TIMEOUT = 300
+
+# The fileset status (/planb/status/) is kept in redis. It is updated when
+# a fileset is saved, starts a backup or is done with one, and rebuilt
+# after TIMEOUT seconds for other changes (e.g. the hourly queueing); the
+# version (ETag) only changes if the rebuilt status differs.
+PLANB_STATUS_CACHE_TIMEOUT = 60
+
+# The Prometheus metrics (/metrics) are for users who may view filesets,
+# or for requests with an "Authorization: Bearer <TOKEN>" header if set.
+PLANB_METRICS_TOKEN = None
+
+# The brebalance command plans fileset moves (migrations) between the
+# pools until the spread of the space used plus the spread of the
+# nightly busy time (both fractions) is at most TOLERANCE. A plan holds
+# at most MAX_MOVES filesets and MAX_SIZE bytes; run it again (e.g.
+# weekly from cron) to continue. The queued (--enqueue) moves run one at a
+# time per pool on the Q_REPLICATION_QUEUE.
+PLANB_REBALANCE_TOLERANCE = 0.1
+PLANB_REBALANCE_MAX_MOVES = 4
+PLANB_REBALANCE_MAX_SIZE = 2 << 40  # 2 TiB
+
+# Restores push the data back with this total bandwidth limit (rsync
+# --bwlimit notation, 0 for none), divided over PLANB_RESTORE_SHARDS
+# parallel rsync streams by default.
+PLANB_RESTORE_BWLIMIT = '10M'
+PLANB_RESTORE_SHARDS = 4
+
 # Q_CLUSTER_QUEUE is the queue the qcluster worker should process.
 Q_MAIN_QUEUE = 'main'
 Q_CLUSTER_QUEUE = os.environ.get('Q_CLUSTER_QUEUE', Q_MAIN_QUEUE)
 
-# The worker queue for dutree tasks, limited to 1 worker. See how this is set
-# in the bqcluster management command.
+# The worker queue for dutree tasks. See how this is set in the bqcluster
+# management command. The workers take the oldest pending listings first,
+# running at most PLANB_DUTREE_POOL_CONCURRENCY scans per storage pool (or
+# the DUTREE_CONCURRENCY of the pool config) and none while the IO wait
+# time of the (zpool) storage is above PLANB_DUTREE_MAX_IO_LATENCY
+# seconds. None disables the latency check.
 Q_DUTREE_QUEUE = 'dutree'
-Q_DUTREE_WORKERS = 1
+Q_DUTREE_WORKERS = 4
+PLANB_DUTREE_POOL_CONCURRENCY = 1
+PLANB_DUTREE_MAX_IO_LATENCY = None
+
+# The worker queue for replicate_run tasks (zfs send/recv to a secondary
+# pool, see REPLICATION in the PLANB_STORAGE_POOLS config) and migrate_run
+# tasks (zfs send/recv to another storage pool).
+Q_REPLICATION_QUEUE = 'replication'
+Q_REPLICATION_WORKERS = 2
+
+# The worker queue for restore_run tasks (rsync of snapshot data back to
+# the host), so restores never hold up the backups.
+Q_RESTORE_QUEUE = 'restore'
+Q_RESTORE_WORKERS = 2
 
 Q_CLUSTER = {
     'name': 'planb',    # redis prefix AND default broker (yuck!)
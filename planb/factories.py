@@ -66,3 +66,14 @@ class BackupRunFactory(DjangoModelFactory):
 
     class Meta:
         model = 'planb.BackupRun'
+
+    @factory.post_generation
+    def last_backuprun(self, create, extracted, **kwargs):
+        # Like the FilesetRunner does when the run finishes.
+        if not create:
+            return
+        values = {'last_backuprun': self}
+        if self.success:
+            values['last_successful_backuprun'] = self
+        type(self.fileset).objects.filter(pk=self.fileset_id).update(
+            **values)
@@ -1,9 +1,13 @@
 from django import forms
 from django.apps import apps
 from django.conf import settings
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext as _
 
+from planb.placement import suggest_pool
 from planb.storage import pools
+from planb.storage.zfs import ZfsStorage
+from planb.transport_rsync.restore import parse_bwlimit
 
 from .models import Fileset
 
@@ -16,13 +20,44 @@ class FilesetAdminForm(forms.ModelForm):
             storage_choices = tuple(
                 (pool.alias, pool.get_label())
                 for pool in pools.values())
+            help_text = ''
+            if not self.instance.pk:
+                # New filesets may be placed automatically.
+                suggested = self.suggested_pool
+                storage_choices = (('', _('(automatic)')),) + storage_choices
+                help_text = (
+                    _('Automatic placement would pick %s.') % suggested
+                    if suggested else
+                    _('No storage has room for automatic placement.'))
             self.fields['storage_alias'] = forms.ChoiceField(
-                label=_('Storage'), choices=storage_choices)
+                label=_('Storage'), choices=storage_choices,
+                required=bool(self.instance.pk), help_text=help_text)
 
         if 'hostgroup' in self.fields:
             self.fields['hostgroup'].queryset = (
                 self.fields['hostgroup'].queryset.order_by('name'))
 
+    @cached_property
+    def suggested_pool(self):
+        # Once per form: it queries the space and load of every pool.
+        return suggest_pool()
+
+    def clean_storage_alias(self):
+        storage_alias = self.cleaned_data['storage_alias']
+        if not storage_alias:
+            storage_alias = self.suggested_pool
+            if not storage_alias:
+                raise forms.ValidationError(
+                    _('No storage has room for automatic placement.'))
+        elif self.instance.pk and (
+                storage_alias != self.instance.storage_alias):
+            # Changing it queues a migration: zfs send/recv.
+            if not (isinstance(self.instance.storage, ZfsStorage)
+                    and isinstance(pools[storage_alias], ZfsStorage)):
+                raise forms.ValidationError(
+                    _('Filesets can only be moved between ZFS storage.'))
+        return storage_alias
+
     class Meta:
         model = Fileset
         exclude = (
@@ -72,3 +107,41 @@ class FilesetRefForm(forms.ModelForm):
 
     class Meta:
         fields = '__all__'
+
+
+class FilesetRestoreForm(forms.Form):
+    """
+    Choose what to push back to the host; see planb.tasks.restore_run.
+    """
+    snapshot = forms.ChoiceField(label=_('Snapshot'))
+    subpath = forms.CharField(
+        label=_('Path'), required=False,
+        help_text=_('Path inside the snapshot; empty for everything.'))
+    dest = forms.CharField(
+        label=_('Destination'), required=False,
+        help_text=_('Directory on the host; empty for the source dir.'))
+    shards = forms.IntegerField(
+        label=_('Streams'), min_value=1, max_value=32,
+        initial=settings.PLANB_RESTORE_SHARDS)
+    bwlimit = forms.CharField(
+        label=_('Bandwidth limit'), initial=settings.PLANB_RESTORE_BWLIMIT,
+        help_text=_('Total of all streams, like 10M; 0 for no limit.'))
+
+    def __init__(self, fileset, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['snapshot'].choices = [
+            (snapshot, snapshot) for snapshot in reversed(
+                fileset.snapshot_list_display())]
+
+    def clean_subpath(self):
+        subpath = self.cleaned_data['subpath'].strip('/')
+        if '..' in subpath.split('/'):
+            raise forms.ValidationError(_('Path cannot contain ".."'))
+        return subpath
+
+    def clean_bwlimit(self):
+        try:
+            parse_bwlimit(self.cleaned_data['bwlimit'])
+        except ValueError as e:
+            raise forms.ValidationError(str(e))
+        return self.cleaned_data['bwlimit']
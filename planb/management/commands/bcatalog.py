@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from planb.catalog import lookup_catalog
+from planb.common import human
+from planb.models import BackupRun, Fileset
+from planb.tasks import FilesetRunner
+
+
+class Command(BaseCommand):
+    help = 'Lists the snapshots that have a path, from the catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('fileset_id', type=int)
+        parser.add_argument('path', nargs='?', default='')
+        parser.add_argument('--update', action='store_true', help=(
+            'First add the last successful snapshot to the catalog'))
+        parser.add_argument('--limit', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fileset = Fileset.objects.get(pk=options['fileset_id'])
+        if options['update']:
+            run = (
+                BackupRun.objects.filter(fileset=fileset, success=True)
+                .latest('started'))
+            with FilesetRunner(fileset.pk) as runner:
+                runner.catalog_run(run.pk)
+
+        entries = lookup_catalog(
+            fileset.get_dataset(), options['path'], limit=options['limit'])
+        if entries is None:
+            raise CommandError('There is no catalog for {}'.format(fileset))
+
+        for entry in entries:
+            self.stdout.write('{}  {:>9s}  {}  {}{}'.format(
+                entry.mtime_datetime.strftime('%Y-%m-%d %H:%M:%S'),
+                human.bytes(entry.size), entry.path, entry.snapshots[0],
+                ('..{} ({})'.format(entry.snapshots[-1], len(entry.snapshots))
+                 if len(entry.snapshots) > 1 else '')))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from planb.common import human
+from planb.models import Fileset, SnapshotListingEntry
+
+
+class Command(BaseCommand):
+    help = (
+        'Lists the largest paths in the snapshot size listings of the last '
+        'successful runs, across all filesets')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--limit', type=int, default=20, help=(
+            'How many paths to list (default: 20)'))
+        parser.add_argument('--fileset', type=int, action='append', help=(
+            'Only list the paths of this fileset id (repeatable)'))
+
+        return super().add_arguments(parser)
+
+    def handle(self, *args, **options):
+        filesets = Fileset.objects.filter(is_enabled=True)
+        if options['fileset']:
+            filesets = filesets.filter(pk__in=options['fileset'])
+        entries = (
+            SnapshotListingEntry.objects
+            .filter(run__in=filesets.values('last_successful_backuprun'))
+            .select_related('run__fileset')
+            .order_by('-size', 'pk')[0:options['limit']])
+
+        for entry in entries:
+            self.stdout.write('{:>8s}  {:40s}  {}'.format(
+                human.bytes(entry.size), str(entry.run.fileset)[0:40],
+                entry.path))
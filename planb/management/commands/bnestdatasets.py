@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from planb.models import Fileset
+from planb.storage import pools
+from planb.tasks import async_rename_job
+
+
+class Command(BaseCommand):
+    help = (
+        'Queues renames of the datasets on STORAGE_ALIAS that are not in '
+        'its nested (POOLNAME/hostgroup/name) layout yet')
+
+    def add_arguments(self, parser):
+        parser.add_argument('storage_alias')
+        parser.add_argument('--dry-run', action='store_true', help=(
+            'Only show the renames'))
+
+    def handle(self, *args, **options):
+        try:
+            storage = pools[options['storage_alias']]
+        except KeyError:
+            raise CommandError('Unknown storage pool {!r}'.format(
+                options['storage_alias']))
+        if storage.get_namespace_dataset_name('') is None:
+            raise CommandError(
+                'Storage {} does not use the nested layout; set its LAYOUT '
+                'first'.format(storage.name))
+
+        count = 0
+        for fileset in (
+                Fileset.objects.filter(storage_alias=storage.alias)
+                .select_related('hostgroup').order_by('pk')):
+            dataset_name = storage.get_dataset_name(
+                fileset.hostgroup.name, fileset.friendly_name)
+            if fileset.dataset_name == dataset_name:
+                continue
+            self.stdout.write('{} to {}'.format(
+                fileset.dataset_name, dataset_name))
+            if not options['dry_run']:
+                async_rename_job(
+                    fileset, fileset.hostgroup.name, fileset.friendly_name)
+            count += 1
+
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(
+                'Queued {} renames'.format(count)))
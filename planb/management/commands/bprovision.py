@@ -0,0 +1,62 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from planb.common import human
+from planb.models import Fileset, HostGroup
+from planb.placement import get_pool_loads, suggest_pool
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates filesets like the template Fileset of ID, placing each on '
+        'the best storage pool. Reads "FRIENDLY_NAME HOST" lines')
+
+    def add_arguments(self, parser):
+        parser.add_argument('fileset_id', type=int)
+        parser.add_argument(
+            'file', nargs='?', default='-',
+            help='File with "FRIENDLY_NAME HOST" lines (default: stdin)')
+        parser.add_argument('--hostgroup', help=(
+            'Host group name for the new filesets (default: the template '
+            'host group)'))
+        parser.add_argument('--dry-run', action='store_true', help=(
+            'Only show the placement'))
+
+    def handle(self, *args, **options):
+        template = Fileset.objects.get(pk=options['fileset_id'])
+        override = {}
+        if options['hostgroup']:
+            override['hostgroup'] = HostGroup.objects.get(
+                name=options['hostgroup'])
+
+        if options['file'] == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(options['file']) as fp:
+                lines = fp.read().splitlines()
+        hosts = [line.split() for line in lines if line.strip()]
+        if any(len(i) != 2 for i in hosts):
+            raise CommandError('Expected "FRIENDLY_NAME HOST" lines')
+
+        # Expect the size and duration of the template for every new
+        # fileset, and account for them so the batch is spread out.
+        size = template.total_size
+        duration = template.average_duration
+        loads = get_pool_loads()
+        for friendly_name, host in hosts:
+            alias = suggest_pool(size, loads)
+            if alias is None:
+                raise CommandError(
+                    'No storage pool has room for {} ({})'.format(
+                        friendly_name, human.bytes(size)))
+            loads[alias].add(size, duration)
+
+            if options['dry_run']:
+                self.stdout.write('{} on {}'.format(friendly_name, alias))
+                continue
+            copy = template.clone(
+                friendly_name=friendly_name, storage_alias=alias,
+                transport__host=host, **override)
+            self.stdout.write(self.style.SUCCESS(
+                'Created {} on {}'.format(copy, alias)))
@@ -54,6 +54,13 @@ class Command(BaseCommand):
         if queue == settings.Q_DUTREE_QUEUE:
             settings_q['workers'] = Conf.WORKERS = settings.Q_DUTREE_WORKERS
             settings_q['scheduler'] = Conf.SCHEDULER = False
+        elif queue == settings.Q_REPLICATION_QUEUE:
+            settings_q['workers'] = Conf.WORKERS = (
+                settings.Q_REPLICATION_WORKERS)
+            settings_q['scheduler'] = Conf.SCHEDULER = False
+        elif queue == settings.Q_RESTORE_QUEUE:
+            settings_q['workers'] = Conf.WORKERS = settings.Q_RESTORE_WORKERS
+            settings_q['scheduler'] = Conf.SCHEDULER = False
 
         # Double check that the Sentinel gets the values from our updated Conf
         # class.
@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from planb.common import human
+from planb.placement import (
+    get_fileset_candidates, get_imbalance, get_pool_loads, plan_moves)
+from planb.storage import pools
+from planb.storage.zfs import ZfsStorage
+from planb.tasks import async_rebalance_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        'Proposes fileset moves between the storage pools that even out '
+        'their space and nightly backup time, moving as few bytes as '
+        'possible')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pool', action='append', help=(
+            'Only balance between these storage pools (repeatable; '
+            'default: all ZFS pools)'))
+        parser.add_argument('--max-moves', type=int, help=(
+            'Move at most this many filesets (default: '
+            'PLANB_REBALANCE_MAX_MOVES)'))
+        parser.add_argument('--max-size', type=int, help=(
+            'Move at most this many GiB (default: PLANB_REBALANCE_MAX_SIZE)'))
+        parser.add_argument('--enqueue', action='store_true', help=(
+            'Queue the migrations of the plan; they run one at a time per '
+            'storage pool'))
+
+    def handle(self, *args, **options):
+        # Migrations are done with zfs send/recv.
+        zfs_aliases = sorted(
+            alias for alias, pool in pools.items()
+            if isinstance(pool, ZfsStorage))
+        aliases = options['pool'] or zfs_aliases
+        if any(alias not in zfs_aliases for alias in aliases):
+            raise CommandError(
+                'Unknown or non-ZFS storage pool in {}'.format(aliases))
+        if len(aliases) < 2:
+            raise CommandError('Need at least two storage pools to balance')
+
+        loads = dict(
+            (alias, load) for alias, load in get_pool_loads().items()
+            if alias in aliases)
+        candidates = get_fileset_candidates(loads)
+        before = self.get_summary(loads)
+        imbalance = get_imbalance(loads)
+        max_size = options['max_size']
+        moves = plan_moves(
+            loads, candidates, max_moves=options['max_moves'],
+            max_size=(None if max_size is None else max_size << 30))
+
+        for move in moves:
+            self.stdout.write('{:6d} {:40s} {} -> {} ({}, {})'.format(
+                move.fileset.pk, str(move.fileset)[0:40], move.source.alias,
+                move.target.alias, human.bytes(move.size),
+                human.seconds(move.duration)))
+        self.stdout.write(
+            'Moving {} filesets, {}; imbalance {:.2f} -> {:.2f}'.format(
+                len(moves), human.bytes(sum(i.size for i in moves)),
+                imbalance, get_imbalance(loads)))
+        after = self.get_summary(loads)
+        for alias in aliases:
+            self.stdout.write('  {}: {} -> {}'.format(
+                alias, before[alias], after[alias]))
+
+        if options['enqueue']:
+            async_rebalance_jobs([
+                (move.fileset, move.target.alias) for move in moves])
+            self.stdout.write(self.style.SUCCESS(
+                'Queued {} migrations'.format(len(moves))))
+
+    def get_summary(self, loads):
+        summary = {}
+        for alias, load in loads.items():
+            usage = load.get_usage()
+            summary[alias] = '{} used, {:.0f}% busy, {} filesets'.format(
+                '???' if usage is None else '{:.0f}%'.format(100 * usage),
+                100 * load.get_busyness(), load.filesets)
+        return summary
@@ -62,7 +62,11 @@ class Command(BaseCommand):
             fs.id for fs in filesets.filter(hostgroup__in=groups)
             if fnmatch(fs.friendly_name, filesets_glob)))
 
-        return filesets.prefetch_related('hostgroup')
+        return (
+            filesets.select_related(
+                'hostgroup', 'last_backuprun', 'last_successful_backuprun')
+            .prefetch_related(
+                'last_successful_backuprun__listing_entries', 'snapshots'))
 
     def run_per_group(self, func, qs, force_send):
         # Fix so we can aggregate by group below.
@@ -87,7 +91,8 @@ class Command(BaseCommand):
             1 for i in filesets if not i.is_enabled)
         hosts_failed = sum(
             1 for i in filesets
-            if i.is_enabled and not i.last_backuprun.success)
+            if i.is_enabled and i.last_backuprun
+            and not i.last_backuprun.success)
 
         subject = _('%s backup report "%s"') % (
             settings.COMPANY_NAME, hostgroup.name)
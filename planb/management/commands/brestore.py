@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+
+from planb.common import human
+from planb.models import Fileset
+from planb.tasks import async_restore_job
+from planb.transport_rsync.models import Config as RsyncConfig
+from planb.transport_rsync.restore import RsyncRestore
+
+
+class Command(BaseCommand):
+    help = 'Pushes (a path in) a snapshot back to the host of the fileset'
+
+    def add_arguments(self, parser):
+        parser.add_argument('fileset_id', type=int)
+        parser.add_argument('snapshot')
+        parser.add_argument('subpath', nargs='?', default='')
+        parser.add_argument('--dest', help=(
+            'Destination directory on the host (default: the source dir)'))
+        parser.add_argument(
+            '--shards', type=int, default=settings.PLANB_RESTORE_SHARDS,
+            help='Number of parallel rsync streams')
+        parser.add_argument('--bwlimit', help=(
+            'Total bandwidth limit, like 10M (default: {})'.format(
+                settings.PLANB_RESTORE_BWLIMIT)))
+        parser.add_argument('--queue', action='store_true', help=(
+            'Run the restore in the restore qcluster instead'))
+
+    def handle(self, *args, **options):
+        fileset = Fileset.objects.get(pk=options['fileset_id'])
+        if options['snapshot'] not in fileset.snapshot_list_display():
+            raise CommandError('No snapshot {} of {}'.format(
+                options['snapshot'], fileset))
+        try:
+            transport = fileset.get_transport()
+        except ObjectDoesNotExist:
+            transport = None
+        if not isinstance(transport, RsyncConfig):
+            raise CommandError('Cannot restore {} without rsync transport'
+                               .format(fileset))
+        try:
+            restore = RsyncRestore(
+                transport, options['snapshot'], options['subpath'],
+                dest=options['dest'], shards=options['shards'],
+                bwlimit=options['bwlimit'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['queue']:
+            async_restore_job(
+                fileset, options['snapshot'], options['subpath'],
+                dest=options['dest'], shards=options['shards'],
+                bwlimit=options['bwlimit'])
+            self.stdout.write('Queued restore of {}'.format(restore))
+            return
+
+        self.stdout.write('Restoring {}'.format(restore))
+        total = restore.run(progress=self.progress)
+        self.stdout.write('Restored {}'.format(human.bytes(total)))
+
+    def progress(self, done, total):
+        self.stdout.write('{:>9s} of {:>9s}'.format(
+            human.bytes(done), human.bytes(total)))
@@ -0,0 +1,196 @@
+"""
+Metrics in the Prometheus text format, as served by planb.views.Metrics.
+
+Everything is taken from a fixed number of (aggregating) queries and
+redis calls, whatever the number of filesets, so it can be scraped
+often:
+
+- per enabled fileset: the age of the last success, the failed runs
+  since then, the total size, and the duration and written (transferred)
+  size of the last successful run;
+- per storage pool: the running and queued filesets, and the backup runs
+  and written size so far (counters, including the compacted runs);
+- per django-q queue: the number of pending tasks;
+- per storage pool and subcommand: a histogram of the zfs command
+  durations (see planb.common.histogram). The libzfs_core calls of
+  LibZfsStorage are not commands and are not in it.
+"""
+from django.conf import settings
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from django_q.brokers import get_broker
+
+from planb.common import histogram
+from planb.models import BackupRun, BackupRunRollup, Fileset
+
+QUEUES = (
+    'Q_MAIN_QUEUE', 'Q_DUTREE_QUEUE', 'Q_REPLICATION_QUEUE',
+    'Q_RESTORE_QUEUE')
+
+
+class MetricsWriter:
+    def __init__(self):
+        self._lines = []
+
+    def add(self, name, type_, help_text, samples):
+        """
+        Add the metric name with the (labels dict, value) samples.
+        """
+        self._lines.append('# HELP {} {}'.format(name, help_text))
+        self._lines.append('# TYPE {} {}'.format(name, type_))
+        for labels, value in samples:
+            self._lines.append('{}{} {}'.format(
+                name, self.format_labels(labels), value))
+
+    def add_histogram(self, name, help_text, samples):
+        """
+        Add the histogram name with the (labels dict, cumulative bucket
+        counts, sum) samples of planb.common.histogram.
+        """
+        self._lines.append('# HELP {} {}'.format(name, help_text))
+        self._lines.append('# TYPE {} histogram'.format(name))
+        bounds = [str(i) for i in histogram.BUCKETS] + ['+Inf']
+        for labels, counts, sum_ in samples:
+            for bound, count in zip(bounds, counts):
+                self._lines.append('{}_bucket{} {}'.format(
+                    name, self.format_labels(dict(labels, le=bound)), count))
+            self._lines.append('{}_sum{} {}'.format(
+                name, self.format_labels(labels), sum_))
+            self._lines.append('{}_count{} {}'.format(
+                name, self.format_labels(labels), counts[-1]))
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(key, str(value).replace('\\', r'\\').replace(
+                '"', r'\"').replace('\n', r'\n'))
+            for key, value in sorted(labels.items())))
+
+    def getvalue(self):
+        return '\n'.join(self._lines) + '\n'
+
+
+def _add_fileset_metrics(writer):
+    filesets = list(
+        Fileset.objects.filter(is_enabled=True)
+        .values(
+            'id', 'hostgroup__name', 'friendly_name', 'storage_alias',
+            'last_ok', 'total_size_mb', 'last_successful_backuprun__duration',
+            'last_successful_backuprun__written_mb')
+        .order_by('id'))
+    # The finished runs that failed after the last success.
+    failed_runs = dict(
+        BackupRun.objects
+        .filter(success=False, duration__isnull=False)
+        .filter(
+            Q(fileset__last_ok=None) | Q(started__gt=F('fileset__last_ok')))
+        .values_list('fileset').annotate(Count('id')).order_by())
+
+    now = timezone.now()
+    labels = [{
+        'fileset': '{}-{}'.format(i['hostgroup__name'], i['friendly_name']),
+        'pool': i['storage_alias']} for i in filesets]
+    writer.add(
+        'planb_fileset_last_success_age_seconds', 'gauge',
+        'Seconds since the last successful backup.', [
+            (label, int((now - i['last_ok']).total_seconds()))
+            for label, i in zip(labels, filesets) if i['last_ok']])
+    writer.add(
+        'planb_fileset_failed_runs', 'gauge',
+        'Failed backup runs since the last success.', [
+            (label, failed_runs.get(i['id'], 0))
+            for label, i in zip(labels, filesets)])
+    writer.add(
+        'planb_fileset_total_size_bytes', 'gauge',
+        'Total size, including the snapshots.', [
+            (label, i['total_size_mb'] << 20)
+            for label, i in zip(labels, filesets)])
+    writer.add(
+        'planb_fileset_last_duration_seconds', 'gauge',
+        'Duration of the last successful backup run.', [
+            (label, i['last_successful_backuprun__duration'] or 0)
+            for label, i in zip(labels, filesets)])
+    writer.add(
+        'planb_fileset_last_written_bytes', 'gauge',
+        'Data written (transferred) by the last successful backup run.', [
+            (label, (i['last_successful_backuprun__written_mb'] or 0) << 20)
+            for label, i in zip(labels, filesets)])
+
+
+def _add_pool_metrics(writer):
+    jobs = (
+        Fileset.objects.values('storage_alias')
+        .annotate(
+            running=Count('id', filter=Q(is_running=True)),
+            queued=Count('id', filter=Q(is_queued=True, is_running=False)))
+        .order_by('storage_alias'))
+    writer.add(
+        'planb_pool_running_jobs', 'gauge',
+        'Filesets that are backing up.', [
+            ({'pool': i['storage_alias']}, i['running']) for i in jobs])
+    writer.add(
+        'planb_pool_queued_jobs', 'gauge',
+        'Filesets that are queued for a backup.', [
+            ({'pool': i['storage_alias']}, i['queued']) for i in jobs])
+
+    # The compacted runs count too, so these only go down when filesets
+    # are removed.
+    runs, written = {}, {}
+    for pool, success, count, written_mb in (
+            BackupRun.objects.filter(duration__isnull=False)
+            .values_list('fileset__storage_alias', 'success')
+            .annotate(Count('id'), Sum('written_mb')).order_by()):
+        key = (pool, 'success' if success else 'failure')
+        runs[key] = runs.get(key, 0) + count
+        written[pool] = written.get(pool, 0) + (written_mb or 0)
+    for pool, count, successful, written_mb in (
+            BackupRunRollup.objects
+            .values_list('fileset__storage_alias')
+            .annotate(Sum('runs'), Sum('successful_runs'), Sum('written_mb'))
+            .order_by()):
+        runs[pool, 'success'] = runs.get((pool, 'success'), 0) + successful
+        runs[pool, 'failure'] = (
+            runs.get((pool, 'failure'), 0) + count - successful)
+        written[pool] = written.get(pool, 0) + written_mb
+
+    writer.add(
+        'planb_backup_runs_total', 'counter', 'Finished backup runs.', [
+            ({'pool': pool, 'result': result}, count)
+            for (pool, result), count in sorted(runs.items())])
+    writer.add(
+        'planb_backup_written_bytes_total', 'counter',
+        'Data written (transferred) by the backup runs.', [
+            ({'pool': pool}, written_mb << 20)
+            for pool, written_mb in sorted(written.items())])
+
+
+def _add_queue_metrics(writer):
+    writer.add(
+        'planb_queue_tasks', 'gauge', 'Tasks waiting in the task queue.', [
+            ({'queue': queue}, get_broker(queue).queue_size())
+            for queue in sorted(set(
+                getattr(settings, i) for i in QUEUES))])
+
+
+def _add_command_metrics(writer):
+    writer.add_histogram(
+        'planb_storage_command_duration_seconds',
+        'Duration of the zfs commands (not the libzfs_core calls).', [
+            ({'pool': pool, 'command': command}, counts, sum_)
+            for (pool, command), (counts, sum_) in sorted(
+                histogram.get_histogram('storage_command').items())])
+
+
+def get_metrics():
+    """
+    Return all metrics in the Prometheus text format.
+    """
+    writer = MetricsWriter()
+    _add_fileset_metrics(writer)
+    _add_pool_metrics(writer)
+    _add_queue_metrics(writer)
+    _add_command_metrics(writer)
+    return writer.getvalue()
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 08:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planb', '0015_fileset_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileset',
+            name='snapshot_size_listing_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the disk usage summary was last created.', null=True, verbose_name='Last disk usage summary'),
+        ),
+    ]
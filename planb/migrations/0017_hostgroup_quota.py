@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planb', '0016_snapshot_size_listing_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hostgroup',
+            name='quota_gb',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum disk usage of all filesets, including snapshots. Backups that are expected to exceed it are refused; only storage with the nested layout enforces it (as ZFS quota).', null=True, verbose_name='Quota (GiB)'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-19 11:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def set_last_backupruns(apps, schema_editor):
+    Fileset = apps.get_model('planb', 'Fileset')
+    BackupRun = apps.get_model('planb', 'BackupRun')
+    for fileset_id in Fileset.objects.values_list('pk', flat=True):
+        runs = BackupRun.objects.filter(fileset_id=fileset_id)
+        successful = runs.filter(success=True)
+        first_ok = successful.order_by('started').first()
+        Fileset.objects.filter(pk=fileset_id).update(
+            first_ok=(first_ok and first_ok.started),
+            last_backuprun=runs.order_by('-started').first(),
+            last_successful_backuprun=(
+                successful.order_by('-started').first()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planb', '0017_hostgroup_quota'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileset',
+            name='first_ok',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='First backup success'),
+        ),
+        migrations.AddField(
+            model_name='fileset',
+            name='last_backuprun',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='planb.BackupRun'),
+        ),
+        migrations.AddField(
+            model_name='fileset',
+            name='last_successful_backuprun',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='planb.BackupRun'),
+        ),
+        migrations.RunPython(set_last_backupruns, migrations.RunPython.noop),
+    ]
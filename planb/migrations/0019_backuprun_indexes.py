@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-19 08:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planb', '0018_fileset_last_backuprun'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='backuprun',
+            index=models.Index(fields=['fileset', 'success', 'started'], name='planb_run_fileset_ok_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backuprun',
+            index=models.Index(fields=['fileset', 'started'], name='planb_run_fileset_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-19 09:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planb', '0019_backuprun_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupRunRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(help_text='The day the runs started.')),
+                ('runs', models.PositiveIntegerField(default=0, help_text='Number of backup runs.')),
+                ('successful_runs', models.PositiveIntegerField(default=0, help_text='Number of successful backup runs.')),
+                ('duration', models.PositiveIntegerField(default=0, help_text='Total duration of the runs in seconds.')),
+                ('total_size_mb', models.PositiveIntegerField(default=0, help_text='Largest total backup size in MiB of a successful run.')),
+                ('snapshot_size_mb', models.PositiveIntegerField(default=0, help_text='Largest single backup size in MiB of a successful run.')),
+                ('written_mb', models.PositiveIntegerField(default=0, help_text='Data written (transferred) by the successful runs in MiB, if the storage tells.')),
+                ('fileset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='planb.Fileset')),
+            ],
+            options={
+                'unique_together': {('fileset', 'date')},
+            },
+        ),
+    ]
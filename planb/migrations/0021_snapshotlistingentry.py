@@ -0,0 +1,74 @@
+# Generated by Django 2.2.28 on 2026-10-19 09:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def listings_to_entries(apps, schema_editor):
+    BackupRun = apps.get_model('planb', 'BackupRun')
+    SnapshotListingEntry = apps.get_model('planb', 'SnapshotListingEntry')
+    runs = (
+        BackupRun.objects.exclude(snapshot_size_listing='')
+        .exclude(snapshot_size_listing__startswith='summary_'))
+    for run in runs.only('snapshot_size_listing').iterator():
+        entries = []
+        for line in run.snapshot_size_listing.splitlines():
+            path, size = line.rsplit(':', 1)
+            if path[0] == path[-1] == '"':
+                path = path[1:-1]
+            entries.append(SnapshotListingEntry(
+                run_id=run.pk, position=len(entries), path=path,
+                size=int(size.replace(',', ''))))
+        SnapshotListingEntry.objects.bulk_create(entries, batch_size=500)
+        BackupRun.objects.filter(pk=run.pk).update(snapshot_size_listing='')
+
+
+def entries_to_listings(apps, schema_editor):
+    BackupRun = apps.get_model('planb', 'BackupRun')
+    SnapshotListingEntry = apps.get_model('planb', 'SnapshotListingEntry')
+    run_ids = (
+        SnapshotListingEntry.objects.values_list('run_id', flat=True)
+        .distinct())
+    for run_id in run_ids:
+        BackupRun.objects.filter(pk=run_id).update(
+            snapshot_size_listing='\n'.join(
+                '"{}": {:,}'.format(path, size) for path, size in (
+                    SnapshotListingEntry.objects.filter(run_id=run_id)
+                    .order_by('position').values_list('path', 'size'))))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planb', '0020_backuprunrollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backuprun',
+            name='snapshot_size_listing',
+            field=models.TextField(blank=True, help_text='State of the path listing: "summary_pending: 0", "summary_error: 0", "summary_disabled: 0" or empty.'),
+        ),
+        migrations.CreateModel(
+            name='SnapshotListingEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('path', models.TextField()),
+                ('size', models.BigIntegerField(help_text='Size in bytes.')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='listing_entries', to='planb.BackupRun')),
+            ],
+            options={
+                'ordering': ('position',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='snapshotlistingentry',
+            index=models.Index(fields=['-size'], name='planb_listing_size_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='snapshotlistingentry',
+            unique_together={('run', 'position')},
+        ),
+        migrations.RunPython(listings_to_entries, entries_to_listings),
+    ]
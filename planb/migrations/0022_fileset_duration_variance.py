@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-19 09:05
+
+from django.db import migrations, models
+
+
+def set_duration_variance(apps, schema_editor):
+    # Start from the variance of the last 10 successful runs, which the
+    # average_duration was taken from.
+    Fileset = apps.get_model('planb', 'Fileset')
+    BackupRun = apps.get_model('planb', 'BackupRun')
+    for fileset_id in Fileset.objects.values_list('pk', flat=True):
+        durations = list(
+            BackupRun.objects
+            .filter(fileset_id=fileset_id, success=True)
+            .exclude(duration=None)
+            .order_by('-started', '-id')
+            .values_list('duration', flat=True)[0:10])
+        if len(durations) < 2:
+            continue
+        mean = sum(durations) / len(durations)
+        Fileset.objects.filter(pk=fileset_id).update(
+            duration_variance=(
+                sum((i - mean) ** 2 for i in durations) / len(durations)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planb', '0021_snapshotlistingentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileset',
+            name='duration_variance',
+            field=models.FloatField(default=0, editable=False, help_text='Variance of the duration of succesful jobs (exponentially weighted).'),
+        ),
+        migrations.AlterField(
+            model_name='fileset',
+            name='average_duration',
+            field=models.PositiveIntegerField(default=0, help_text='Average duration of succesful jobs in seconds (exponentially weighted).', verbose_name='Time'),
+        ),
+        migrations.RunPython(set_duration_variance, migrations.RunPython.noop),
+    ]
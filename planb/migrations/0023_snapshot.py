@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-19 09:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planb', '0022_fileset_duration_variance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Snapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=63)),
+                ('type', models.CharField(help_text='daily, weekly, monthly or yearly.', max_length=15)),
+                ('created', models.DateTimeField(blank=True, null=True)),
+                ('used', models.BigIntegerField(blank=True, help_text='Bytes only in this snapshot, if the storage tells.', null=True)),
+                ('referenced', models.BigIntegerField(blank=True, help_text='Bytes of all data in this snapshot, if the storage tells.', null=True)),
+                ('fileset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='planb.Fileset')),
+            ],
+            options={
+                'ordering': ('name',),
+                'unique_together': {('fileset', 'name')},
+            },
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 2.2.28 on 2026-10-19 09:10
+
+from django.db import migrations, models
+from yaml import YAMLError, safe_load
+
+
+def set_written_mb(apps, schema_editor):
+    # From the snapshot accounting in the attributes.
+    BackupRun = apps.get_model('planb', 'BackupRun')
+    runs = (
+        BackupRun.objects.filter(attributes__contains='written:')
+        .only('attributes'))
+    for run in runs.iterator():
+        try:
+            attributes = safe_load(run.attributes)
+        except YAMLError:
+            continue
+        if not isinstance(attributes, dict):
+            continue
+        written = (attributes.get('snapshot_accounting') or {}).get('written')
+        if isinstance(written, int):
+            BackupRun.objects.filter(pk=run.pk).update(
+                written_mb=((written + 524288) >> 20))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planb', '0023_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backuprun',
+            name='anomalies',
+            field=models.CharField(blank=True, help_text='Unusual growth, shrinkage or slowdown of this run (space separated), see planb.anomaly.', max_length=63),
+        ),
+        migrations.AddField(
+            model_name='backuprun',
+            name='written_mb',
+            field=models.PositiveIntegerField(default=0, help_text='Data written (transferred) in MiB, if the storage tells.'),
+        ),
+        migrations.AddField(
+            model_name='fileset',
+            name='growth_average',
+            field=models.FloatField(default=0, editable=False, help_text='Average growth of the total size per succesful job in MiB (exponentially weighted).'),
+        ),
+        migrations.AddField(
+            model_name='fileset',
+            name='growth_variance',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='fileset',
+            name='snapshot_growth_average',
+            field=models.FloatField(default=0, editable=False, help_text='Average growth of the snapshot size per succesful job in MiB (exponentially weighted).'),
+        ),
+        migrations.AddField(
+            model_name='fileset',
+            name='snapshot_growth_variance',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='fileset',
+            name='trend_runs',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of succesful jobs in the growth averages.'),
+        ),
+        migrations.RunPython(set_written_mb, migrations.RunPython.noop),
+    ]
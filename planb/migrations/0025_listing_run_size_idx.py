@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-19 09:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planb', '0024_run_anomalies'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='snapshotlistingentry',
+            index=models.Index(fields=['run', '-size'], name='planb_listing_run_size_idx'),
+        ),
+    ]
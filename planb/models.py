@@ -1,4 +1,5 @@
 import logging
+import math
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
@@ -7,8 +8,8 @@ from django.conf import settings
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 from django.core.mail import mail_admins
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db.models.signals import post_save
-from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.db import models, transaction
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.functional import cached_property
@@ -16,16 +17,23 @@ from django.utils.translation import ugettext_lazy as _, ngettext
 
 from django_q.brokers.redis_broker import Redis
 
+from planb.anomaly import update_ewma
 from planb.common.fields import MultiEmailField
 from planb.signals import backup_done
 from planb.storage import pools
-from planb.storage.base import DatasetNotFound
 
 
 logger = logging.getLogger(__name__)
 
 BOGODATE = datetime(1970, 1, 2, tzinfo=timezone.utc)
 
+# The rendered backup failure banner, see planb.templatetags.planb.
+GLOBAL_MESSAGES_CACHE_KEY = 'planb:global_messages'
+
+
+def clear_global_messages_cache():
+    Redis.get_connection().delete(GLOBAL_MESSAGES_CACHE_KEY)
+
 
 class TransportChoices(models.PositiveSmallIntegerField):
     SSH = 0
@@ -45,10 +53,22 @@ class HostGroup(models.Model):
         blank=True, null=True,
         help_text=_('Use a newline per emailaddress'))
     last_monthly_report = models.DateTimeField(blank=True, null=True)
+    quota_gb = models.PositiveIntegerField(
+        _('Quota (GiB)'), blank=True, null=True,
+        help_text=_('Maximum disk usage of all filesets, including '
+                    'snapshots. Backups that are expected to exceed it are '
+                    'refused; only storage with the nested layout enforces '
+                    'it (as ZFS quota).'))
 
     def __str__(self):
         return self.name
 
+    @property
+    def quota(self):
+        if self.quota_gb is None:
+            return None
+        return self.quota_gb << 30
+
     class Meta:
         ordering = ('name',)
 
@@ -114,19 +134,51 @@ class Fileset(models.Model):
         _('Last backup attempt'), default=BOGODATE)
     first_fail = models.DateTimeField(
         _('First backup failure'), blank=True, null=True)
+    # Cached by the FilesetRunner when a run finishes, so lists of
+    # filesets need not look up their runs one by one.
+    first_ok = models.DateTimeField(
+        _('First backup success'), blank=True, null=True, editable=False)
+    last_backuprun = models.ForeignKey(
+        'BackupRun', blank=True, null=True, editable=False,
+        on_delete=models.SET_NULL, related_name='+')
+    last_successful_backuprun = models.ForeignKey(
+        'BackupRun', blank=True, null=True, editable=False,
+        on_delete=models.SET_NULL, related_name='+')
 
     total_size_mb = models.PositiveIntegerField(
         default=0, db_index=True,
         help_text=_('Estimated total backup size in MiB.'))
     average_duration = models.PositiveIntegerField(
         'Time', default=0,  # this value may vary..
-        help_text=_('Average duration of succesful jobs in seconds.'))
+        help_text=_('Average duration of succesful jobs in seconds '
+                    '(exponentially weighted).'))
+    duration_variance = models.FloatField(
+        default=0, editable=False,
+        help_text=_('Variance of the duration of succesful jobs '
+                    '(exponentially weighted).'))
+    # The averages that unusual runs are detected with, see planb.anomaly.
+    trend_runs = models.PositiveIntegerField(
+        default=0, editable=False,
+        help_text=_('Number of succesful jobs in the growth averages.'))
+    growth_average = models.FloatField(
+        default=0, editable=False,
+        help_text=_('Average growth of the total size per succesful job '
+                    'in MiB (exponentially weighted).'))
+    growth_variance = models.FloatField(default=0, editable=False)
+    snapshot_growth_average = models.FloatField(
+        default=0, editable=False,
+        help_text=_('Average growth of the snapshot size per succesful '
+                    'job in MiB (exponentially weighted).'))
+    snapshot_growth_variance = models.FloatField(default=0, editable=False)
 
     do_snapshot_size_listing = models.BooleanField(
         _('Create disk usage summary'), blank=True, default=True,
         help_text=_(
             'Summarize disk usage after the transport. '
             'This can be slow if there are many files.'))
+    snapshot_size_listing_at = models.DateTimeField(
+        _('Last disk usage summary'), blank=True, null=True, editable=False,
+        help_text=_('When the disk usage summary was last created.'))
 
     is_enabled = models.BooleanField(default=True)
     is_running = models.BooleanField(default=False)
@@ -209,6 +261,8 @@ class Fileset(models.Model):
 
     @property
     def snapshot_size(self):
+        if self.last_successful_backuprun is None:
+            return 0
         return self.last_successful_backuprun.snapshot_size
 
     @cached_property
@@ -225,14 +279,6 @@ class Fileset(models.Model):
         except (ValueError, ZeroDivisionError):
             return _('N/A')
 
-    @cached_property
-    def last_backuprun(self):
-        return self.backuprun_set.latest('started')
-
-    @cached_property
-    def last_successful_backuprun(self):
-        return self.backuprun_set.filter(success=True).latest('started')
-
     def get_dataset(self):
         return self.storage.get_dataset(self.dataset_name)
 
@@ -249,9 +295,16 @@ class Fileset(models.Model):
         copy.last_ok = None
         copy.last_run = BOGODATE
         copy.first_fail = None
+        copy.first_ok = None
+        copy.last_backuprun = copy.last_successful_backuprun = None
         copy.is_queued = copy.is_running = False
         copy.average_duration = 0
+        copy.duration_variance = 0
+        copy.trend_runs = 0
+        copy.growth_average = copy.growth_variance = 0
+        copy.snapshot_growth_average = copy.snapshot_growth_variance = 0
         copy.total_size_mb = 0
+        copy.snapshot_size_listing_at = None
         copy.dataset_name = ''
 
         transport_overrides = {}
@@ -272,6 +325,29 @@ class Fileset(models.Model):
 
         return copy
 
+    @property
+    def p90_duration(self):
+        """
+        Estimate of the duration in seconds that 9 out of 10 runs stay
+        within (taking the durations as normally distributed).
+        """
+        return int(
+            self.average_duration + 1.2816 * math.sqrt(self.duration_variance))
+
+    def get_duration_estimate(self, duration):
+        """
+        Return the (average_duration, duration_variance) after a successful
+        run of duration seconds: the exponentially weighted moving average
+        and variance, with weight PLANB_DURATION_EWMA_ALPHA for the new run.
+        """
+        if self.last_successful_backuprun_id is None:
+            return int(duration), 0.0
+
+        average, variance = update_ewma(
+            self.average_duration, self.duration_variance, duration,
+            settings.PLANB_DURATION_EWMA_ALPHA)
+        return int(round(average)), variance
+
     def should_backup(self):
         if not self.is_enabled:
             return False
@@ -307,10 +383,10 @@ class Fileset(models.Model):
                 seconds_since_last >= (8 * 3600)):
             return False
 
-        # If the last backup was "started" (using average duration) more
+        # If the last backup was "started" (using the p90 duration) more
         # than 24 hours ago. If we decrease this, we can make the
         # backups start sooner than 00:00.
-        if (seconds_since_last + self.average_duration) >= (24 * 3600):
+        if (seconds_since_last + self.p90_duration) >= (24 * 3600):
             return False
 
         return True
@@ -324,15 +400,26 @@ class Fileset(models.Model):
             yearly_retention=self.yearly_retention)
 
     def snapshot_list(self):
-        return self.storage.snapshot_list(self.dataset_name)
+        # The Snapshot rows, not the storage; uses
+        # prefetch_related('snapshots') if done.
+        return [snapshot.name for snapshot in self.snapshots.all()]
 
     def snapshot_list_display(self):
-        try:
-            snapshots = self.snapshot_list()
-        except DatasetNotFound:
-            return ['(dataset not found in storage {!r})'.format(
-                self.storage_alias)]
-        return sorted([s.split('@')[-1] for s in snapshots])
+        return sorted(self.snapshot_list())
+
+    def snapshot_size_listing_is_stale(self):
+        """
+        Return True if the disk usage summary should be recreated.
+
+        Sizes are taken from the storage after every run, but walking all
+        files for the per-path summary is done only once every
+        PLANB_SNAPSHOT_LISTING_MAX_AGE seconds (or always, if it is 0).
+        """
+        max_age = settings.PLANB_SNAPSHOT_LISTING_MAX_AGE
+        if not max_age or self.snapshot_size_listing_at is None:
+            return True
+        age = (timezone.now() - self.snapshot_size_listing_at).total_seconds()
+        return age >= max_age
 
     def snapshot_create(self):
         # Add logica what kind of snapshot
@@ -382,11 +469,15 @@ class Fileset(models.Model):
         return True
 
     def signal_done(self, success):
-        instance = Fileset.objects.get(pk=self.pk)
+        instance = (
+            Fileset.objects.select_related('last_backuprun').get(pk=self.pk))
+        run = instance.last_backuprun
+        anomalies = run.get_anomalies() if success and run else []
         # Using send_robust, because we do not want user-code to mess up
         # the rest of our state.
         backup_done.send_robust(
-            sender=self.__class__, fileset=instance, success=success)
+            sender=self.__class__, fileset=instance, success=success,
+            anomalies=anomalies)
 
     def save(self, *args, **kwargs):
         # Notify the same users who get ERROR / Success for backups that
@@ -395,6 +486,9 @@ class Fileset(models.Model):
             old_enabled = Fileset.objects.values_list(
                 'is_enabled', flat=True).get(pk=self.pk)
             if self.is_enabled != old_enabled:
+                # After the commit, or a render in between caches the
+                # old state again.
+                transaction.on_commit(clear_global_messages_cache)
                 mail_admins(
                     'INFO: Backup {} of {}'.format(
                         'ENABLED' if self.is_enabled else 'DISABLED', self),
@@ -447,10 +541,19 @@ class BackupRun(models.Model):
     snapshot_size_mb = models.PositiveIntegerField(
         default=0,
         help_text=_('Estimated single backup size in MiB.'))
+    written_mb = models.PositiveIntegerField(
+        default=0,
+        help_text=_('Data written (transferred) in MiB, if the storage '
+                    'tells.'))
+    anomalies = models.CharField(
+        max_length=63, blank=True,
+        help_text=_('Unusual growth, shrinkage or slowdown of this run '
+                    '(space separated), see planb.anomaly.'))
     snapshot_size_listing = models.TextField(
         blank=True,
-        # This will be populated by dutree-output.
-        help_text=_('YAML-safe "PATH: SIZE<LF>"{n} dictionary of paths.'))
+        # The paths are in the SnapshotListingEntry rows (listing_entries).
+        help_text=_('State of the path listing: "summary_pending: 0", '
+                    '"summary_error: 0", "summary_disabled: 0" or empty.'))
 
     @property
     def total_size(self):
@@ -460,18 +563,40 @@ class BackupRun(models.Model):
     def snapshot_size(self):
         return self.snapshot_size_mb << 20
 
+    def get_anomalies(self):
+        return self.anomalies.split()
+
     def snapshot_size_listing_as_list(self):
-        if not self.snapshot_size_listing:
-            return []
-
-        list_ = []
-        for line in self.snapshot_size_listing.splitlines():
-            path, size = line.rsplit(':', 1)
-            if path[0] == path[-1] == '"':
-                path = path[1:-1]
-            size = int(size.replace(',', ''))
-            list_.append((path, size))
-        return list_
+        # Uses prefetch_related('listing_entries') if done.
+        return [
+            (entry.path, entry.size) for entry in self.listing_entries.all()]
+
+    def set_snapshot_size_listing(self, leaves):
+        """
+        Replace the path listing with the (path, size) leaves.
+        """
+        with transaction.atomic():
+            self.listing_entries.all().delete()
+            SnapshotListingEntry.objects.bulk_create(
+                (SnapshotListingEntry(
+                    run=self, position=position, path=path, size=size)
+                 for position, (path, size) in enumerate(leaves)),
+                batch_size=500)
+            BackupRun.objects.filter(pk=self.pk).update(
+                snapshot_size_listing='')
+        self.snapshot_size_listing = ''
+
+    class Meta:
+        indexes = [
+            # The last (successful) runs of a fileset: latest('started'),
+            # average durations, growth and listing reuse. The primary key
+            # is implied at the end, for ('-started', '-id') ordering.
+            models.Index(
+                fields=['fileset', 'success', 'started'],
+                name='planb_run_fileset_ok_idx'),
+            models.Index(
+                fields=['fileset', 'started'], name='planb_run_fileset_idx'),
+        ]
 
     def __str__(self):
         return '<BackupRun({} #{}-{}{})>'.format(
@@ -479,6 +604,108 @@ class BackupRun(models.Model):
             '' if self.success else ' failed')
 
 
+class Snapshot(models.Model):
+    """
+    A snapshot of the dataset of a fileset, as last synced from the
+    storage (see planb.snapshots). Reads use these; the storage is only
+    asked when snapshots are made or destroyed.
+    """
+    fileset = models.ForeignKey(
+        Fileset, related_name='snapshots', on_delete=models.CASCADE)
+    name = models.CharField(max_length=63)
+    type = models.CharField(
+        max_length=15, help_text=_('daily, weekly, monthly or yearly.'))
+    created = models.DateTimeField(blank=True, null=True)
+    used = models.BigIntegerField(
+        blank=True, null=True,
+        help_text=_('Bytes only in this snapshot, if the storage tells.'))
+    referenced = models.BigIntegerField(
+        blank=True, null=True,
+        help_text=_('Bytes of all data in this snapshot, if the storage '
+                    'tells.'))
+
+    class Meta:
+        ordering = ('name',)
+        unique_together = ('fileset', 'name')
+
+    def __str__(self):
+        return '{}@{}'.format(self.fileset_id, self.name)
+
+
+class SnapshotListingEntry(models.Model):
+    """
+    A path of the snapshot size listing of a BackupRun (made by dutree),
+    in the order of the listing.
+    """
+    run = models.ForeignKey(
+        BackupRun, related_name='listing_entries', on_delete=models.CASCADE)
+    position = models.PositiveIntegerField()
+    path = models.TextField()
+    size = models.BigIntegerField(help_text=_('Size in bytes.'))
+
+    class Meta:
+        ordering = ('position',)
+        unique_together = ('run', 'position')
+        indexes = [
+            # The largest paths, across all filesets.
+            models.Index(fields=['-size'], name='planb_listing_size_idx'),
+            # The largest paths of a run, without sorting the listing.
+            models.Index(
+                fields=['run', '-size'], name='planb_listing_run_size_idx'),
+        ]
+
+    def __str__(self):
+        return '{}: {}'.format(self.path, self.size)
+
+
+class BackupRunRollup(models.Model):
+    """
+    The BackupRuns of a fileset on a single day, compacted into one row
+    once they are older than the last PLANB_BACKUPRUN_KEEP runs (see
+    planb.rollup). Use these for history beyond the recent runs.
+    """
+    fileset = models.ForeignKey(
+        Fileset, related_name='rollups', on_delete=models.CASCADE)
+    date = models.DateField(help_text=_('The day the runs started.'))
+
+    runs = models.PositiveIntegerField(
+        default=0, help_text=_('Number of backup runs.'))
+    successful_runs = models.PositiveIntegerField(
+        default=0, help_text=_('Number of successful backup runs.'))
+    duration = models.PositiveIntegerField(
+        default=0, help_text=_('Total duration of the runs in seconds.'))
+    total_size_mb = models.PositiveIntegerField(
+        default=0,
+        help_text=_('Largest total backup size in MiB of a successful '
+                    'run.'))
+    snapshot_size_mb = models.PositiveIntegerField(
+        default=0,
+        help_text=_('Largest single backup size in MiB of a successful '
+                    'run.'))
+    written_mb = models.PositiveIntegerField(
+        default=0,
+        help_text=_('Data written (transferred) by the successful runs in '
+                    'MiB, if the storage tells.'))
+
+    class Meta:
+        unique_together = ('fileset', 'date')
+
+    def __str__(self):
+        return '<BackupRunRollup({} #{}: {}/{})>'.format(
+            self.date.strftime('%Y-%m-%d'), self.fileset_id,
+            self.successful_runs, self.runs)
+
+    @property
+    def total_size(self):
+        return self.total_size_mb << 20
+
+
+@receiver(backup_done)
+@receiver(post_delete, sender=Fileset)
+def clear_global_messages(sender, *args, **kwargs):
+    clear_global_messages_cache()
+
+
 @receiver(post_save, sender=Fileset)
 def create_dataset(sender, instance, created, *args, **kwargs):
     if not instance.is_enabled:
@@ -0,0 +1,321 @@
+"""
+Pick the storage pool for new filesets.
+
+Every pool gets a score from two things:
+
+- space: the free space left after the predicted growth of the filesets
+  already on it (over PLANB_PLACEMENT_HORIZON_DAYS) and the size of the
+  new fileset, as a fraction of the pool size;
+- time: the part of the nightly backup window (PLANB_PLACEMENT_NIGHT_SECONDS
+  times the qcluster workers) that is not yet taken by the average
+  transport durations of the filesets on it.
+
+The score is space * time; pools that would drop below
+PLANB_PLACEMENT_MIN_FREE are not eligible. Pools that cannot tell their
+size (like the dummy storage) count as empty.
+
+The same loads drive the rebalancing planner (plan_moves): it moves
+filesets from the fullest/busiest pools to the emptiest ones until the
+spread of the space used and of the nightly busy time is within
+PLANB_REBALANCE_TOLERANCE, picking the moves with the most effect per
+byte moved.
+"""
+from datetime import timedelta
+import logging
+
+from django.conf import settings
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from planb.models import BackupRun, BackupRunRollup, Fileset
+from planb.storage import pools
+
+logger = logging.getLogger(__name__)
+
+# The cost of a move in bytes, on top of its size.
+MOVE_OVERHEAD = 1 << 30
+
+
+class PoolLoad(object):
+    def __init__(self, alias, space, growth=0, busy=0, filesets=0):
+        self.alias = alias
+        self.space = space          # (used, available) bytes or None
+        self.growth = growth        # bytes per day
+        self.busy = busy            # seconds of transport per night
+        self.filesets = filesets
+
+    def __repr__(self):
+        return '<PoolLoad({}: space={!r} growth={} busy={})>'.format(
+            self.alias, self.space, self.growth, self.busy)
+
+    def add(self, size, duration, growth=0):
+        """
+        Account for a new fileset of size bytes and duration seconds.
+        """
+        if self.space:
+            used, available = self.space
+            self.space = (used + size, available - size)
+        self.busy += duration
+        self.growth += growth
+        self.filesets += 1
+
+    def remove(self, size, duration, growth=0):
+        """
+        Account for a fileset that leaves the pool.
+        """
+        if self.space:
+            used, available = self.space
+            self.space = (used - size, available + size)
+        self.busy -= duration
+        self.growth -= growth
+        self.filesets -= 1
+
+    def get_headroom(self, size=0):
+        """
+        Return the bytes left after the predicted growth and size, or None
+        if unknown.
+        """
+        if not self.space:
+            return None
+        growth = self.growth * settings.PLANB_PLACEMENT_HORIZON_DAYS
+        return self.space[1] - growth - size
+
+    def get_usage(self):
+        """
+        Return the fraction of the pool used after the predicted growth, or
+        None if unknown.
+        """
+        headroom = self.get_headroom()
+        if headroom is None:
+            return None
+        return 1 - headroom / (sum(self.space) or 1)
+
+    def get_busyness(self):
+        """
+        Return the fraction of the nightly backup window taken.
+        """
+        return self.busy / _get_window()
+
+    def get_score(self, size=0):
+        """
+        Return the score (0..1, higher is better) for a new fileset of
+        size bytes, or None if it does not fit.
+        """
+        headroom = self.get_headroom(size)
+        if headroom is None:
+            space = 1.0
+        else:
+            capacity = sum(self.space) or 1
+            space = headroom / capacity
+            if space < settings.PLANB_PLACEMENT_MIN_FREE:
+                return None
+
+        # Keep ordering by space when all pools are overbooked.
+        time = max(0.05, 1 - self.get_busyness())
+        return space * time
+
+
+class Move(object):
+    def __init__(self, fileset, source, target, growth=0):
+        self.fileset = fileset
+        self.source = source        # PoolLoad
+        self.target = target        # PoolLoad
+        self.size = fileset.total_size
+        self.duration = fileset.average_duration
+        self.growth = growth
+
+    def __str__(self):
+        return '{} from {} to {}'.format(
+            self.fileset, self.source.alias, self.target.alias)
+
+    def apply(self):
+        self.source.remove(self.size, self.duration, self.growth)
+        self.target.add(self.size, self.duration, self.growth)
+
+    def revert(self):
+        self.target.remove(self.size, self.duration, self.growth)
+        self.source.add(self.size, self.duration, self.growth)
+
+
+def _get_window():
+    return (
+        settings.PLANB_PLACEMENT_NIGHT_SECONDS
+        * settings.Q_CLUSTER['workers'])
+
+
+def _iter_fileset_growth(now):
+    """
+    Yield (storage_alias, fileset_id, bytes per day): the increase of the
+    total size of every fileset over the last PLANB_PLACEMENT_GROWTH_DAYS,
+    from the oldest to the newest size (0 if it shrank).
+    """
+    days = settings.PLANB_PLACEMENT_GROWTH_DAYS
+    since = now - timedelta(days=days)
+    # The recent runs, and the daily rollups of the compacted ones (which
+    # are older than the runs of the same day).
+    rows = [
+        (alias, fileset_id, (timezone.localtime(started).date(), 1, started),
+         total_size_mb)
+        for alias, fileset_id, started, total_size_mb in (
+            BackupRun.objects.filter(
+                success=True, fileset__is_enabled=True, started__gte=since)
+            .values_list(
+                'fileset__storage_alias', 'fileset', 'started',
+                'total_size_mb'))]
+    rows.extend(
+        (alias, fileset_id, (date, 0), total_size_mb)
+        for alias, fileset_id, date, total_size_mb in (
+            BackupRunRollup.objects.filter(
+                successful_runs__gt=0, fileset__is_enabled=True,
+                date__gte=timezone.localtime(since).date())
+            .values_list(
+                'fileset__storage_alias', 'fileset', 'date',
+                'total_size_mb')))
+
+    oldest, newest = {}, {}
+    for alias, fileset_id, key, total_size_mb in rows:
+        if fileset_id not in oldest or key < oldest[fileset_id][0]:
+            oldest[fileset_id] = (key, total_size_mb)
+        if fileset_id not in newest or key > newest[fileset_id][0]:
+            newest[fileset_id] = (key, total_size_mb, alias)
+
+    for fileset_id, (key, total_size_mb, alias) in sorted(newest.items()):
+        growth = max(0, total_size_mb - oldest[fileset_id][1])
+        yield alias, fileset_id, (growth << 20) / days
+
+
+def get_pool_loads(now=None):
+    """
+    Return a dict of alias to PoolLoad for all storage pools.
+    """
+    now = now or timezone.now()
+    loads = dict(
+        (alias, PoolLoad(alias, pool.get_space()))
+        for alias, pool in pools.items())
+
+    for row in (
+            Fileset.objects.filter(is_enabled=True)
+            .values('storage_alias')
+            .annotate(busy=Sum('average_duration'), filesets=Count('id'))):
+        if row['storage_alias'] in loads:
+            load = loads[row['storage_alias']]
+            load.busy, load.filesets = row['busy'], row['filesets']
+
+    for alias, fileset_id, growth in _iter_fileset_growth(now):
+        if alias in loads:
+            loads[alias].growth += growth
+
+    return loads
+
+
+def rank_pools(size=0, loads=None):
+    """
+    Return the [(score, PoolLoad)] of the eligible pools for a new fileset
+    of size bytes, best first.
+    """
+    if loads is None:
+        loads = get_pool_loads()
+    ranking = []
+    for alias, load in sorted(loads.items()):
+        score = load.get_score(size)
+        if score is not None:
+            ranking.append((score, load))
+    ranking.sort(key=(lambda x: -x[0]))
+    return ranking
+
+
+def suggest_pool(size=0, loads=None):
+    """
+    Return the alias of the best pool for a new fileset of size bytes, or
+    None if no pool has room for it.
+    """
+    ranking = rank_pools(size, loads)
+    if not ranking:
+        logger.warning('No storage pool has room for %d bytes', size)
+        return None
+    return ranking[0][1].alias
+
+
+def get_imbalance(loads):
+    """
+    Return the spread of the space used plus the spread of the nightly
+    busy time over the pools (both as fractions): 0 is perfectly even.
+    """
+    usages = [
+        usage for usage in (load.get_usage() for load in loads.values())
+        if usage is not None]
+    busy = [load.get_busyness() for load in loads.values()]
+    imbalance = 0
+    for values in (usages, busy):
+        if values:
+            imbalance += max(values) - min(values)
+    return imbalance
+
+
+def get_fileset_candidates(loads, now=None):
+    """
+    Return [(fileset, bytes per day)] of the enabled filesets on the pools
+    of loads, to feed to plan_moves().
+    """
+    now = now or timezone.now()
+    growth = dict(
+        (fileset_id, value)
+        for alias, fileset_id, value in _iter_fileset_growth(now))
+    return [
+        (fileset, growth.get(fileset.pk, 0))
+        for fileset in Fileset.objects.filter(
+            is_enabled=True, storage_alias__in=loads.keys()).order_by('pk')]
+
+
+def _best_move(loads, candidates, max_size):
+    before = get_imbalance(loads)
+    best, best_value = None, 0
+    for fileset, growth in candidates:
+        for target in loads.values():
+            move = Move(fileset, loads[fileset.storage_alias], target, growth)
+            if target is move.source or move.size > max_size:
+                continue
+            # Only to pools where it fits.
+            if target.get_score(move.size + growth * (
+                    settings.PLANB_PLACEMENT_HORIZON_DAYS)) is None:
+                continue
+            move.apply()
+            gain = before - get_imbalance(loads)
+            move.revert()
+            # Effect per byte moved; with a fixed cost per move, so of
+            # equally efficient moves the largest (fewest moves) wins.
+            value = gain / (move.size + MOVE_OVERHEAD)
+            if gain > 0 and value > best_value:
+                best, best_value = move, value
+    return best
+
+
+def plan_moves(loads, candidates, max_moves=None, max_size=None):
+    """
+    Return a list of Moves that even out the space and nightly busy time
+    of the pools, for at most max_moves filesets and max_size bytes. The
+    loads are updated as if the moves were done.
+
+    Every step takes the move with the biggest decrease of the imbalance
+    per byte moved, until the imbalance is within
+    PLANB_REBALANCE_TOLERANCE or no move improves it.
+    """
+    if max_moves is None:
+        max_moves = settings.PLANB_REBALANCE_MAX_MOVES
+    if max_size is None:
+        max_size = settings.PLANB_REBALANCE_MAX_SIZE
+    candidates = [
+        (fileset, growth) for fileset, growth in candidates
+        if fileset.storage_alias in loads]
+
+    moves = []
+    while (len(moves) < max_moves
+           and get_imbalance(loads) > settings.PLANB_REBALANCE_TOLERANCE):
+        move = _best_move(loads, candidates, max_size)
+        if move is None:
+            break
+        move.apply()
+        moves.append(move)
+        max_size -= move.size
+        candidates = [i for i in candidates if i[0] != move.fileset]
+    return moves
@@ -0,0 +1,118 @@
+"""
+Host group quotas.
+
+The quota of the host group is applied to the storage (as ZFS quota on
+the hostgroup parent dataset in the nested ZFS layout; other storage has
+no such property) when it is saved, and when a fileset is added to the
+group.
+
+Before the transport of a backup starts, the quota is checked against
+the expected usage: the current usage of the host group plus the largest
+growth of the fileset over its last PLANB_QUOTA_GROWTH_RUNS runs. A run
+that would exceed the quota is refused at once, instead of failing with
+ENOSPC hours later.
+"""
+import logging
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from planb.common import human
+from planb.common.subprocess2 import CalledProcessError
+from planb.models import BackupRun, Fileset
+from planb.storage import pools
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def apply_quota(hostgroup, storage_aliases=None):
+    """
+    Set the quota of the hostgroup on the storage of its filesets, or on
+    the storage_aliases. Returns whether any storage enforces it.
+    """
+    if storage_aliases is None:
+        storage_aliases = (
+            hostgroup.filesets.values_list('storage_alias', flat=True)
+            .order_by('storage_alias').distinct())
+    applied = False
+    for storage_alias in storage_aliases:
+        try:
+            applied |= pools[storage_alias].set_namespace_quota(
+                hostgroup.name, hostgroup.quota)
+        except CalledProcessError as e:
+            logger.warning(
+                'Cannot set quota of %s on %s: %s', hostgroup, storage_alias,
+                e)
+    return applied
+
+
+def get_hostgroup_usage(hostgroup):
+    """
+    Return the bytes used by all filesets of the hostgroup: read from the
+    storage where it can do so for the whole group, otherwise the sum of
+    the last known fileset sizes.
+    """
+    usage = 0
+    for storage_alias in (
+            hostgroup.filesets.values_list('storage_alias', flat=True)
+            .order_by('storage_alias').distinct()):
+        filesets = hostgroup.filesets.filter(storage_alias=storage_alias)
+        storage_usage = filesets[0].storage.get_namespace_usage(
+            hostgroup.name)
+        if storage_usage is None:
+            storage_usage = sum(
+                filesets.values_list('total_size_mb', flat=True)) << 20
+        usage += storage_usage
+    return usage
+
+
+def estimate_run_growth(fileset):
+    """
+    Return the expected growth in bytes of the next run: the largest
+    increase of the total size between the recent successful runs.
+    """
+    sizes = list(
+        BackupRun.objects.filter(fileset=fileset, success=True)
+        .order_by('-started', '-id').values_list('total_size_mb', flat=True)
+        [0:(settings.PLANB_QUOTA_GROWTH_RUNS + 1)])
+    increases = [new - old for new, old in zip(sizes, sizes[1:])]
+    return max([0] + increases) << 20
+
+
+def check_quota(fileset):
+    """
+    Check the hostgroup quota before a run of the fileset. Raises
+    QuotaExceeded if the run is expected to exceed it; warns when it
+    comes above PLANB_QUOTA_WARN of it.
+    """
+    hostgroup = fileset.hostgroup
+    quota = hostgroup.quota
+    if quota is None:
+        return
+
+    usage = get_hostgroup_usage(hostgroup)
+    expected = usage + estimate_run_growth(fileset)
+    if expected > quota:
+        raise QuotaExceeded(
+            'Quota of {} exceeded: {} used, {} expected after the run, '
+            'quota is {}'.format(
+                hostgroup, human.bytes(usage), human.bytes(expected),
+                human.bytes(quota)))
+    if expected > quota * settings.PLANB_QUOTA_WARN:
+        logger.warning(
+            '[%s] Quota of %s almost reached: %s expected after the run, '
+            'quota is %s', fileset, hostgroup, human.bytes(expected),
+            human.bytes(quota))
+
+
+@receiver(post_save, sender=Fileset)
+def apply_quota_to_new_fileset(sender, instance, created, **kwargs):
+    # The hostgroup parent dataset may have been created along with it.
+    if created and instance.is_enabled and (
+            instance.hostgroup.quota is not None):
+        apply_quota(instance.hostgroup, [instance.storage_alias])
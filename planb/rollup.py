@@ -0,0 +1,87 @@
+"""
+Compaction of the BackupRun history.
+
+Every fileset keeps the full BackupRun detail (errors, listings,
+attributes) of its last PLANB_BACKUPRUN_KEEP runs. Older runs are
+summed into a BackupRunRollup per fileset per day and removed, so the
+BackupRun table stays bounded. Runs that are still referenced (the last
+(successful) run of the fileset, or a pending disk usage summary) are
+kept until they are not.
+
+Schedule planb.tasks.compact_runs daily to do so.
+"""
+from collections import OrderedDict
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from planb.models import BackupRun, BackupRunRollup, Fileset
+
+logger = logging.getLogger(__name__)
+
+
+def _add_run(rollup, run):
+    rollup.runs += 1
+    rollup.duration += run.duration or 0
+    if run.success:
+        rollup.successful_runs += 1
+        rollup.total_size_mb = max(rollup.total_size_mb, run.total_size_mb)
+        rollup.snapshot_size_mb = max(
+            rollup.snapshot_size_mb, run.snapshot_size_mb)
+        rollup.written_mb += run.written_mb
+
+
+def compact_fileset_runs(fileset, keep=None):
+    """
+    Compact the runs of the fileset beyond the last keep runs into daily
+    rollups. Returns the number of compacted runs.
+    """
+    if keep is None:
+        keep = settings.PLANB_BACKUPRUN_KEEP
+    runs = BackupRun.objects.filter(fileset_id=fileset.pk)
+    kept = list(
+        runs.order_by('-started', '-id').values_list('pk', flat=True)
+        [0:keep])
+    old_runs = list(
+        runs.exclude(pk__in=kept)
+        .exclude(pk__in=(
+            fileset.last_backuprun_id, fileset.last_successful_backuprun_id))
+        .exclude(snapshot_size_listing__startswith='summary_pending')
+        .order_by('started'))
+    if not old_runs:
+        return 0
+
+    days = OrderedDict()
+    for run in old_runs:
+        days.setdefault(
+            timezone.localtime(run.started).date(), []).append(run)
+
+    with transaction.atomic():
+        for date, day_runs in days.items():
+            # A day may have been compacted before, except for a run that
+            # was still referenced then.
+            rollup, created = (
+                BackupRunRollup.objects.select_for_update()
+                .get_or_create(fileset_id=fileset.pk, date=date))
+            for run in day_runs:
+                _add_run(rollup, run)
+            rollup.save()
+        BackupRun.objects.filter(pk__in=[i.pk for i in old_runs]).delete()
+
+    logger.info(
+        '[%s] Compacted %d runs into %d daily rollups', fileset,
+        len(old_runs), len(days))
+    return len(old_runs)
+
+
+def compact_runs(keep=None):
+    """
+    Compact the old runs of all filesets. Returns the number of compacted
+    runs.
+    """
+    total = 0
+    for fileset in Fileset.objects.order_by('pk'):
+        total += compact_fileset_runs(fileset, keep)
+    return total
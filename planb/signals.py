@@ -1,4 +1,5 @@
 import django.dispatch
 
 
-backup_done = django.dispatch.Signal(providing_args=['fileset', 'success'])
+backup_done = django.dispatch.Signal(
+    providing_args=['fileset', 'success', 'anomalies'])
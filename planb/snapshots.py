@@ -0,0 +1,115 @@
+"""
+Mirror the snapshots on the storage in the Snapshot table.
+
+Listing the snapshots of a dataset takes a zfs (sudo) call, so the admin
+pages and the backup report read the Snapshot rows instead. These are
+synced after every backup run, for the fileset that ran, and by the
+planb.tasks.reconcile_snapshots task (schedule it daily) from a single
+snapshot listing per storage pool, to pick up changes made by hand.
+"""
+from datetime import datetime
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from planb.models import Fileset, FilesetLock, Snapshot
+from planb.storage import pools
+from planb.storage.base import DatasetNotFound
+
+logger = logging.getLogger(__name__)
+
+
+def get_created(snapname):
+    """
+    Return the creation time in the (UTC) name of a snapshot made by
+    Fileset.snapshot_create, or None.
+    """
+    try:
+        created = datetime.strptime(snapname.split('-', 1)[1], '%Y%m%d%H%M')
+    except (IndexError, ValueError):
+        return None
+    return timezone.make_aware(created, timezone.utc)
+
+
+def sync_fileset_snapshots(fileset, snapshots=None):
+    """
+    Update the Snapshot rows of fileset to the (dataset_name, snapname,
+    created, used, referenced) snapshots, or to the snapshots on its
+    storage if None. Returns the number of (added, removed) rows.
+    """
+    if snapshots is None:
+        try:
+            snapshots = fileset.storage.get_snapshots(fileset.dataset_name)
+        except DatasetNotFound:
+            snapshots = []
+
+    existing = dict((i.name, i) for i in fileset.snapshots.all())
+    added, changed = [], []
+    for dataset_name, snapname, created, used, referenced in snapshots:
+        snapshot = existing.pop(snapname, None) or Snapshot(
+            fileset=fileset, name=snapname, type=snapname.split('-', 1)[0])
+        values = (created or get_created(snapname), used, referenced)
+        if snapshot.pk is None:
+            added.append(snapshot)
+        elif (snapshot.created, snapshot.used, snapshot.referenced) != values:
+            changed.append(snapshot)
+        snapshot.created, snapshot.used, snapshot.referenced = values
+
+    with transaction.atomic():
+        if existing:
+            Snapshot.objects.filter(
+                pk__in=[i.pk for i in existing.values()]).delete()
+        Snapshot.objects.bulk_create(added)
+        Snapshot.objects.bulk_update(
+            changed, ('created', 'used', 'referenced'), batch_size=500)
+    return len(added), len(existing)
+
+
+def _reconcile_pool_snapshots(alias, storage):
+    listed_at = timezone.now()
+    snapshots = storage.get_snapshots()
+    by_dataset = {}
+    for snapshot in snapshots:
+        by_dataset.setdefault(snapshot[0], []).append(snapshot)
+
+    added = removed = 0
+    for fileset in Fileset.objects.filter(
+            storage_alias=alias).order_by('pk'):
+        lock = FilesetLock(fileset.pk)
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            # The run sets last_run after its snapshot changes.
+            if Fileset.objects.filter(
+                    pk=fileset.pk, last_run__gte=listed_at).exists():
+                continue
+            counts = sync_fileset_snapshots(
+                fileset, by_dataset.get(fileset.dataset_name, []))
+        finally:
+            lock.release()
+        added += counts[0]
+        removed += counts[1]
+    return added, removed
+
+
+def reconcile_snapshots():
+    """
+    Sync the Snapshot rows of all filesets, with one snapshot listing per
+    storage pool. Filesets that are locked (backing up), or that finished
+    a run after the listing, are skipped; their run syncs them. Returns
+    the number of (added, removed) rows.
+    """
+    added = removed = 0
+    for alias, storage in sorted(pools.items()):
+        try:
+            counts = _reconcile_pool_snapshots(alias, storage)
+        except NotImplementedError:
+            logger.info('Storage %s cannot list its snapshots', alias)
+            continue
+        added += counts[0]
+        removed += counts[1]
+
+    logger.info(
+        'Reconciled snapshots: %d added and %d removed', added, removed)
+    return added, removed
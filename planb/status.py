@@ -0,0 +1,156 @@
+"""
+The fileset status for monitoring, as served by planb.views.FilesetStatus.
+
+The status of every fileset is kept as a JSON object in a redis hash,
+with a random version token next to it that is used as the ETag. It is
+built with a single query when it has expired (after
+PLANB_STATUS_CACHE_TIMEOUT seconds) and updated for a single fileset
+when that fileset is saved, starts a backup run, or is done with one.
+Polls that send the ETag back in If-None-Match cost a single redis GET.
+
+A rebuild keeps the version if the status is the same as at the last
+rebuild (by a hash of it) and has not been updated since, so unchanged
+polls keep getting a 304 after it expired.
+"""
+from hashlib import sha1
+import json
+from uuid import uuid4
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from django_q.brokers.redis_broker import Redis
+
+from planb.models import Fileset
+from planb.signals import backup_done
+
+STATUS_CACHE_KEY = 'planb:status'
+STATUS_VERSION_KEY = 'planb:status:version'
+STATUS_FRESH_KEY = 'planb:status:fresh'
+STATUS_HASH_KEY = 'planb:status:hash'
+
+STATUS_FIELDS = (
+    'id', 'hostgroup__name', 'friendly_name', 'is_enabled', 'is_queued',
+    'is_running', 'last_ok', 'first_fail', 'total_size_mb',
+    'last_successful_backuprun__snapshot_size_mb', 'average_duration')
+
+
+def _isoformat(value):
+    return value and value.isoformat()
+
+
+def get_status_entries(fileset_ids=None):
+    """
+    Return the JSON encoded status of all filesets, or of the ones in
+    fileset_ids, by id.
+    """
+    qs = Fileset.objects.all()
+    if fileset_ids is not None:
+        qs = qs.filter(pk__in=fileset_ids)
+    entries = {}
+    for values in qs.values(*STATUS_FIELDS):
+        entries[values['id']] = json.dumps({
+            'id': values['id'],
+            'hostgroup': values['hostgroup__name'],
+            'friendly_name': values['friendly_name'],
+            'is_enabled': values['is_enabled'],
+            'is_queued': values['is_queued'],
+            'is_running': values['is_running'],
+            'last_ok': _isoformat(values['last_ok']),
+            'first_fail': _isoformat(values['first_fail']),
+            'total_size': values['total_size_mb'] << 20,
+            'snapshot_size': (
+                values['last_successful_backuprun__snapshot_size_mb']
+                or 0) << 20,
+            'average_duration': values['average_duration'],
+        }, sort_keys=True)
+    return entries
+
+
+def clear_status_cache():
+    Redis.get_connection().delete(STATUS_FRESH_KEY)
+
+
+def rebuild_status():
+    """
+    Store the status of all filesets and return the version: a new one
+    only if the status changed.
+    """
+    entries = get_status_entries()
+    digest = sha1(b'\n'.join(
+        entries[key].encode('utf-8') for key in sorted(entries))).hexdigest()
+    redis = Redis.get_connection()
+    pipe = redis.pipeline()
+    pipe.get(STATUS_VERSION_KEY)
+    pipe.get(STATUS_HASH_KEY)
+    version, old_digest = pipe.execute()
+    if version is None or old_digest != digest.encode('ascii'):
+        version = uuid4().hex
+    else:
+        version = version.decode('ascii')
+
+    pipe = redis.pipeline()
+    pipe.delete(STATUS_CACHE_KEY)
+    if entries:
+        pipe.hmset(STATUS_CACHE_KEY, entries)
+    pipe.set(STATUS_VERSION_KEY, version)
+    pipe.set(STATUS_HASH_KEY, digest)
+    pipe.set(
+        STATUS_FRESH_KEY, version, ex=settings.PLANB_STATUS_CACHE_TIMEOUT)
+    pipe.execute()
+    return version
+
+
+def update_status(*fileset_ids):
+    """
+    Update the stored status of the filesets with fileset_ids.
+    """
+    redis = Redis.get_connection()
+    if not redis.exists(STATUS_FRESH_KEY):
+        return  # rebuilt on the next get_status_version
+
+    entries = get_status_entries(fileset_ids)
+    pipe = redis.pipeline()
+    deleted = [pk for pk in fileset_ids if pk not in entries]
+    if deleted:
+        pipe.hdel(STATUS_CACHE_KEY, *deleted)
+    if entries:
+        pipe.hmset(STATUS_CACHE_KEY, entries)
+    pipe.set(STATUS_VERSION_KEY, uuid4().hex)
+    # No longer the status that was hashed.
+    pipe.delete(STATUS_HASH_KEY)
+    pipe.execute()
+
+
+def get_status_version():
+    """
+    Return the version of the stored status, (re)building it if needed.
+    """
+    pipe = Redis.get_connection().pipeline()
+    pipe.get(STATUS_VERSION_KEY)
+    pipe.exists(STATUS_FRESH_KEY)
+    version, fresh = pipe.execute()
+    if version is None or not fresh:
+        return rebuild_status()
+    return version.decode('ascii')
+
+
+def get_status_json():
+    """
+    Return the stored status as a JSON encoded list, ordered by id.
+    """
+    entries = Redis.get_connection().hgetall(STATUS_CACHE_KEY)
+    return b''.join((b'[', b','.join(
+        entries[key] for key in sorted(entries, key=int)), b']'))
+
+
+@receiver(backup_done)
+def update_status_when_done(sender, fileset, **kwargs):
+    update_status(fileset.pk)
+
+
+@receiver(post_save, sender=Fileset)
+@receiver(post_delete, sender=Fileset)
+def update_status_when_changed(sender, instance, **kwargs):
+    update_status(instance.pk)
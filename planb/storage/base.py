@@ -1,6 +1,13 @@
 from contextlib import contextmanager
+from datetime import datetime
 import logging
+import os
+import re
+import time
 
+from dateutil.relativedelta import relativedelta
+
+from planb.common import histogram
 from planb.common.subprocess2 import CalledProcessError, check_output
 
 logger = logging.getLogger(__name__)
@@ -10,6 +17,19 @@ class DatasetNotFound(Exception):
     pass
 
 
+def get_real_subpath(source, subpath):
+    """
+    Return the real path of subpath in the directory source. Raises
+    ValueError if it is outside of source, through '..' or a symlink.
+    """
+    source = os.path.realpath(source)
+    path = os.path.realpath(os.path.join(source, subpath))
+    if path != source and not path.startswith(source + '/'):
+        raise ValueError('Path {!r} is outside of {!r}'.format(
+            subpath, source))
+    return path
+
+
 class Storage(object):
     def __init__(self, config, alias):
         self.config = config
@@ -26,6 +46,53 @@ class Storage(object):
     def get_dataset_name(self, namespace, name):
         return '{}-{}'.format(namespace, name)
 
+    def get_namespace_dataset_name(self, namespace):
+        """
+        Return the name of the parent dataset of all datasets in the
+        namespace (hostgroup), or None if the storage has no such parents.
+        """
+        return None
+
+    def get_namespace_usage(self, namespace):
+        """
+        Return the bytes used by all datasets in the namespace, or None if
+        this cannot be read at once.
+        """
+        return None
+
+    def set_namespace_quota(self, namespace, quota):
+        """
+        Limit the bytes used by all datasets in the namespace (None for no
+        limit). Returns False if the storage cannot do so.
+        """
+        return False
+
+    def rename_namespace(self, old_namespace, new_namespace):
+        """
+        Rename the parent dataset of the namespace, and thereby all datasets
+        in it.
+        """
+        raise NotImplementedError()
+
+    def get_replication(self):
+        """
+        Return the replication handler for this storage, if configured.
+        """
+        return None
+
+    def get_space(self):
+        """
+        Return (used, available) bytes of the storage, or None if unknown.
+        """
+        return None
+
+    def get_io_latency(self):
+        """
+        Return the current average IO wait time of the storage in seconds,
+        or None if unknown.
+        """
+        return None
+
     def get_datasets(self):
         raise NotImplementedError()
 
@@ -38,11 +105,133 @@ class Storage(object):
     def snapshot_list(self, dataset_name):
         raise NotImplementedError()
 
+    def snapshot_delete(self, dataset_name, snapname):
+        raise NotImplementedError()
+
+    def get_snapshots(self, dataset_name=None):
+        """
+        Return the (dataset_name, snapname, created, used, referenced) of
+        our snapshots of dataset_name, or of all datasets. Created is an
+        aware datetime and the sizes are in bytes, or None if unknown.
+
+        Storages that can list the snapshots of all datasets (and their
+        sizes) in a single call should override this.
+        """
+        if dataset_name is None:
+            dataset_names = [dataset.name for dataset in self.get_datasets()]
+        else:
+            dataset_names = [dataset_name]
+
+        snapshots = []
+        for name in dataset_names:
+            try:
+                snapnames = self.snapshot_list(name)
+            except DatasetNotFound:
+                if dataset_name is not None:
+                    raise
+                continue
+            snapshots.extend(
+                (name, snapname, None, None, None) for snapname in snapnames)
+        return snapshots
+
+    def _filter_snapshot_names(self, names, typ=None):
+        """
+        Take "dataset@snapshot" names, return the snapshot part of the
+        ones that look like ours (optionally of type typ only).
+        """
+        snapshots = []
+        if typ:
+            snapshot_rgx = re.compile(r'.*@{}\-\d+'.format(typ))
+        else:
+            snapshot_rgx = re.compile(r'^.*@\w+-\d+$')
+        for snapshot in names:
+            if snapshot_rgx.match(snapshot):
+                # Do not include the dataset in the snapshot name.
+                snapshots.append(snapshot.split('@', 1)[1])
+        return snapshots
+
+    # Note: We use retention + 1 to calculate if we need to
+    # retain the backup, in this situation we won't run into
+    # situations where your data already gets cleaned up just
+    # because it's older than the relative delta.
+    # 1 montly retention:
+    # 1 jan: monthly created
+    # 1 febr: new monthly created
+    # 1 febr: old monthly deleted
+    # situation, you have data from yesterday and no monthly data
+    def snapshot_retain_daily(self, snapname, retention):
+        try:
+            dts = re.match(r'\w+-(\d+)', snapname).groups()[0]
+        except AttributeError:
+            return True  # Keep
+        datetimestamp = datetime.strptime(dts, '%Y%m%d%H%M')
+        return datetimestamp > (
+            datetime.now() - relativedelta(days=retention+1))
+
+    def snapshot_retain_weekly(self, snapname, retention):
+        try:
+            dts = re.match(r'\w+-(\d+)', snapname).groups()[0]
+        except AttributeError:
+            return True  # Keep
+        datetimestamp = datetime.strptime(dts, '%Y%m%d%H%M')
+        snapdate = datetime.date(datetimestamp)
+        today_a_week_ago = datetime.date(
+            datetime.now() - relativedelta(weeks=retention+1))
+        return snapdate >= today_a_week_ago
+
+    def snapshot_retain_monthly(self, snapname, retention):
+        try:
+            dts = re.match(r'\w+-(\d+)', snapname).groups()[0]
+        except AttributeError:
+            return True  # Keep
+
+        datetimestamp = datetime.strptime(dts, '%Y%m%d%H%M')
+        snapdate = datetime.date(datetimestamp)
+        today_a_month_ago = datetime.date(
+            datetime.now() - relativedelta(months=retention+1))
+        return snapdate >= today_a_month_ago
+
+    def snapshot_retain_yearly(self, snapname, retention):
+        try:
+            dts = re.match(r'\w+-(\d+)', snapname).groups()[0]
+        except AttributeError:
+            return True  # Keep
+        datetimestamp = datetime.strptime(dts, '%Y%m%d%H%M')
+        snapdate = datetime.date(datetimestamp)
+        today_a_year_ago = datetime.date(
+            datetime.now() - relativedelta(years=retention+1))
+        return snapdate >= today_a_year_ago
+
+    def snapshots_delete(self, dataset_name, snapnames):
+        """
+        Delete multiple snapshots. Storages that can destroy snapshots in
+        a single call may override this.
+        """
+        for snapname in snapnames:
+            self.snapshot_delete(dataset_name, snapname)
+
     def snapshots_rotate(self, dataset_name, **kwargs):
         '''
         Rotate the snapshots according to the retention parameters in kwargs.
         '''
-        raise NotImplementedError()
+        snapshots = self.snapshot_list(dataset_name)
+        expired = []
+        logger.info('snapshots rotation for {}'.format(dataset_name))
+        for snapname in snapshots:
+            snaptype, dts = re.match(r'(\w+)-(\d+)', snapname).groups()
+            snapshot_retain_func = getattr(self,
+                                           'snapshot_retain_%s' % snaptype)
+            retention = kwargs.get('%s_retention' % snaptype)
+            if not snapshot_retain_func(snapname, retention):
+                expired.append((snapname, retention))
+
+        destroyed = [snapname for snapname, retention in expired]
+        self.snapshots_delete(dataset_name, destroyed)
+        for snapname, retention in expired:
+            logger.info(
+                'destroyed: %s@%s, past retention %s',
+                dataset_name, snapname, retention)
+        return destroyed
 
 
 class Datasets(list):
@@ -138,6 +327,15 @@ class Dataset(object):
     def get_used_size(self):
         raise NotImplementedError()
 
+    def get_snapshot_accounting(self, snapname):
+        """
+        Return a dict of cheaply available sizes of the snapshot, like
+        'referenced', 'written' and 'usedbysnapshots' (all in bytes).
+
+        Storages that cannot tell without walking the files return {}.
+        """
+        return {}
+
     def ensure_exists(self):
         pass
 
@@ -147,6 +345,38 @@ class Dataset(object):
     def get_snapshot_path(self, snapname):
         raise NotImplementedError()
 
+    def get_snapshot_subpath(self, snapname, subpath):
+        """
+        Return the real path of subpath in the snapshot. Raises ValueError
+        if it is outside of the snapshot, through a symlink in the (host
+        controlled) snapshot data.
+        """
+        return get_real_subpath(self.get_snapshot_path(snapname), subpath)
+
+    def mount(self):
+        """
+        Make the snapshot paths readable, for readers that cannot use
+        workon(), like the web interface: that changes the working
+        directory of the process. It is left mounted.
+        """
+        pass
+
+    def get_metadata_path(self):
+        """
+        Return the directory next to 'data' where planb may keep its own
+        bookkeeping for this dataset.
+        """
+        raise NotImplementedError()
+
+    def get_snapshot_diff(self, old_snapname, new_snapname):
+        """
+        Return the changes between two snapshots as a list of (change,
+        is_dir, relpath, new_relpath) tuples. The change is '+', '-', 'M'
+        or 'R' (renamed to new_relpath, which is None otherwise). Paths
+        are relative to the data path and start with a '/'.
+        """
+        raise NotImplementedError()
+
     def rename_dataset(self, new_dataset_name):
         raise NotImplementedError()
 
@@ -191,9 +421,25 @@ class OldStyleStorage(Storage):
     def _perform_binary_command(self, cmd):
         """
         Do _perform_sudo_command, but for the supplied binary.
+
+        The durations go into the storage_command histogram, by pool and
+        subcommand.
         """
-        return self._perform_sudo_command(
-            (self.binary,) + tuple(cmd))
+        t0 = time.time()
+        try:
+            return self._perform_sudo_command(
+                (self.binary,) + tuple(cmd))
+        finally:
+            self._observe_command(cmd[0], time.time() - t0)
+
+    def _observe_command(self, command, seconds):
+        try:
+            histogram.observe(
+                'storage_command', (self.alias, command), seconds)
+        except Exception as e:
+            # Never fail the command, or hide its error, for a metric.
+            logger.debug(
+                'Cannot observe %s %s duration: %s', self.alias, command, e)
 
     def get_datasets(self):
         """
@@ -206,12 +452,3 @@ class OldStyleStorage(Storage):
                 for directory in `zfs list -Hpo name`])
         """
         raise NotImplementedError()
-
-    def snapshot_retain_weekly(self, datetimestamp, retention):
-        raise NotImplementedError()
-
-    def snapshot_retain_monthly(self, datetimestamp, retention):
-        raise NotImplementedError()
-
-    def snapshot_retain_yearly(self, datetimestamp, retention):
-        raise NotImplementedError()
@@ -55,6 +55,9 @@ class DummyDataset(Dataset):
     def get_used_size(self):
         return 1001
 
+    def get_metadata_path(self):
+        return self.temp_directory
+
     def rename_dataset(self, new_dataset_name):
         self.backend._datasets.pop(self.name)
         self.name = new_dataset_name
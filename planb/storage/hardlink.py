@@ -0,0 +1,180 @@
+import logging
+import os
+import shutil
+
+from django.core.exceptions import ImproperlyConfigured
+
+from planb.common.subprocess2 import CalledProcessError, check_output
+
+from .base import Datasets, Dataset, DatasetNotFound, Storage
+
+logger = logging.getLogger(__name__)
+
+
+class HardlinkStorage(Storage):
+    """
+    Storage in plain directories below ROOT, for filesystems without
+    snapshots (ext4, xfs, ...).
+
+    Every dataset is a ROOT/<dataset_name> directory with the 'data'
+    directory that the transport updates. Snapshots are 'cp -al' copies
+    of it in .snapshot/<snapname>/data. Unchanged files are hardlinks to
+    the same inode, so a snapshot only takes the space of the files that
+    changed since the previous one.
+
+    This needs a transport that replaces changed files instead of
+    writing into them (rsync does so, unless --inplace is used).
+    Attribute-only changes (chmod/chown) do show in all snapshots sharing
+    the inode.
+    """
+    @classmethod
+    def ensure_defaults(cls, config):
+        super().ensure_defaults(config)
+        if 'ROOT' not in config:
+            raise ImproperlyConfigured('Hardlink storage requires a ROOT')
+        config.setdefault('CP_BINARY', '/bin/cp')
+        config.setdefault('DU_BINARY', '/usr/bin/du')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.root = self.config['ROOT']
+
+    def get_space(self):
+        try:
+            st = os.statvfs(self.root)
+        except OSError:
+            return None
+        return (
+            (st.f_blocks - st.f_bfree) * st.f_frsize,
+            st.f_bavail * st.f_frsize)
+
+    def get_label(self):
+        space = self.get_space()
+        if not space:
+            return '{}, ???G free (??? used)'.format(self.name)
+        used, available = space
+        return '{}, {}G free ({:.0f}% used)'.format(
+            self.name, available >> 30,
+            100 * used / ((used + available) or 1))
+
+    def get_datasets(self):
+        datasets = Datasets()
+        for name in sorted(os.listdir(self.root)):
+            dataset = HardlinkDataset(backend=self, name=name)
+            if os.path.isdir(dataset.get_data_path()):
+                dataset.set_disk_usage(dataset.get_used_size())
+                datasets.append(dataset)
+        return datasets
+
+    def get_dataset(self, dataset_name):
+        return HardlinkDataset(backend=self, name=dataset_name)
+
+    def du(self, *paths):
+        """
+        Return the disk usage of the paths in bytes, counting every inode
+        only for the first path that has it (like du(1) does).
+        """
+        out = check_output(
+            (self.config['DU_BINARY'], '-0', '-s', '-x', '-B1', '--')
+            + paths)
+        return [
+            int(line.split(b'\t', 1)[0])
+            for line in out.split(b'\0') if line]
+
+    def snapshot_create(self, dataset_name, snapname):
+        self.get_dataset(dataset_name).snapshot_create(snapname)
+        return '{}@{}'.format(dataset_name, snapname)
+
+    def snapshot_delete(self, dataset_name, snapname):
+        self.get_dataset(dataset_name).snapshot_delete(snapname)
+
+    def snapshot_list(self, dataset_name, typ=None):
+        path = os.path.join(self.root, dataset_name, '.snapshot')
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            raise DatasetNotFound()
+        return self._filter_snapshot_names(
+            sorted('{}@{}'.format(dataset_name, name) for name in names),
+            typ)
+
+
+class HardlinkDataset(Dataset):
+    def get_dataset_path(self):
+        return os.path.join(self.backend.root, self.name)
+
+    def ensure_exists(self):
+        os.makedirs(self.get_data_path(), 0o700, exist_ok=True)
+        os.makedirs(self._get_snapshots_path(), 0o700, exist_ok=True)
+
+    def get_data_path(self):
+        return os.path.join(self.get_dataset_path(), 'data')
+
+    def _get_snapshots_path(self):
+        return os.path.join(self.get_dataset_path(), '.snapshot')
+
+    def get_snapshot_path(self, snapname):
+        return os.path.join(self._get_snapshots_path(), snapname, 'data')
+
+    def get_metadata_path(self):
+        return self.get_dataset_path()
+
+    def snapshot_create(self, snapname):
+        # Link into a temporary name first, so a snapshot that is listed
+        # is always complete.
+        path = os.path.join(self._get_snapshots_path(), snapname)
+        tmp_path = os.path.join(self._get_snapshots_path(), '.new-' + snapname)
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.mkdir(tmp_path, 0o700)
+        check_output((
+            self.backend.config['CP_BINARY'], '-al', self.get_data_path(),
+            os.path.join(tmp_path, 'data')))
+        os.rename(tmp_path, path)
+
+    def snapshot_delete(self, snapname):
+        # Hide it at once; removing a large tree takes a while.
+        path = os.path.join(self._get_snapshots_path(), snapname)
+        tmp_path = os.path.join(self._get_snapshots_path(), '.del-' + snapname)
+        os.rename(path, tmp_path)
+        shutil.rmtree(tmp_path)
+
+    def _get_previous_snapshot(self, snapname):
+        timestamp = snapname.split('-', 1)[-1]
+        previous = [
+            name for name in self.backend.snapshot_list(self.name)
+            if name.split('-', 1)[-1] < timestamp]
+        return max(previous, key=(lambda x: x.split('-', 1)[-1]), default=None)
+
+    def get_used_size(self):
+        return self.backend.du(self.get_dataset_path())[0]
+
+    def get_referenced_size(self, snapname=None):
+        if snapname is None:
+            return self.backend.du(self.get_data_path())[0]
+        return self.backend.du(self.get_snapshot_path(snapname))[0]
+
+    def get_snapshot_accounting(self, snapname):
+        """
+        Return the referenced and written (not in the previous snapshot)
+        sizes. Unlike on ZFS, these take a du walk of the snapshots.
+        """
+        try:
+            ret = {'referenced': self.get_referenced_size(snapname)}
+            previous = self._get_previous_snapshot(snapname)
+            if previous:
+                ret['written'] = self.backend.du(
+                    self.get_snapshot_path(previous),
+                    self.get_snapshot_path(snapname))[1]
+            else:
+                ret['written'] = ret['referenced']
+        except CalledProcessError as e:
+            logger.warning('Cannot get sizes of %s@%s: %s', self, snapname, e)
+            return {}
+        return ret
+
+    def rename_dataset(self, new_dataset_name):
+        os.rename(
+            self.get_dataset_path(),
+            os.path.join(self.backend.root, new_dataset_name))
+        self.name = new_dataset_name
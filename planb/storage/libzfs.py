@@ -0,0 +1,181 @@
+import logging
+import os.path
+
+from .base import Datasets, DatasetNotFound
+from .zfs import ZfsDataset, ZfsStorage
+
+try:
+    import libzfs_core as lzc
+    from libzfs_core import exceptions as lzc_exc
+except ImportError:
+    lzc = lzc_exc = None
+
+logger = logging.getLogger(__name__)
+
+
+class LibZfsStorage(ZfsStorage):
+    """
+    ZfsStorage that talks to /dev/zfs through the pyzfs libzfs_core
+    bindings, instead of doing a sudo+zfs fork/exec for every call.
+
+    The planb user needs read/write access to /dev/zfs and the proper
+    'zfs allow' delegations (snapshot, destroy, rename) on the pool.
+
+    Everything the bindings cannot do (mount/unmount/create need root
+    anyway) or cannot do on this ZFS version (NotImplementedError) is
+    handed to the ZfsStorage command line implementation. If the
+    bindings are not installed at all, this behaves exactly like
+    ZfsStorage.
+
+    Only the zfs commands show up in the storage_command histogram (see
+    planb.metrics), not the libzfs_core calls.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lzc = lzc if self.config['USE_LIBZFS_CORE'] else None
+        if self.config['USE_LIBZFS_CORE'] and not self.lzc:
+            logger.warning(
+                'libzfs_core bindings not found, %s uses the zfs binary',
+                self.alias)
+
+    @classmethod
+    def ensure_defaults(cls, config):
+        super().ensure_defaults(config)
+        config.setdefault('USE_LIBZFS_CORE', True)
+
+    @staticmethod
+    def _enc(name):
+        return name.encode('utf-8')
+
+    @staticmethod
+    def _dec(name):
+        return name.decode('utf-8') if isinstance(name, bytes) else name
+
+    def _lzc_get_props(self, dataset_name):
+        """
+        Return the properties of dataset_name as a dict of str values.
+        """
+        props = self.lzc.lzc_get_props(self._enc(dataset_name))
+        return dict(
+            (self._dec(key), self._dec(value)) for key, value in props.items())
+
+    def _lzc_walk(self, dataset_name):
+        """
+        Yield all filesystems below dataset_name, depth first.
+        """
+        for child in self.lzc.lzc_list_children(self._enc(dataset_name)):
+            child = self._dec(child)
+            yield child
+            yield from self._lzc_walk(child)
+
+    def get_datasets(self):
+        if not self.lzc:
+            return super().get_datasets()
+
+        datasets = Datasets()
+        try:
+            found = list(self._lzc_walk(self.poolname))
+            # Skip the parents of other datasets (the hostgroups in the
+            # nested layout), as ZfsStorage does.
+            parents = set(os.path.dirname(name) for name in found)
+            for dataset_name in found:
+                if dataset_name in parents:
+                    continue
+                dataset = ZfsDataset(backend=self, name=dataset_name)
+                dataset.set_disk_usage(
+                    int(self._lzc_get_props(dataset_name)['used']))
+                datasets.append(dataset)
+        except NotImplementedError:
+            return super().get_datasets()
+        return datasets
+
+    def zfs_get_property(
+            self, dataset_name, prop, output='value', snapname=None):
+        if not self.lzc or output != 'value':
+            return super().zfs_get_property(
+                dataset_name, prop, output=output, snapname=snapname)
+
+        name = dataset_name
+        if snapname is not None:
+            name = '{}@{}'.format(dataset_name, snapname)
+        try:
+            value = self._lzc_get_props(name)[prop]
+        except (KeyError, NotImplementedError):
+            # Not a native property (or no lzc_get_props on this
+            # version): let the zfs binary work it out.
+            return super().zfs_get_property(
+                dataset_name, prop, output=output, snapname=snapname)
+        except lzc_exc.ZFSError as e:
+            logger.warning('Error while getting %r of %r: %s', prop, name, e)
+            value = '0'
+        return str(value)
+
+    def zfs_get_properties(self, dataset_name, props, snapname=None):
+        if not self.lzc:
+            return super().zfs_get_properties(
+                dataset_name, props, snapname=snapname)
+
+        name = dataset_name
+        if snapname is not None:
+            name = '{}@{}'.format(dataset_name, snapname)
+        try:
+            values = self._lzc_get_props(name)
+        except NotImplementedError:
+            return super().zfs_get_properties(
+                dataset_name, props, snapname=snapname)
+        except lzc_exc.ZFSError as e:
+            logger.warning('Error while getting %r of %r: %s', props, name, e)
+            return {}
+        return dict(
+            (prop, str(values[prop])) for prop in props if prop in values)
+
+    def zfs_rename_dataset(self, old_dataset_name, new_dataset_name):
+        if not self.lzc:
+            return super().zfs_rename_dataset(
+                old_dataset_name, new_dataset_name)
+        try:
+            self.lzc.lzc_rename(
+                self._enc(old_dataset_name), self._enc(new_dataset_name))
+        except NotImplementedError:
+            super().zfs_rename_dataset(old_dataset_name, new_dataset_name)
+
+    def snapshot_create(self, dataset_name, snapname):
+        if not self.lzc:
+            return super().snapshot_create(dataset_name, snapname)
+
+        snapshot_name = '{}@{}'.format(dataset_name, snapname)
+        self.lzc.lzc_snapshot([self._enc(snapshot_name)])
+        return snapshot_name
+
+    def snapshot_delete(self, dataset_name, snapname):
+        self.snapshots_delete(dataset_name, [snapname])
+
+    def snapshots_delete(self, dataset_name, snapnames):
+        if not self.lzc:
+            for snapname in snapnames:
+                super().snapshot_delete(dataset_name, snapname)
+            return
+
+        # One ioctl for the lot.
+        if snapnames:
+            self.lzc.lzc_destroy_snaps([
+                self._enc('{}@{}'.format(dataset_name, snapname))
+                for snapname in snapnames], defer=False)
+
+    def snapshot_list(self, dataset_name, typ=None):
+        if not self.lzc:
+            return super().snapshot_list(dataset_name, typ=typ)
+
+        names = []
+        try:
+            # Like 'zfs list -r', include the snapshots of the children.
+            for name in [dataset_name] + list(self._lzc_walk(dataset_name)):
+                names.extend(
+                    self._dec(i)
+                    for i in self.lzc.lzc_list_snaps(self._enc(name)))
+        except NotImplementedError:
+            return super().snapshot_list(dataset_name, typ=typ)
+        except (lzc_exc.DatasetNotFound, lzc_exc.FilesystemNotFound):
+            raise DatasetNotFound()
+
+        return self._filter_snapshot_names(names, typ)
@@ -0,0 +1,67 @@
+import logging
+
+from .replication import ReplicationError, ZfsReplication
+from .zfs import ZfsStorage
+
+logger = logging.getLogger(__name__)
+
+
+class MigrationError(ReplicationError):
+    pass
+
+
+class ZfsMigration(ZfsReplication):
+    """
+    Move a dataset from one ZfsStorage pool to another with zfs send/recv,
+    while the backups go on.
+
+    First sync() sends all snapshots (a full send of the oldest, then
+    incremental sends) and catches up with the snapshots created in the
+    meantime. Then finish(), to be called with the FilesetLock held so
+    no backup can run, sends the last few snapshots. The data of the
+    dataset is that of its last snapshot after a backup, so the target
+    is complete and the fileset can be switched to it.
+
+    The source dataset is left alone; remove it when satisfied.
+    """
+    def __init__(self, storage, target_storage, max_rounds=5):
+        if not (isinstance(storage, ZfsStorage)
+                and isinstance(target_storage, ZfsStorage)):
+            raise MigrationError(
+                'Cannot migrate from {} to {}: both need ZFS storage'.format(
+                    storage.name, target_storage.name))
+        super().__init__(storage, {
+            'POOLNAME': target_storage.poolname,
+            'COMMAND': (target_storage.sudobin, target_storage.binary)})
+        self.target_storage = target_storage
+        self.max_rounds = max_rounds
+
+    def sync(self, dataset_name, target_name=None):
+        """
+        Send snapshots until the target has caught up (or max_rounds).
+        Returns the number of sent snapshots.
+
+        Pass the target_name from target_storage.get_dataset_name when the
+        pools have a different LAYOUT; the default only swaps the pool.
+        """
+        total = 0
+        for round_ in range(self.max_rounds):
+            sent = self.replicate(dataset_name, target_name=target_name)
+            logger.info(
+                'Migration round %d of %s sent %d snapshots',
+                round_ + 1, dataset_name, len(sent))
+            total += len(sent)
+            if not sent:
+                break
+        return total
+
+    def finish(self, dataset_name, target_name=None):
+        """
+        Send the last snapshots and prepare the target for use. Returns
+        the target dataset name.
+        """
+        target_name = target_name or self.get_target_name(dataset_name)
+        self.sync(dataset_name, target_name)
+        # Like zfs_create: we mount it ourselves when we need it.
+        self._run(self._target(('set', 'canmount=noauto', target_name)))
+        return target_name
@@ -0,0 +1,187 @@
+import logging
+
+from django.core.exceptions import ImproperlyConfigured
+
+from planb.common.subprocess2 import (
+    CalledProcessError, argsjoin, check_output, check_pipe)
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicationError(Exception):
+    pass
+
+
+class ZfsReplication(object):
+    """
+    Replicate ZfsStorage datasets to a secondary pool using incremental
+    zfs send/recv.
+
+    Configured through the REPLICATION key of the storage config::
+
+        'REPLICATION': {
+            'POOLNAME': 'tank2/BACKUP',
+            # Command (prefix) to run zfs on the target pool. Defaults
+            # to the local SUDOBIN+BINARY of the source storage.
+            'COMMAND': ('/usr/bin/ssh', 'planb@backup2', 'sudo', 'zfs'),
+        }
+
+    The receiving side uses "zfs recv -s" so an interrupted transfer
+    leaves a receive_resume_token which is picked up on the next run.
+    """
+    def __init__(self, storage, config):
+        self.storage = storage
+        self.poolname = config['POOLNAME']
+        self.command = tuple(config.get('COMMAND') or (
+            storage.sudobin, storage.binary))
+
+    @classmethod
+    def ensure_defaults(cls, config):
+        if 'POOLNAME' not in config:
+            raise ImproperlyConfigured('Zfs replication requires a POOLNAME')
+
+    def get_target_name(self, dataset_name):
+        assert dataset_name.startswith(self.storage.poolname + '/'), (
+            dataset_name, self.storage.poolname)
+        return '{}/{}'.format(
+            self.poolname, dataset_name[len(self.storage.poolname) + 1:])
+
+    def _source(self, cmd):
+        return (self.storage.sudobin, self.storage.binary) + tuple(cmd)
+
+    def _target(self, cmd):
+        return self.command + tuple(cmd)
+
+    def _run(self, cmd):
+        return check_output(cmd).decode('utf-8')
+
+    def _list_snapshots(self, cmd):
+        """
+        Return our snapshot names, oldest first.
+        """
+        try:
+            out = self._run(cmd)
+        except CalledProcessError as e:
+            if b'dataset does not exist' in e.errput:
+                return []
+            raise
+        return self.storage._filter_snapshot_names(out.split('\n'))
+
+    def _send(self, send_args, target_name):
+        send_cmd = self._source(('send',) + tuple(send_args))
+        recv_cmd = self._target(('recv', '-s', '-u', target_name))
+        logger.info(
+            'Replicating: %s | %s', argsjoin(send_cmd), argsjoin(recv_cmd))
+        check_pipe(send_cmd, recv_cmd)
+
+    def resume(self, target_name):
+        """
+        Finish an interrupted receive, if there is one.
+        """
+        try:
+            token = self._run(self._target((
+                'get', '-Hpo', 'value', 'receive_resume_token',
+                target_name))).strip()
+        except CalledProcessError as e:
+            if b'dataset does not exist' in e.errput:
+                return False
+            raise
+        if token in ('', '-'):
+            return False
+
+        logger.info('Resuming interrupted receive into %s', target_name)
+        self._send(('-t', token), target_name)
+        return True
+
+    def rename(self, old_dataset_name, new_dataset_name):
+        """
+        Mirror the rename of a source dataset (or hostgroup parent) on the
+        target. Otherwise the next replicate would do a full send under
+        the new name, next to the old replica.
+
+        Returns False if nothing was replicated yet.
+        """
+        old_target_name = self.get_target_name(old_dataset_name)
+        new_target_name = self.get_target_name(new_dataset_name)
+        try:
+            self._run(self._target((
+                'rename', '-p', old_target_name, new_target_name)))
+        except CalledProcessError as e:
+            if b'dataset does not exist' in e.errput:
+                return False
+            raise
+        logger.info(
+            'renamed replica: %s to %s', old_target_name, new_target_name)
+        return True
+
+    def get_source_snapshots(self, dataset_name):
+        """
+        Return the snapshot names of dataset_name, oldest first.
+        """
+        return self._list_snapshots(self._source((
+            'list', '-H', '-t', 'snapshot', '-o', 'name', '-s', 'createtxg',
+            '-d', '1', dataset_name)))
+
+    def replicate(self, dataset_name, source_snapshots=None, target_name=None):
+        """
+        Send all snapshots of dataset_name that are missing on the target
+        and remove the target snapshots that were rotated away.
+
+        Pass source_snapshots (see get_source_snapshots) to choose the
+        snapshots while holding the FilesetLock, and send them without.
+        The target_name defaults to get_target_name(dataset_name).
+
+        Returns the list of sent snapshot names.
+        """
+        target_name = target_name or self.get_target_name(dataset_name)
+        self.resume(target_name)
+
+        if source_snapshots is None:
+            source_snapshots = self.get_source_snapshots(dataset_name)
+        target_snapshots = self._list_snapshots(self._target((
+            'list', '-H', '-t', 'snapshot', '-o', 'name', '-s', 'createtxg',
+            '-d', '1', target_name)))
+        if not source_snapshots:
+            return []
+
+        common = [i for i in source_snapshots if i in set(target_snapshots)]
+        sent = []
+        if common:
+            previous = common[-1]
+        elif target_snapshots:
+            # The target has history we cannot build on. Don't touch it.
+            raise ReplicationError(
+                'No common snapshot between {} and {}; replication lagged '
+                'beyond the retention?'.format(dataset_name, target_name))
+        else:
+            # Initial full send of the oldest snapshot.
+            parent = target_name.rsplit('/', 1)[0]
+            self._run(self._target(('create', '-p', parent)))
+            previous = source_snapshots[0]
+            self._send(
+                ('{}@{}'.format(dataset_name, previous),), target_name)
+            sent.append(previous)
+
+        for snapname in source_snapshots[
+                source_snapshots.index(previous) + 1:]:
+            self._send((
+                '-i', '@{}'.format(previous),
+                '{}@{}'.format(dataset_name, snapname)), target_name)
+            sent.append(snapname)
+            previous = snapname
+
+        self.rotate(target_name, source_snapshots, target_snapshots)
+        return sent
+
+    def rotate(self, target_name, source_snapshots, target_snapshots):
+        """
+        Mirror the snapshots_rotate of the source: destroy all target
+        snapshots that no longer exist on the source.
+        """
+        expired = [i for i in target_snapshots if i not in source_snapshots]
+        if expired:
+            self._run(self._target((
+                'destroy', '{}@{}'.format(target_name, ','.join(expired)))))
+            logger.info(
+                'destroyed replicas: %s@%s', target_name, ','.join(expired))
+        return expired
@@ -1,14 +1,20 @@
+from datetime import datetime, timezone
 import os
 from tempfile import TemporaryDirectory
 
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase, override_settings
 
-from mock import patch
+from mock import Mock, patch
 
 from planb.common.subprocess2 import CalledProcessError
 from planb.storage import load_pools
+from planb.storage.base import DatasetNotFound
 from planb.storage.dummy import DummyStorage
+from planb.storage.hardlink import HardlinkStorage
+from planb.storage.libzfs import LibZfsStorage
+from planb.storage.migration import MigrationError, ZfsMigration
+from planb.storage.replication import ReplicationError
 from planb.storage.zfs import ZfsStorage
 
 
@@ -34,6 +40,105 @@ class PlanbStorageTestCase(TestCase):
         self.assertEqual(len(datasets), 1)
         self.assertEqual(datasets[0].name, 'new_name')
 
+        storage.snapshot_create('new_name', 'daily-201901010000')
+        self.assertEqual(storage.get_snapshots(), [
+            ('new_name', 'daily-201901010000', None, None, None)])
+
+    def test_hardlink_storage(self):
+        with self.assertRaises(ImproperlyConfigured):
+            HardlinkStorage.ensure_defaults({})
+
+        tmpdir = TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        config = {'NAME': 'Hardlink Storage', 'ROOT': tmpdir.name}
+        HardlinkStorage.ensure_defaults(config)
+        storage = HardlinkStorage(config, alias='plain')
+
+        dataset = storage.get_dataset('my_dataset')
+        with self.assertRaises(DatasetNotFound):
+            storage.snapshot_list('my_dataset')
+        dataset.ensure_exists()
+        self.assertEqual(storage.snapshot_list('my_dataset'), [])
+
+        data = dataset.get_data_path()
+        with open(os.path.join(data, 'same'), 'wb') as fp:
+            fp.write(b'x' * 100000)
+        with open(os.path.join(data, 'changed'), 'wb') as fp:
+            fp.write(b'1' * 50000)
+        storage.snapshot_create('my_dataset', 'daily-201901010000')
+
+        # Like rsync: write a new file and rename it over the old one.
+        with open(os.path.join(data, '.changed.tmp'), 'wb') as fp:
+            fp.write(b'2' * 50000)
+        os.rename(
+            os.path.join(data, '.changed.tmp'), os.path.join(data, 'changed'))
+        storage.snapshot_create('my_dataset', 'daily-201901020000')
+        storage.snapshot_create('my_dataset', 'weekly-201901020000')
+
+        self.assertEqual(storage.snapshot_list('my_dataset'), [
+            'daily-201901010000', 'daily-201901020000',
+            'weekly-201901020000'])
+        self.assertEqual(
+            storage.snapshot_list('my_dataset', 'weekly'),
+            ['weekly-201901020000'])
+        old = dataset.get_snapshot_path('daily-201901010000')
+        new = dataset.get_snapshot_path('daily-201901020000')
+        self.assertEqual(
+            os.stat(os.path.join(old, 'same')).st_ino,
+            os.stat(os.path.join(new, 'same')).st_ino)
+        with open(os.path.join(old, 'changed'), 'rb') as fp:
+            self.assertEqual(fp.read(1), b'1')
+
+        # The shared inodes are counted once.
+        referenced = dataset.get_referenced_size()
+        self.assertGreaterEqual(referenced, 150000)
+        self.assertLess(dataset.get_used_size(), referenced + 100000)
+        accounting = dataset.get_snapshot_accounting('daily-201901020000')
+        self.assertEqual(accounting['referenced'], referenced)
+        self.assertLess(accounting['written'], 100000)
+        self.assertEqual(
+            dataset.get_snapshot_accounting('daily-201901010000'),
+            {'referenced': referenced, 'written': referenced})
+
+        datasets = storage.get_datasets()
+        self.assertEqual([i.name for i in datasets], ['my_dataset'])
+
+        class FakeDatetime(datetime):
+            @classmethod
+            def now(cls):
+                return datetime(2019, 1, 3, 12, 0)
+
+        with patch('planb.storage.base.datetime', FakeDatetime):
+            self.assertEqual(storage.snapshots_rotate(
+                'my_dataset', daily_retention=1, weekly_retention=1),
+                ['daily-201901010000'])
+        self.assertFalse(os.path.exists(old))
+
+        dataset.rename_dataset('new_name')
+        self.assertEqual(
+            storage.snapshot_list('new_name'),
+            ['daily-201901020000', 'weekly-201901020000'])
+
+    def test_command_histogram(self):
+        config = {
+            'NAME': 'Zfs Storage', 'POOLNAME': 'tank', 'SUDOBIN': 'sudo'}
+        ZfsStorage.ensure_defaults(config)
+        storage = ZfsStorage(config, alias='zfs')
+
+        # Redis trouble does not fail the command, nor hide its error.
+        with patch('planb.storage.base.histogram.observe',
+                   side_effect=ConnectionError('redis')) as observe, \
+                patch('planb.storage.base.check_output') as m:
+            m.return_value = b'tank\n'
+            self.assertEqual(
+                storage._perform_binary_command(('list',)), 'tank\n')
+            m.side_effect = CalledProcessError(1, 'cmd', b'', b'no')
+            with self.assertRaises(CalledProcessError):
+                storage._perform_binary_command(('list',))
+        self.assertEqual(observe.call_count, 2)
+        self.assertEqual(
+            observe.call_args[0][:2], ('storage_command', ('zfs', 'list')))
+
     def test_zfs_storage(self):
         config = {
             'NAME': 'Zfs Storage', 'POOLNAME': 'tank', 'SUDOBIN': '/bin/echo'}
@@ -106,3 +211,311 @@ class PlanbStorageTestCase(TestCase):
             self.assertEqual(datasets[0].name, 'tank/new_name')
             self.assertEqual(datasets[0].disk_usage, 101)
             m.assert_any_call(('list', '-Hpo', 'name,used'))
+
+    def test_libzfs_storage(self):
+        config = {
+            'NAME': 'Zfs Storage', 'POOLNAME': 'tank', 'SUDOBIN': '/bin/echo'}
+        LibZfsStorage.ensure_defaults(config)
+
+        lzc = Mock()
+        lzc.lzc_list_children.side_effect = (
+            lambda name: {
+                b'tank': [b'tank/a', b'tank/group'],
+                b'tank/group': [b'tank/group/b']}.get(name, []))
+        lzc.lzc_list_snaps.return_value = [
+            b'tank/a@daily-201901010000', b'tank/a@other']
+        lzc.lzc_get_props.return_value = {b'used': 101}
+
+        with patch('planb.storage.libzfs.lzc', lzc):
+            storage = LibZfsStorage(config, alias='zfs')
+        with patch.object(storage, '_perform_binary_command') as m:
+            datasets = storage.get_datasets()
+            # Without the (nested layout) hostgroup parent.
+            self.assertEqual(
+                [i.name for i in datasets], ['tank/a', 'tank/group/b'])
+            self.assertEqual(datasets[0].disk_usage, 101)
+
+            self.assertEqual(
+                storage.snapshot_list('tank/a'), ['daily-201901010000'])
+            storage.snapshot_create('tank/a', 'daily-201901020000')
+            lzc.lzc_snapshot.assert_called_with(
+                [b'tank/a@daily-201901020000'])
+            storage.snapshots_delete('tank/a', ['daily-1', 'daily-2'])
+            lzc.lzc_destroy_snaps.assert_called_with(
+                [b'tank/a@daily-1', b'tank/a@daily-2'], defer=False)
+            storage.zfs_rename_dataset('tank/a', 'tank/b')
+            lzc.lzc_rename.assert_called_with(b'tank/a', b'tank/b')
+
+            # None of the above needed the zfs binary.
+            m.assert_not_called()
+
+            # Unsupported calls fall back to the binary.
+            lzc.lzc_list_snaps.side_effect = NotImplementedError
+            m.return_value = 'tank/a@daily-201901010000'
+            self.assertEqual(
+                storage.snapshot_list('tank/a'), ['daily-201901010000'])
+            m.assert_called_with((
+                'list', '-r', '-H', '-t', 'snapshot', '-o', 'name', 'tank/a'))
+
+        # Without bindings, it is a plain ZfsStorage.
+        with patch('planb.storage.libzfs.lzc', None):
+            storage = LibZfsStorage(config, alias='zfs')
+        with patch.object(storage, '_perform_binary_command') as m:
+            storage.snapshot_create('tank/a', 'daily-201901020000')
+            m.assert_called_with(('snapshot', 'tank/a@daily-201901020000'))
+
+    def test_zfs_nested_layout(self):
+        config = {
+            'NAME': 'Zfs Storage', 'POOLNAME': 'tank', 'SUDOBIN': '/bin/echo',
+            'LAYOUT': 'nested'}
+        ZfsStorage.ensure_defaults(config)
+        storage = ZfsStorage(config, alias='zfs')
+        self.assertEqual(
+            storage.get_dataset_name('group', 'host'), 'tank/group/host')
+        self.assertEqual(
+            storage.get_namespace_dataset_name('group'), 'tank/group')
+        with self.assertRaises(ImproperlyConfigured):
+            ZfsStorage.ensure_defaults(dict(config, LAYOUT='deep'))
+
+        with patch.object(storage, '_perform_binary_command') as m:
+            # The hostgroup parents are not listed as datasets.
+            m.return_value = (
+                'tank\t303\ntank/group\t202\ntank/group/host\t101\n'
+                'tank/old-flat\t101\n')
+            self.assertEqual(
+                [i.name for i in storage.get_datasets()],
+                ['tank/group/host', 'tank/old-flat'])
+
+            m.reset_mock()
+            m.return_value = 'used\t202\n'
+            self.assertEqual(storage.get_namespace_usage('group'), 202)
+            m.assert_called_once_with(
+                ('get', '-o', 'property,value', '-Hp', 'used', 'tank/group'))
+
+            m.reset_mock()
+            self.assertTrue(storage.set_namespace_quota('group', 1 << 30))
+            m.assert_called_once_with(
+                ('set', 'quota=1073741824', 'tank/group'))
+            storage.set_namespace_quota('group', None)
+            m.assert_called_with(('set', 'quota=none', 'tank/group'))
+
+            m.reset_mock()
+            storage.rename_namespace('group', 'new-group')
+            m.assert_called_once_with(
+                ('rename', 'tank/group', 'tank/new-group'))
+
+            # Moving a flat dataset in creates the parent.
+            m.reset_mock(return_value=True)
+            m.side_effect = [
+                '/tank/old-flat',  # rename_dataset: get mountpoint
+                'filesystem',  # zfs_create_filesystems: get type tank
+                # zfs_create_filesystems: get type tank/group2
+                CalledProcessError(1, 'cmd', 'stdout', 'does not exist'),
+                '',  # zfs_create_filesystems: create
+                '',  # zfs_create_filesystems: set canmount
+                '',  # rename
+            ]
+            dataset = storage.get_dataset('tank/old-flat')
+            dataset.rename_dataset('tank/group2/flat')
+            m.assert_any_call(('create', 'tank/group2'))
+            m.assert_called_with(
+                ('rename', 'tank/old-flat', 'tank/group2/flat'))
+
+        flat = ZfsStorage(dict(config, LAYOUT='flat'), alias='flat')
+        self.assertEqual(
+            flat.get_dataset_name('group', 'host'), 'tank/group-host')
+        self.assertIsNone(flat.get_namespace_dataset_name('group'))
+        self.assertIsNone(flat.get_namespace_usage('group'))
+        self.assertFalse(flat.set_namespace_quota('group', 1 << 30))
+
+    def test_zfs_replication(self):
+        config = {
+            'NAME': 'Zfs Storage', 'POOLNAME': 'tank', 'SUDOBIN': 'sudo',
+            'BINARY': 'zfs', 'REPLICATION': {
+                'POOLNAME': 'tank2', 'COMMAND': ('ssh', 'b2', 'zfs')}}
+        ZfsStorage.ensure_defaults(config)
+        storage = ZfsStorage(config, alias='zfs')
+        replication = storage.get_replication()
+        self.assertEqual(replication.get_target_name('tank/a'), 'tank2/a')
+
+        def zfs(source, target, destroyed=None):
+            def check_output(cmd):
+                if cmd[-1] == 'tank/a':
+                    return '\n'.join('tank/a@' + i for i in source).encode()
+                if cmd[-2:] == ('receive_resume_token', 'tank2/a'):
+                    return b'-\n'
+                if cmd[-1] == 'tank2/a':
+                    return '\n'.join('tank2/a@' + i for i in target).encode()
+                return b''
+            return check_output
+
+        with patch('planb.storage.replication.check_output') as out, \
+                patch('planb.storage.replication.check_pipe') as pipe:
+            # Initial: full send, followed by incrementals.
+            out.side_effect = zfs(['daily-1', 'daily-2'], [])
+            self.assertEqual(
+                replication.replicate('tank/a'), ['daily-1', 'daily-2'])
+            out.assert_any_call(('ssh', 'b2', 'zfs', 'create', '-p', 'tank2'))
+            pipe.assert_any_call(
+                ('sudo', 'zfs', 'send', 'tank/a@daily-1'),
+                ('ssh', 'b2', 'zfs', 'recv', '-s', '-u', 'tank2/a'))
+            pipe.assert_called_with(
+                ('sudo', 'zfs', 'send', '-i', '@daily-1', 'tank/a@daily-2'),
+                ('ssh', 'b2', 'zfs', 'recv', '-s', '-u', 'tank2/a'))
+
+            # Next run: only the new snapshot is sent and the rotated
+            # snapshots are destroyed on the target too.
+            pipe.reset_mock()
+            out.side_effect = zfs(
+                ['daily-2', 'daily-3'], ['daily-1', 'daily-2'])
+            self.assertEqual(replication.replicate('tank/a'), ['daily-3'])
+            self.assertEqual(pipe.call_count, 1)
+            out.assert_called_with(
+                ('ssh', 'b2', 'zfs', 'destroy', 'tank2/a@daily-1'))
+
+            # Diverged history is not touched.
+            out.side_effect = zfs(['daily-4'], ['daily-2'])
+            with self.assertRaises(ReplicationError):
+                replication.replicate('tank/a')
+
+            # Interrupted receives are resumed first.
+            pipe.reset_mock()
+            out.side_effect = (
+                lambda cmd: b'1-abc\n' if 'receive_resume_token' in cmd
+                else b'')
+            replication.replicate('tank/a')
+            pipe.assert_called_with(
+                ('sudo', 'zfs', 'send', '-t', '1-abc'),
+                ('ssh', 'b2', 'zfs', 'recv', '-s', '-u', 'tank2/a'))
+
+            # Renames are mirrored, if there is a replica.
+            out.side_effect = None
+            self.assertTrue(replication.rename('tank/a', 'tank/g/b'))
+            out.assert_called_with(
+                ('ssh', 'b2', 'zfs', 'rename', '-p', 'tank2/a', 'tank2/g/b'))
+            out.side_effect = CalledProcessError(
+                1, 'cmd', b'', b"cannot open 'tank2/a': dataset does not "
+                b"exist\n")
+            self.assertFalse(replication.rename('tank/a', 'tank/g/b'))
+
+    def test_zfs_migration(self):
+        config = {
+            'NAME': 'Zfs Storage', 'POOLNAME': 'tank', 'SUDOBIN': 'sudo',
+            'BINARY': 'zfs'}
+        ZfsStorage.ensure_defaults(config)
+        storage = ZfsStorage(config, alias='zfs')
+        config2 = dict(config, POOLNAME='tank2/BACKUP')
+        ZfsStorage.ensure_defaults(config2)
+        storage2 = ZfsStorage(config2, alias='zfs2')
+
+        with self.assertRaises(MigrationError):
+            ZfsMigration(storage, DummyStorage({'NAME': 'd'}, alias='d'))
+
+        migration = ZfsMigration(storage, storage2, max_rounds=3)
+        self.assertEqual(
+            migration.get_target_name('tank/a'), 'tank2/BACKUP/a')
+        with patch.object(migration, 'replicate') as replicate, \
+                patch('planb.storage.replication.check_output') as out:
+            # Catch up until nothing is sent, or max_rounds.
+            replicate.side_effect = [['daily-1', 'daily-2'], ['daily-3'], []]
+            self.assertEqual(migration.sync('tank/a'), 3)
+            replicate.side_effect = [['daily-1']] * 4
+            self.assertEqual(migration.sync('tank/a'), 3)
+
+            replicate.side_effect = [[]]
+            self.assertEqual(migration.finish('tank/a'), 'tank2/BACKUP/a')
+            out.assert_called_once_with(
+                ('sudo', 'zfs', 'set', 'canmount=noauto', 'tank2/BACKUP/a'))
+            replicate.assert_called_with(
+                'tank/a', target_name='tank2/BACKUP/a')
+
+            # Into another LAYOUT.
+            replicate.side_effect = [[]]
+            self.assertEqual(
+                migration.finish('tank/g-a', 'tank2/BACKUP/g/a'),
+                'tank2/BACKUP/g/a')
+            replicate.assert_called_with(
+                'tank/g-a', target_name='tank2/BACKUP/g/a')
+
+    def test_zfs_snapshot_accounting(self):
+        config = {'NAME': 'Zfs Storage', 'POOLNAME': 'tank'}
+        ZfsStorage.ensure_defaults(config)
+        storage = ZfsStorage(config, alias='zfs')
+        dataset = storage.get_dataset('tank/a')
+
+        with patch.object(storage, '_perform_binary_command') as m:
+            m.side_effect = [
+                'referenced\t2048\nwritten\t1024\nlogicalreferenced\t-\n',
+                'usedbysnapshots\t512\n',
+            ]
+            self.assertEqual(
+                dataset.get_snapshot_accounting('daily-201901010000'), {
+                    'referenced': 2048, 'written': 1024,
+                    'usedbysnapshots': 512})
+            m.assert_any_call((
+                'get', '-o', 'property,value', '-Hp',
+                'referenced,written,logicalreferenced',
+                'tank/a@daily-201901010000'))
+
+    def test_zfs_get_snapshots(self):
+        config = {'NAME': 'Zfs Storage', 'POOLNAME': 'tank'}
+        ZfsStorage.ensure_defaults(config)
+        storage = ZfsStorage(config, alias='zfs')
+
+        with patch.object(storage, '_perform_binary_command') as m:
+            m.return_value = (
+                'tank/a@daily-201901010000\t1546300800\t512\t2048\n'
+                'tank/a@manual\t1546300800\t0\t2048\n'
+                'tank/b@weekly-201901010000\t1546300860\t0\t1024\n')
+            self.assertEqual(storage.get_snapshots(), [
+                ('tank/a', 'daily-201901010000',
+                 datetime(2019, 1, 1, tzinfo=timezone.utc), 512, 2048),
+                ('tank/b', 'weekly-201901010000',
+                 datetime(2019, 1, 1, 0, 1, tzinfo=timezone.utc), 0, 1024)])
+            m.assert_called_with((
+                'list', '-H', '-p', '-t', 'snapshot',
+                '-o', 'name,creation,used,referenced', '-r', 'tank'))
+
+            m.side_effect = CalledProcessError(
+                1, ('zfs',), b'', b"cannot open 'tank/c': dataset does not "
+                b"exist")
+            with self.assertRaises(DatasetNotFound):
+                storage.get_snapshots('tank/c')
+            m.assert_called_with((
+                'list', '-H', '-p', '-t', 'snapshot',
+                '-o', 'name,creation,used,referenced', '-d', '1', 'tank/c'))
+
+    def test_zfs_snapshot_diff(self):
+        config = {'NAME': 'Zfs Storage', 'POOLNAME': 'tank'}
+        ZfsStorage.ensure_defaults(config)
+        storage = ZfsStorage(config, alias='zfs')
+        dataset = storage.get_dataset('tank/a')
+        dataset._get_mount_path = '/srv/a'
+
+        with patch.object(storage, '_perform_binary_command') as m:
+            m.return_value = (
+                'M\t/\t/srv/a/data\n'
+                'M\tF\t/srv/a/planb-usagetree.json.gz\n'
+                '+\tF\t/srv/a/data/my\\0040file\n'
+                '-\t/\t/srv/a/data/old\n'
+                'R\tF\t/srv/a/data/x\t/srv/a/data/y\n')
+            self.assertEqual(
+                dataset.get_snapshot_diff('daily-1', 'daily-2'), [
+                    ('+', False, '/my file', None),
+                    ('-', True, '/old', None),
+                    ('R', False, '/x', '/y')])
+            m.assert_called_with((
+                'diff', '-FH', 'tank/a@daily-1', 'tank/a@daily-2'))
+
+    def test_zfs_io_latency(self):
+        config = {'NAME': 'Zfs Storage', 'POOLNAME': 'tank/BACKUP'}
+        ZfsStorage.ensure_defaults(config)
+        storage = ZfsStorage(config, alias='zfs')
+
+        with patch.object(storage, '_perform_sudo_command') as m:
+            m.return_value = (
+                'tank\t1000\t2000\t10\t20\t4096\t8192\t1500000\t25000000\t'
+                '1000000\t2000000\t-\t-\t-\t-\t-\t-\n')
+            self.assertEqual(storage.get_io_latency(), 0.025)
+            m.assert_called_with((
+                '/sbin/zpool', 'iostat', '-Hpl', '-y', 'tank', '1', '1'))
@@ -1,11 +1,10 @@
 from contextlib import contextmanager
+from datetime import datetime, timezone
 import logging
 import os.path
 import re
 import time
 
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
 from functools import lru_cache
 
 from django.core.exceptions import ImproperlyConfigured
@@ -13,6 +12,7 @@ from django.core.exceptions import ImproperlyConfigured
 from planb.common.subprocess2 import CalledProcessError
 
 from .base import OldStyleStorage, Datasets, Dataset, DatasetNotFound
+from .replication import ZfsReplication
 
 # Check if we can backup (daily)
 # backup
@@ -31,22 +31,93 @@ from .base import OldStyleStorage, Datasets, Dataset, DatasetNotFound
 logger = logging.getLogger(__name__)
 
 
+def zfs_unescape(path):
+    """
+    Undo the escaping of zfs diff: it writes spaces, backslashes and all
+    non-printable bytes as a backslash and four octal digits.
+    """
+    if '\\' not in path:
+        return path
+    value = re.sub(
+        rb'\\([0-7]{4})', (lambda m: bytes([int(m.group(1), 8)])),
+        path.encode('utf-8'))
+    return value.decode('utf-8', 'surrogateescape')
+
+
 class ZfsStorage(OldStyleStorage):
+    """
+    Datasets below POOLNAME on ZFS.
+
+    With LAYOUT 'flat' (the default) datasets are named
+    POOLNAME/<hostgroup>-<friendly_name>. With LAYOUT 'nested' they are
+    POOLNAME/<hostgroup>/<friendly_name>, so a hostgroup rename is a
+    single zfs rename, and properties (quota, compression) and sizes can
+    be set and read per hostgroup. The bnestdatasets command moves the
+    existing datasets into the nested layout.
+    """
+    LAYOUTS = ('flat', 'nested')
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.poolname = self.config['POOLNAME']
         # Create LRU cache for this instance of Zfs.
         self.zfs_get_property = lru_cache(maxsize=32)(self.zfs_get_property)
+        self._replication = None
+        if self.config.get('REPLICATION'):
+            self._replication = ZfsReplication(
+                self, self.config['REPLICATION'])
 
     @classmethod
     def ensure_defaults(cls, config):
         super().ensure_defaults(config)
         if 'POOLNAME' not in config:
             raise ImproperlyConfigured('Zfs storage requires a POOLNAME')
+        if config.get('REPLICATION'):
+            ZfsReplication.ensure_defaults(config['REPLICATION'])
+        config.setdefault('LAYOUT', 'flat')
+        if config['LAYOUT'] not in cls.LAYOUTS:
+            raise ImproperlyConfigured(
+                'Zfs storage LAYOUT must be one of {}'.format(cls.LAYOUTS))
+        config.setdefault('ZPOOL_BINARY', os.path.join(
+            os.path.dirname(config['BINARY']), 'zpool'))
+
+    def get_replication(self):
+        return self._replication
+
+    def get_io_latency(self):
+        """
+        Sample 'zpool iostat -l' for a second and return the highest of
+        the read/write total_wait, in seconds.
+        """
+        zpool = self.poolname.split('/', 1)[0]
+        cmd = (
+            self.config['ZPOOL_BINARY'], 'iostat', '-Hpl', '-y', zpool, '1',
+            '1')
+        try:
+            out = self._perform_sudo_command(cmd)
+        except CalledProcessError as e:
+            logger.warning('Cannot get IO latency of %s: %s', zpool, e)
+            return None
+
+        # name, alloc, free, ops r/w, bandwidth r/w, total_wait r/w, ...
+        fields = out.split('\n', 1)[0].split('\t')
+        waits = [int(i) for i in fields[7:9] if i.isdigit()]
+        if not waits:
+            return None
+        return max(waits) / 1e9  # nanoseconds
+
+    def get_space(self):
+        try:
+            used = int(self.zfs_get_property(self.poolname, 'used'))
+            available = int(self.zfs_get_property(self.poolname, 'available'))
+        except ValueError:
+            return None
+        if not (used or available):
+            return None  # failed to get them
+        return used, available
 
     def get_label(self):
-        used = int(self.zfs_get_property(self.poolname, 'used'))
-        available = int(self.zfs_get_property(self.poolname, 'available'))
+        used, available = self.get_space() or (0, 0)
 
         if used and available:
             pct = '{pct:.0f}%'.format(pct=(100 * (used / (used + available))))
@@ -59,11 +130,18 @@ class ZfsStorage(OldStyleStorage):
     def get_datasets(self):
         output = self._perform_binary_command(('list', '-Hpo', 'name,used'))
 
-        datasets = Datasets()
+        found = []
         for line in output.rstrip().split('\n'):
             dataset_name, used = line.split('\t')
-
             if dataset_name.startswith(self.poolname + '/'):
+                found.append((dataset_name, used))
+
+        # Skip the parents of other datasets (the hostgroups in the nested
+        # layout); they hold no data of their own.
+        parents = set(os.path.dirname(name) for name, used in found)
+        datasets = Datasets()
+        for dataset_name, used in found:
+            if dataset_name not in parents:
                 dataset = ZfsDataset(backend=self, name=dataset_name)
                 dataset.set_disk_usage(int(used))
                 datasets.append(dataset)
@@ -74,8 +152,43 @@ class ZfsStorage(OldStyleStorage):
         return ZfsDataset(backend=self, name=dataset_name)
 
     def get_dataset_name(self, namespace, name):
+        if self.config['LAYOUT'] == 'nested':
+            return '{}/{}/{}'.format(self.poolname, namespace, name)
         return '{}/{}-{}'.format(self.poolname, namespace, name)
 
+    def get_namespace_dataset_name(self, namespace):
+        if self.config['LAYOUT'] == 'nested':
+            return '{}/{}'.format(self.poolname, namespace)
+        return None
+
+    def get_namespace_usage(self, namespace):
+        dataset_name = self.get_namespace_dataset_name(namespace)
+        if dataset_name is None:
+            return None
+        # The used of the parent includes that of all its children. Not
+        # the cached zfs_get_property: this is checked before every run.
+        used = self.zfs_get_properties(dataset_name, ('used',)).get('used')
+        return int(used) if used and used.isdigit() else None
+
+    def set_namespace_quota(self, namespace, quota):
+        dataset_name = self.get_namespace_dataset_name(namespace)
+        if dataset_name is None:
+            return False
+        # The quota includes the snapshots of all children; a refquota
+        # on the parent would only limit its own (empty) data.
+        self._perform_binary_command((
+            'set', 'quota={}'.format('none' if quota is None else quota),
+            dataset_name))
+        return True
+
+    def rename_namespace(self, old_namespace, new_namespace):
+        old_dataset_name = self.get_namespace_dataset_name(old_namespace)
+        new_dataset_name = self.get_namespace_dataset_name(new_namespace)
+        if old_dataset_name is None:
+            raise ValueError(
+                'Storage {} has no namespace datasets'.format(self.name))
+        self.zfs_rename_dataset(old_dataset_name, new_dataset_name)
+
     def zfs_get_local_path(self, dataset_name):
         cmd = ('get', '-Ho', 'value', 'mountpoint', dataset_name)
         try:
@@ -103,6 +216,28 @@ class ZfsStorage(OldStyleStorage):
 
         return size
 
+    def zfs_get_properties(self, dataset_name, props, snapname=None):
+        """
+        Get multiple properties in a single call, as dict of strings.
+        """
+        if snapname is not None:
+            dataset_name = '{}@{}'.format(dataset_name, snapname)
+        cmd = (
+            'get', '-o', 'property,value', '-Hp', ','.join(props),
+            dataset_name)
+        try:
+            out = self._perform_binary_command(cmd)
+        except CalledProcessError as e:
+            msg = 'Error while calling: %r, %s' % (cmd, e.output.strip())
+            logger.warning(msg)
+            return {}
+
+        ret = {}
+        for line in out.splitlines():
+            prop, value = line.split('\t', 1)
+            ret[prop] = value
+        return ret
+
     def zfs_get_used_size(self, dataset_name):
         return int(self.zfs_get_property(dataset_name, 'used'))
 
@@ -110,8 +245,11 @@ class ZfsStorage(OldStyleStorage):
         return int(self.zfs_get_property(
             dataset_name, 'referenced', snapname=snapname))
 
-    def zfs_create(self, dataset_name):
-        # For multi-slash paths, we may need to create parents as well.
+    def zfs_create_filesystems(self, dataset_name):
+        """
+        Create the (unmounted) dataset and its parents where they do not
+        exist yet.
+        """
         parts = dataset_name.split('/')
         for idx, last_part in enumerate(parts):
             part = '/'.join(parts[0:(idx + 1)])
@@ -125,6 +263,10 @@ class ZfsStorage(OldStyleStorage):
             else:
                 assert type_ == 'filesystem', (dataset_name, part, type_)
 
+    def zfs_create(self, dataset_name):
+        # For multi-slash paths, we may need to create parents as well.
+        self.zfs_create_filesystems(dataset_name)
+
         # After mount, make it ours. Blegh. Unfortunate side-effect of
         # using sudo for the ZFS create.
         try:
@@ -153,6 +295,30 @@ class ZfsStorage(OldStyleStorage):
         self._perform_binary_command(
             ('rename', old_dataset_name, new_dataset_name))
 
+    def zfs_diff(self, dataset_name, old_snapname, new_snapname):
+        """
+        Return the 'zfs diff -FH' between two snapshots as a list of
+        (change, filetype, path, new_path) tuples, with the absolute
+        (unescaped) paths of the mounted dataset.
+        """
+        cmd = (
+            'diff', '-FH',
+            '{}@{}'.format(dataset_name, old_snapname),
+            '{}@{}'.format(dataset_name, new_snapname))
+        out = self._perform_binary_command(cmd)
+
+        changes = []
+        for line in out.split('\n'):
+            if not line:
+                continue
+            fields = line.split('\t')
+            change, filetype, path = fields[0:3]
+            new_path = fields[3] if len(fields) > 3 else None
+            changes.append((
+                change, filetype, zfs_unescape(path),
+                new_path and zfs_unescape(new_path)))
+        return changes
+
     # (old style)
 
     def snapshot_create(self, dataset_name, snapname):
@@ -181,85 +347,36 @@ class ZfsStorage(OldStyleStorage):
         if not out:
             return []
 
-        snapshots = []
-        if typ:
-            snapshot_rgx = re.compile(r'.*@{}\-\d+'.format(typ))
-        else:
-            snapshot_rgx = re.compile(r'^.*@\w+-\d+$')
-        for snapshot in out.split('\n'):
-            if snapshot_rgx.match(snapshot):
-                # Do not include the dataset in the snapshot name.
-                snapshots.append(snapshot.split('@', 1)[1])
-        return snapshots
+        return self._filter_snapshot_names(out.split('\n'), typ)
 
-    # Note: We use retention + 1 to calculate if we need to
-    # retain the backup, in this situation we won't run into
-    # situations where your data already gets cleaned up just
-    # because it's older than the relative delta.
-    # 1 montly retention:
-    # 1 jan: monthly created
-    # 1 febr: new monthly created
-    # 1 febr: old monthly deleted
-    # situation, you have data from yesterday and no monthly data
-    def snapshot_retain_daily(self, snapname, retention):
-        try:
-            dts = re.match(r'\w+-(\d+)', snapname).groups()[0]
-        except AttributeError:
-            return True  # Keep
-        datetimestamp = datetime.strptime(dts, '%Y%m%d%H%M')
-        return datetimestamp > (
-            datetime.now() - relativedelta(days=retention+1))
-
-    def snapshot_retain_weekly(self, snapname, retention):
-        try:
-            dts = re.match(r'\w+-(\d+)', snapname).groups()[0]
-        except AttributeError:
-            return True  # Keep
-        datetimestamp = datetime.strptime(dts, '%Y%m%d%H%M')
-        snapdate = datetime.date(datetimestamp)
-        today_a_week_ago = datetime.date(
-            datetime.now() - relativedelta(weeks=retention+1))
-        return snapdate >= today_a_week_ago
-
-    def snapshot_retain_monthly(self, snapname, retention):
+    def get_snapshots(self, dataset_name=None):
+        # A single zfs list for the pool (or the dataset only, without
+        # children).
+        cmd = (
+            'list', '-H', '-p', '-t', 'snapshot',
+            '-o', 'name,creation,used,referenced')
+        if dataset_name is None:
+            cmd += ('-r', self.poolname)
+        else:
+            cmd += ('-d', '1', dataset_name)
         try:
-            dts = re.match(r'\w+-(\d+)', snapname).groups()[0]
-        except AttributeError:
-            return True  # Keep
-
-        datetimestamp = datetime.strptime(dts, '%Y%m%d%H%M')
-        snapdate = datetime.date(datetimestamp)
-        today_a_month_ago = datetime.date(
-            datetime.now() - relativedelta(months=retention+1))
-        return snapdate >= today_a_month_ago
+            out = self._perform_binary_command(cmd)
+        except CalledProcessError as e:
+            if b'dataset does not exist' in e.errput:
+                raise DatasetNotFound()
+            raise
 
-    def snapshot_retain_yearly(self, snapname, retention):
-        try:
-            dts = re.match(r'\w+-(\d+)', snapname).groups()[0]
-        except AttributeError:
-            return True  # Keep
-        datetimestamp = datetime.strptime(dts, '%Y%m%d%H%M')
-        snapdate = datetime.date(datetimestamp)
-        today_a_year_ago = datetime.date(
-            datetime.now() - relativedelta(years=retention+1))
-        return snapdate >= today_a_year_ago
-
-    def snapshots_rotate(self, dataset_name, **kwargs):
-        snapshots = self.snapshot_list(dataset_name)
-        destroyed = []
-        logger.info('snapshots rotation for {}'.format(dataset_name))
-        for snapname in snapshots:
-            snaptype, dts = re.match(r'(\w+)-(\d+)', snapname).groups()
-            snapshot_retain_func = getattr(self,
-                                           'snapshot_retain_%s' % snaptype)
-            retention = kwargs.get('%s_retention' % snaptype)
-            if not snapshot_retain_func(snapname, retention):
-                self.snapshot_delete(dataset_name, snapname)
-                destroyed.append(snapname)
-                logger.info(
-                    'destroyed: %s@%s, past retention %s',
-                    dataset_name, snapname, retention)
-        return destroyed
+        snapshots = []
+        for line in out.splitlines():
+            name, creation, used, referenced = line.split('\t')
+            if not self._filter_snapshot_names([name]):
+                continue
+            name, snapname = name.split('@', 1)
+            snapshots.append((
+                name, snapname,
+                datetime.fromtimestamp(int(creation), timezone.utc),
+                int(used), int(referenced)))
+        return snapshots
 
 
 class ZfsDataset(Dataset):
@@ -293,6 +410,12 @@ class ZfsDataset(Dataset):
         except CalledProcessError:
             pass
 
+    def mount(self):
+        try:
+            self.backend.zfs_mount(self.name)
+        except CalledProcessError:
+            pass  # already mounted
+
     @contextmanager
     def workon(self, data_path=None):
         cwd = os.getcwd()
@@ -376,6 +499,27 @@ class ZfsDataset(Dataset):
         return os.path.abspath(os.path.join(
             self.get_data_path(), '../.zfs/snapshot', snapshot, 'data'))
 
+    def get_metadata_path(self):
+        return os.path.dirname(self.get_data_path())
+
+    def get_snapshot_diff(self, old_snapname, new_snapname):
+        data_path = self.get_data_path()
+        changes = []
+        for change, filetype, path, new_path in self.backend.zfs_diff(
+                self.name, old_snapname, new_snapname):
+            # Skip our own metadata and the data dir itself.
+            if not path.startswith(data_path + '/'):
+                continue
+            if new_path is None:
+                pass
+            elif new_path.startswith(data_path + '/'):
+                new_path = new_path[len(data_path):]
+            else:
+                change, new_path = '-', None  # moved out of data
+            changes.append((
+                change, (filetype == '/'), path[len(data_path):], new_path))
+        return changes
+
     def get_used_size(self):
         return self.backend.zfs_get_used_size(self.name)
 
@@ -383,6 +527,18 @@ class ZfsDataset(Dataset):
         return self.backend.zfs_get_referenced_size(
             self.name, snapname)
 
+    def get_snapshot_accounting(self, snapname):
+        ret = {}
+        ret.update(self.backend.zfs_get_properties(
+            self.name, ('referenced', 'written', 'logicalreferenced'),
+            snapname=snapname))
+        ret.update(self.backend.zfs_get_properties(
+            self.name, ('usedbysnapshots',)))
+        # Drop the '-' of unsupported properties.
+        return dict(
+            (key, int(value)) for key, value in ret.items()
+            if value.isdigit())
+
     def rename_dataset(self, new_dataset_name):
         # Cannot rename while working from the dataset directory.
         # zfs rename will force a unmount/remount sequence for the filesystem
@@ -391,6 +547,10 @@ class ZfsDataset(Dataset):
             'Cannot rename dataset {} while working from dataset directory '
             '{}'.format(self.get_mount_path(), os.getcwd()))
 
+        # Moving into the nested layout: the hostgroup parent may be new.
+        parent = os.path.dirname(new_dataset_name)
+        if parent.startswith(self.backend.poolname + '/'):
+            self.backend.zfs_create_filesystems(parent)
         self.backend.zfs_rename_dataset(self.name, new_dataset_name)
         self.name = new_dataset_name
 
@@ -0,0 +1,151 @@
+"""
+Generate a tar archive of a directory tree as a stream of chunks, for
+downloads of snapshot data through the web interface.
+
+Nothing is staged: the headers are built from lstat() and the file
+contents are read in CHUNK_SIZE blocks while the archive is consumed, so
+memory use does not depend on the size of the tree.
+"""
+import logging
+import os
+import stat
+import tarfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+
+# Compression name: (file extension, content type).
+COMPRESSIONS = {
+    '': ('.tar', 'application/x-tar'),
+    'gzip': ('.tar.gz', 'application/gzip'),
+    'zstd': ('.tar.zst', 'application/zstd'),
+}
+
+
+def get_compressor(compression):
+    """
+    Return an object with compress(data) and flush() for the compression
+    (see COMPRESSIONS), or None for none.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression {!r}'.format(compression))
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('Compression zstd needs the zstandard module')
+        return zstandard.ZstdCompressor().compressobj()
+    return None
+
+
+def _make_tarinfo(path, arcname, st):
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode = stat.S_IMODE(st.st_mode)
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.mtime = int(st.st_mtime)
+    if stat.S_ISREG(st.st_mode):
+        tarinfo.size = st.st_size
+    elif stat.S_ISDIR(st.st_mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(path)
+    else:
+        return None  # devices, fifos and sockets are not restored
+    return tarinfo
+
+
+def _iter_file(fp, size):
+    left = size
+    while left:
+        data = fp.read(min(left, CHUNK_SIZE))
+        if not data:
+            # Shrunk since the lstat: keep the archive consistent.
+            logger.warning('File %r is shorter than %d bytes', fp.name, size)
+            data = bytes(min(left, CHUNK_SIZE))
+        left -= len(data)
+        yield data
+    if size % tarfile.BLOCKSIZE:
+        yield bytes(tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+
+
+def _iter_entries(path, arcname):
+    """
+    Yield (path, arcname, stat) for path and everything below it.
+    """
+    todo = [(path, arcname)]
+    while todo:
+        path, arcname = todo.pop()
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            logger.warning('Skipping %r in tar: %s', path, e)
+            continue
+        yield path, arcname, st
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                names = sorted(os.listdir(path), reverse=True)
+            except OSError as e:
+                logger.warning('Cannot list %r for tar: %s', path, e)
+                continue
+            todo.extend(
+                (os.path.join(path, name), arcname + '/' + name)
+                for name in names)
+
+
+def iter_tar(path, arcname):
+    """
+    Yield the tar archive (PAX format) of path and everything below it,
+    stored as arcname.
+    """
+    written = 0
+    for path, arcname, st in _iter_entries(path, arcname):
+        tarinfo = _make_tarinfo(path, arcname, st)
+        if tarinfo is None:
+            continue
+        fp = None
+        if tarinfo.isreg():
+            try:
+                fp = open(path, 'rb')
+            except OSError as e:
+                logger.warning('Skipping %r in tar: %s', path, e)
+                continue
+
+        header = tarinfo.tobuf(
+            tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        written += len(header)
+        yield header
+        if fp:
+            with fp:
+                for data in _iter_file(fp, tarinfo.size):
+                    written += len(data)
+                    yield data
+
+    # Two empty blocks, padded to a full record.
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(written + end) % tarfile.RECORDSIZE
+    yield bytes(end)
+
+
+def iter_compressed(chunks, compression):
+    """
+    Yield the chunks compressed with compression (see COMPRESSIONS).
+    """
+    compressor = get_compressor(compression)
+    if compressor is None:
+        yield from chunks
+        return
+
+    for data in chunks:
+        data = compressor.compress(data)
+        if data:
+            yield data
+    yield compressor.flush()
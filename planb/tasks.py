@@ -1,5 +1,6 @@
+from contextlib import ExitStack
+import json
 import logging
-import re
 import time
 
 from dutree import Scanner
@@ -7,14 +8,28 @@ from dutree import Scanner
 from django.conf import settings
 from django.core.mail import mail_admins
 from django.db import connection
-from django.db.models import Q
+from django.db.models import F, Q
 from django.utils import timezone
 
 from django_q.brokers import get_broker
+from django_q.brokers.redis_broker import Redis
 from django_q.tasks import async_task
 from yaml import safe_dump, safe_load
 
+from .anomaly import get_run_anomalies
+from .catalog import update_catalog
+from .common import human
 from .models import BOGODATE, BackupRun, Fileset, FilesetLock
+from .quota import check_quota
+from .rollup import compact_runs as compact_all_runs
+from .snapshots import (
+    reconcile_snapshots as reconcile_all_snapshots, sync_fileset_snapshots)
+from .status import update_status
+from .storage import pools
+from .storage.migration import ZfsMigration
+from .transport_rsync.models import Config as RsyncConfig
+from .transport_rsync.restore import RsyncRestore
+from .usagetree import ParallelScanner, get_incremental_usage
 
 try:
     from setproctitle import getproctitle, setproctitle
@@ -24,7 +39,7 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
-_yaml_safe_re = re.compile(r'^[a-z/_.][a-z0-9*/_.-]*$')
+MIGRATIONS_KEY = 'planb:migrations'
 
 '''
 Backups are run asynchronous with entry points:
@@ -39,33 +54,38 @@ conditional_run:
 
 unconditional_run:
  - Mount the dataset if needed.
+ - Refuse to start if the run would exceed the hostgroup quota.
  - Run the transport to transfer the backup.
+ - Rotate and create the snapshots, and sync the Snapshot rows.
  - Store administrative data on the FileSet and BackupRun.
- - Start the task dutree_run if needed.
+ - Queue a dutree_next task if a snapshot size listing is needed.
+ - Queue a catalog_run task if PLANB_SNAPSHOT_CATALOG is set.
+ - Start the task replicate_run if the storage has replication.
  - Email backup status to admins.
  - finalize_run is invoked as a hook after unconditional_run completes.
 
 finalize_run:
  - sends the planb.signals.backup_done signal.
-'''
 
+migrate_run:
+ - Move the dataset to another storage pool, see async_migrate_job.
+
+migrate_next:
+ - Run the migrate_run of the first pending move of a rebalance plan of
+   which the storage pools are not busy with another one, see
+   async_rebalance_jobs.
 
-def yaml_safe_str(value):
-    if _yaml_safe_re.match(value):
-        return value
-    return '"{}"'.format(
-        value.replace('\\', '\\\\').replace('"', '\\"'))
+rename_namespace_run:
+ - Rename the hostgroup parent dataset of all its filesets on a storage
+   with the nested layout, see async_rename_hostgroup_job.
 
+restore_run:
+ - Push (a part of) a snapshot back to the host, see async_restore_job.
 
-def yaml_digits(value):
-    # Not really yaml, but we'll make them both readable and precise.
-    # 1234567 => 1,234,567
-    value = str(value)
-    assert '.' not in value
-    off = len(value) % 3
-    return ','.join(
-        value[max(0, i + off - 3):(i + off)]
-        for i in range(0, len(value) + 1, 3)).lstrip(',')
+dutree_next:
+ - Run the dutree_run of the pending listing that is most overdue, on a
+   storage pool that is not too busy.
+'''
 
 
 # Sync called task; spawns async.
@@ -91,6 +111,68 @@ def async_rename_job(fileset, new_namespace, new_name):
         new_dataset_name, broker=get_broker(settings.Q_MAIN_QUEUE))
 
 
+# Sync called task; spawns async.
+def async_rename_hostgroup_job(hostgroup, old_name):
+    """
+    Spawn tasks to rename the filesets of the renamed hostgroup: a single
+    task for its filesets on each storage with a nested layout, and one
+    per fileset for the others.
+    """
+    nested = set()
+    for fileset in hostgroup.filesets.iterator():
+        storage = fileset.storage
+        if (storage.get_namespace_dataset_name(old_name) is not None
+                and fileset.dataset_name == storage.get_dataset_name(
+                    old_name, fileset.friendly_name)):
+            nested.add(fileset.storage_alias)
+        else:
+            async_rename_job(fileset, hostgroup.name, fileset.friendly_name)
+
+    for storage_alias in sorted(nested):
+        async_task(
+            'planb.tasks.rename_namespace_run', storage_alias, old_name,
+            hostgroup.name, broker=get_broker(settings.Q_MAIN_QUEUE))
+
+
+# Sync called task; spawns async.
+def async_migrate_job(fileset, storage_alias):
+    """
+    Spawn a task to move the fileset dataset to the storage_alias pool.
+    """
+    # Hours of zfs send/recv: not on the backup workers.
+    return async_task(
+        'planb.tasks.migrate_run', fileset.pk, fileset.storage_alias,
+        fileset.dataset_name, storage_alias,
+        broker=get_broker(settings.Q_REPLICATION_QUEUE))
+
+
+# Sync called task; spawns async.
+def async_rebalance_jobs(moves):
+    """
+    Queue the (fileset, storage_alias) moves of a rebalance plan. They are
+    run one after another by migrate_next tasks, at most one at a time
+    per storage pool.
+    """
+    if moves:
+        Redis.get_connection().rpush(MIGRATIONS_KEY, *[
+            json.dumps([
+                fileset.pk, fileset.storage_alias, fileset.dataset_name,
+                storage_alias])
+            for fileset, storage_alias in moves])
+    MigrationExecutor().spawn()
+
+
+# Sync called task; spawns async.
+def async_restore_job(fileset, snapshot, subpath, **kwargs):
+    """
+    Spawn a task to push the subpath of the snapshot back to the host of
+    the (rsync) transport. See restore_run for the kwargs.
+    """
+    return async_task(
+        'planb.tasks.restore_run', fileset.pk, snapshot, subpath,
+        broker=get_broker(settings.Q_RESTORE_QUEUE), **kwargs)
+
+
 # Sync called task; spawns async.
 def spawn_backup_jobs():
     """
@@ -99,6 +181,24 @@ def spawn_backup_jobs():
     JobSpawner().spawn_eligible()
 
 
+# Sync called task (schedule daily).
+def compact_runs():
+    """
+    Compact the BackupRuns beyond the last PLANB_BACKUPRUN_KEEP of every
+    fileset into daily rollups.
+    """
+    compact_all_runs()
+
+
+# Sync called task (schedule daily).
+def reconcile_snapshots():
+    """
+    Sync the Snapshot rows of all filesets with the snapshots on the
+    storage pools.
+    """
+    reconcile_all_snapshots()
+
+
 # Async called task:
 def conditional_run(fileset_id):
     with FilesetRunner(fileset_id) as runner:
@@ -123,12 +223,124 @@ def dutree_run(fileset_id, run_id):
         runner.dutree_run(run_id)
 
 
+# Async called task:
+def dutree_next():
+    DutreeExecutor().run_next()
+
+
+# Async called task:
+def catalog_run(fileset_id, run_id):
+    with FilesetRunner(fileset_id) as runner:
+        runner.catalog_run(run_id)
+
+
+# Async called task:
+def replicate_run(fileset_id):
+    # Takes the FilesetLock only to choose the snapshots to send.
+    FilesetRunner(fileset_id).replicate_run()
+
+
+# Async called task:
+def migrate_run(fileset_id, old_storage_alias, dataset_name, storage_alias):
+    # Takes the FilesetLock only for the final switch.
+    FilesetRunner(fileset_id).migrate_run(
+        old_storage_alias, dataset_name, storage_alias)
+
+
+# Async called task:
+def migrate_next():
+    MigrationExecutor().run_next()
+
+
+# Async called task:
+def restore_run(
+        fileset_id, snapshot, subpath, dest=None, shards=1, bwlimit=None):
+    # No FilesetLock: backups may go on while we read from the snapshot.
+    fileset = Fileset.objects.get(pk=fileset_id)
+    transport = fileset.get_transport()
+    if not isinstance(transport, RsyncConfig):
+        raise ValueError('Cannot restore {} without rsync transport'.format(
+            fileset))
+    restore = RsyncRestore(
+        transport, snapshot, subpath, dest=dest, shards=shards,
+        bwlimit=bwlimit)
+
+    def progress(done, total):
+        if getproctitle:
+            setproctitle('[restoring %d: %s]: %s of %s' % (
+                fileset.pk, fileset.friendly_name, human.bytes(done),
+                human.bytes(total)))
+        logger.info(
+            '[%s] Restored %s of %s', fileset, human.bytes(done),
+            human.bytes(total))
+
+    logger.info('[%s] Starting restore of %s', fileset, restore)
+    oldproctitle = getproctitle() if getproctitle else None
+    try:
+        restore.run(progress=progress, interval=60)
+    except Exception:
+        logger.exception('[%s] Failed restore of %s', fileset, restore)
+        raise
+    finally:
+        if getproctitle:
+            setproctitle(oldproctitle)
+    logger.info('[%s] Completed restore of %s', fileset, restore)
+
+
 # Async called task:
 def rename_run(fileset_id, old_dataset_name, new_dataset_name):
     with FilesetRunner(fileset_id) as runner:
         runner.rename_run(old_dataset_name, new_dataset_name)
 
 
+# Async called task:
+def rename_namespace_run(storage_alias, old_namespace, new_namespace):
+    storage = pools[storage_alias]
+    old_parent = storage.get_namespace_dataset_name(old_namespace)
+    new_parent = storage.get_namespace_dataset_name(new_namespace)
+    fileset_ids = list(
+        Fileset.objects.filter(
+            storage_alias=storage_alias,
+            dataset_name__startswith=(old_parent + '/'))
+        .order_by('pk').values_list('pk', flat=True))
+
+    # The rename remounts all children: no backups may run meanwhile.
+    # Take the locks in order, so two of these cannot deadlock.
+    with ExitStack() as stack:
+        filesets = [
+            stack.enter_context(FilesetLock(fileset_id))
+            for fileset_id in fileset_ids]
+        logger.info(
+            '[%s] Rename from %r to %r for %d filesets',
+            storage_alias, old_parent, new_parent, len(filesets))
+        storage.rename_namespace(old_namespace, new_namespace)
+        for fileset in filesets:
+            Fileset.objects.filter(pk=fileset.pk).update(
+                dataset_name=(
+                    new_parent + fileset.dataset_name[len(old_parent):]))
+        rename_replica(storage, old_parent, new_parent, storage_alias)
+        logger.info('[%s] Rename to %r complete', storage_alias, new_parent)
+
+
+def rename_replica(storage, old_dataset_name, new_dataset_name, label):
+    """
+    Rename the replica on the replication target of storage, if any, after
+    a rename of the source dataset.
+    """
+    replication = storage.get_replication()
+    if not replication:
+        return
+    try:
+        replication.rename(old_dataset_name, new_dataset_name)
+    except Exception:
+        # Loud: the next replicate_run sends it all again under the new
+        # name, next to the old replica.
+        logger.exception(
+            '[%s] Failed rename of the replica of %r to %r; rename it on '
+            'the target before the next replication', label,
+            old_dataset_name, new_dataset_name)
+
+
 # Async called task:
 def finalize_run(task):
     fileset_id = task.args[0]
@@ -182,6 +394,155 @@ class JobSpawner:
             yield fileset
 
 
+class DutreeExecutor:
+    """
+    Run one of the pending snapshot size listings.
+
+    Every backup that needs a listing queues a dutree_next task, so there
+    are as many tasks as pending listings. Each task takes the one whose
+    fileset has the oldest listing and can run right now: at most
+    PLANB_DUTREE_POOL_CONCURRENCY (or DUTREE_CONCURRENCY in the pool
+    config) scans per storage pool, and none while the pool IO latency is
+    above PLANB_DUTREE_MAX_IO_LATENCY. This lets the dutree queue run
+    multiple workers without thrashing a single pool.
+    """
+    pending = 'summary_pending: 0'
+    poll_interval = 30
+    max_wait = 3600
+
+    def run_next(self):
+        deadline = time.time() + self.max_wait
+        while True:
+            runs = self._enum_pending_runs()
+            if not runs:
+                return False
+            for run in runs:
+                if self._try_run(run):
+                    return True
+            if time.time() >= deadline:
+                break
+            time.sleep(self.poll_interval)
+
+        # Still nothing we can do. Requeue, so the pending listings are not
+        # forgotten, and free the worker.
+        logger.info('All pools with pending dutree scans are busy')
+        async_task(
+            'planb.tasks.dutree_next',
+            broker=get_broker(settings.Q_DUTREE_QUEUE))
+        return False
+
+    def _enum_pending_runs(self):
+        return list(
+            BackupRun.objects
+            .filter(success=True, snapshot_size_listing=self.pending)
+            .select_related('fileset')
+            .order_by(
+                F('fileset__snapshot_size_listing_at').asc(nulls_first=True),
+                'started')[0:50])
+
+    def _acquire_pool_slot(self, storage):
+        concurrency = storage.config.get(
+            'DUTREE_CONCURRENCY', settings.PLANB_DUTREE_POOL_CONCURRENCY)
+        for slot in range(concurrency):
+            lock = Redis.get_connection().lock(
+                'dutree:{}:{}'.format(storage.alias, slot),
+                timeout=settings.Q_CLUSTER['timeout'])
+            if lock.acquire(blocking=False):
+                break
+        else:
+            return None
+
+        max_latency = settings.PLANB_DUTREE_MAX_IO_LATENCY
+        if max_latency:
+            latency = storage.get_io_latency()
+            if latency is not None and latency > max_latency:
+                logger.info(
+                    'Postponing dutree on %s: IO latency %.3fs',
+                    storage.alias, latency)
+                lock.release()
+                return None
+        return lock
+
+    def _try_run(self, run):
+        slot = self._acquire_pool_slot(run.fileset.storage)
+        if not slot:
+            return False
+        try:
+            runner = FilesetRunner(run.fileset_id)
+            # Don't wait for a running backup or rename.
+            if not runner._fileset_lock.acquire(blocking=False):
+                return False
+            try:
+                # Another worker may have been faster.
+                if not BackupRun.objects.filter(
+                        pk=run.pk, snapshot_size_listing=self.pending
+                        ).exists():
+                    return False
+                runner.dutree_run(run.pk)
+            finally:
+                runner._fileset_lock.release()
+        finally:
+            slot.release()
+        return True
+
+
+class MigrationExecutor:
+    """
+    Run one of the pending migrations of a rebalance plan (see
+    async_rebalance_jobs).
+
+    Each migrate_next task takes the first pending move of which neither
+    the source nor the target pool has another one running. When it is
+    done, it queues migrate_next tasks for the rest; the ones that find
+    all pools busy return at once, instead of holding a worker while they
+    wait.
+    """
+    def spawn(self):
+        pending = Redis.get_connection().llen(MIGRATIONS_KEY)
+        # Every migration takes two pools.
+        for i in range(min(pending, max(1, len(pools) // 2))):
+            async_task(
+                'planb.tasks.migrate_next',
+                broker=get_broker(settings.Q_REPLICATION_QUEUE))
+
+    def run_next(self):
+        redis = Redis.get_connection()
+        for entry in redis.lrange(MIGRATIONS_KEY, 0, -1):
+            fileset_id, old_storage_alias, dataset_name, storage_alias = (
+                json.loads(entry.decode('utf-8')))
+            slots = self._acquire_pool_slots(old_storage_alias, storage_alias)
+            if not slots:
+                continue
+            taken = 0
+            try:
+                # Another worker may have been faster.
+                taken = redis.lrem(MIGRATIONS_KEY, 1, entry)
+                if taken:
+                    FilesetRunner(fileset_id).migrate_run(
+                        old_storage_alias, dataset_name, storage_alias)
+            finally:
+                for slot in slots:
+                    slot.release()
+                if taken:
+                    self.spawn()
+            if taken:
+                return True
+        return False
+
+    def _acquire_pool_slots(self, *aliases):
+        slots = []
+        for alias in aliases:
+            lock = Redis.get_connection().lock(
+                'migrate:{}'.format(alias),
+                timeout=settings.Q_CLUSTER['timeout'])
+            if not lock.acquire(blocking=False):
+                for slot in slots:
+                    slot.release()
+                return None
+            slots.append(lock)
+        return slots
+
+
 class FilesetRunner:
     def __init__(self, fileset_id):
         self._fileset_id = fileset_id
@@ -196,16 +557,6 @@ class FilesetRunner:
     def __exit__(self, type, value, traceback):
         self._fileset_lock.release()
 
-    def get_average_duration(self):
-        # Take average of last 10 runs.
-        durations = (
-            BackupRun.objects
-            .filter(fileset_id=self._fileset_id, success=True)
-            .order_by('-id').values_list('duration', flat=True))[0:10]
-        if not durations:
-            return 0  # impossible.. we should have backupruns if we call this
-        return sum(durations) // len(durations)
-
     def conditional_run(self):
         if not self._fileset_lock.is_acquired():
             raise ValueError('Cannot use fileset without acquiring lock')
@@ -249,6 +600,7 @@ class FilesetRunner:
 
         # Mark it as running.
         Fileset.objects.filter(pk=fileset.pk).update(is_running=True)
+        update_status(fileset.pk)
         t0 = time.time()
         logger.info('[%s] Starting backup', fileset)
         run = BackupRun.objects.create(fileset_id=fileset.pk)
@@ -256,7 +608,8 @@ class FilesetRunner:
         try:
             # Lock and open dataset for work.
             with dataset.workon():
-                self._unconditional_run_work(fileset, dataset, run, t0)
+                needs_listing = self._unconditional_run_work(
+                    fileset, dataset, run, t0)
 
         except Exception as e:
             if True:  # isinstance(e, DigestableError)
@@ -279,7 +632,8 @@ class FilesetRunner:
             # Cache values on the fileset.
             now = timezone.now()
             Fileset.objects.filter(pk=fileset.pk).update(
-                last_run=now)    # don't overwrite last_ok
+                last_run=now,    # don't overwrite last_ok
+                last_backuprun=run)
             (Fileset.objects.filter(pk=fileset.pk)
              .filter(Q(first_fail=None) | Q(first_fail=BOGODATE))
              .update(first_fail=now))  # overwrite first_fail only if unset
@@ -295,19 +649,37 @@ class FilesetRunner:
             if getproctitle:
                 setproctitle(oldproctitle)
 
-        # And now, spawn the dutree listing when all previous work is done and
-        # finalized.
-        if fileset.do_snapshot_size_listing:
+        # And now, spawn the follow-up tasks when all previous work is done
+        # and finalized.
+        self._spawn_post_run_tasks(fileset, run, needs_listing)
+
+    def _spawn_post_run_tasks(self, fileset, run, needs_listing):
+        # The dutree listing, if not reused from a previous run.
+        if needs_listing:
             async_task(
-                'planb.tasks.dutree_run', fileset.pk, run.pk,
+                'planb.tasks.dutree_next',
                 broker=get_broker(settings.Q_DUTREE_QUEUE))
 
+        # Add the new snapshot to the file catalog.
+        if settings.PLANB_SNAPSHOT_CATALOG:
+            async_task(
+                'planb.tasks.catalog_run', fileset.pk, run.pk,
+                broker=get_broker(settings.Q_DUTREE_QUEUE))
+
+        # Ship the new snapshots to the secondary pool.
+        if fileset.storage.get_replication():
+            async_task(
+                'planb.tasks.replicate_run', fileset.pk,
+                broker=get_broker(settings.Q_REPLICATION_QUEUE))
+
     def _unconditional_run_work(self, fileset, dataset, run, t0):
         # Set title, create log, get transport config.
         setproctitle('[backing up %d: %s]: transporting' % (
             fileset.pk, fileset.friendly_name))
         first_fail = fileset.first_fail
         transport = fileset.get_transport()
+        # Fail fast, not after hours of transport.
+        check_quota(fileset)
         transport.run_transport()
 
         # Update snapshots.
@@ -315,6 +687,7 @@ class FilesetRunner:
             fileset.pk, fileset.friendly_name))
         fileset.snapshot_rotate()
         snapshots = fileset.snapshot_create()
+        sync_fileset_snapshots(fileset)
 
         # Close the DB connection because it may be stale.
         connection.close()
@@ -327,24 +700,39 @@ class FilesetRunner:
         total_size_mb = (total_size + 524288) >> 20  # bytes to MiB
         snapshot_size = dataset.get_referenced_size()
         snapshot_size_mb = (snapshot_size + 524288) >> 20
-        if fileset.do_snapshot_size_listing:
-            snapshot_size_listing = 'summary_pending: 0'
-        else:
-            snapshot_size_listing = 'summary_disabled: 0'
+        # Cheap storage provided sizes (written, usedbysnapshots, ...).
+        snapshot_accounting = dataset.get_snapshot_accounting(snapshots[0])
+        snapshot_size_listing, previous_listing = (
+            self._get_snapshot_size_listing(fileset))
+        needs_listing = (snapshot_size_listing == 'summary_pending: 0')
         # XXX Include transport export in attributes.
         attributes = safe_dump(dict(
             snapshots=snapshots,
+            snapshot_accounting=snapshot_accounting,
             do_snapshot_size_listing=fileset.do_snapshot_size_listing),
             default_flow_style=False)
 
         # Store run info.
+        duration = time.time() - t0
+        average_duration, duration_variance = (
+            fileset.get_duration_estimate(duration))
+        anomalies, trend = get_run_anomalies(
+            fileset, total_size_mb, snapshot_size_mb, duration)
+        if anomalies:
+            logger.warning(
+                '[%s] Unusual run: %s', fileset, ', '.join(anomalies))
         BackupRun.objects.filter(pk=run.pk).update(
             attributes=attributes,
-            duration=(time.time() - t0),
+            duration=duration,
             success=True,
             total_size_mb=total_size_mb,
             snapshot_size_mb=snapshot_size_mb,
+            written_mb=(
+                (snapshot_accounting.get('written', 0) + 524288) >> 20),
+            anomalies=' '.join(anomalies),
             snapshot_size_listing=snapshot_size_listing)
+        if previous_listing:
+            run.set_snapshot_size_listing(previous_listing)
 
         # Cache values on the fileset.
         now = timezone.now()
@@ -352,8 +740,14 @@ class FilesetRunner:
             last_ok=now,                        # success
             last_run=now,                       # now
             first_fail=None,                    # no failure
-            average_duration=self.get_average_duration(),
-            total_size_mb=total_size_mb)       # "disk usage"
+            average_duration=average_duration,
+            duration_variance=duration_variance,
+            total_size_mb=total_size_mb,        # "disk usage"
+            last_backuprun=run,
+            last_successful_backuprun=run,
+            **trend)                            # see planb.anomaly
+        (Fileset.objects.filter(pk=fileset.pk, first_ok=None)
+         .update(first_ok=run.started))  # set first_ok only if unset
 
         # Mail if failed recently.
         if first_fail:  # last job was not okay
@@ -367,6 +761,32 @@ class FilesetRunner:
             mail_admins(
                 'OK: Backup success of {}'.format(fileset), msg)
 
+        return needs_listing
+
+    def _get_snapshot_size_listing(self, fileset):
+        """
+        Return the initial snapshot_size_listing state for a new run, and
+        the (path, size) listing to copy from the previous run, if any.
+        A 'summary_pending' state needs a dutree_run to fill it in.
+
+        If the previous listing is recent enough, it is reused as is.
+        """
+        if not fileset.do_snapshot_size_listing:
+            return 'summary_disabled: 0', None
+
+        if not fileset.snapshot_size_listing_is_stale():
+            previous = (
+                BackupRun.objects
+                .filter(
+                    fileset_id=fileset.pk, success=True,
+                    snapshot_size_listing='',
+                    listing_entries__isnull=False)
+                .order_by('-started', '-id').first())
+            if previous:
+                return '', previous.snapshot_size_listing_as_list()
+
+        return 'summary_pending: 0', None
+
     def dutree_run(self, run_id):
         if not self._fileset_lock.is_acquired():
             raise ValueError('Cannot use fileset without acquiring lock')
@@ -389,20 +809,18 @@ class FilesetRunner:
             with dataset.workon(path):
                 setproctitle('[backing up %d: %s]: dutree' % (
                     fileset.pk, fileset.friendly_name))
-                dutree = Scanner(path).scan(use_apparent_size=False)
+                total, leaves = self._get_snapshot_usage(
+                    dataset, snapshot, path)
 
                 # Get snapshot size and tree.
-                snapshot_size_mb = (
-                    dutree.use_size() + 524288) >> 20  # bytes to MiB
-                snapshot_size_yaml = '\n'.join(
-                    '{}: {}'.format(
-                        yaml_safe_str(i.name()[len(path):]),
-                        yaml_digits(i.use_size()))
-                    for i in dutree.get_leaves())
-                BackupRun.objects.filter(pk=run.pk).update(
-                    snapshot_size_mb=snapshot_size_mb,
-                    snapshot_size_listing=snapshot_size_yaml,
-                )
+                run.set_snapshot_size_listing(leaves)
+                if not attributes.get('snapshot_accounting'):
+                    # No sizes from the storage, use the dutree total.
+                    BackupRun.objects.filter(pk=run.pk).update(
+                        snapshot_size_mb=(
+                            (total + 524288) >> 20))  # bytes to MiB
+                Fileset.objects.filter(pk=fileset.pk).update(
+                    snapshot_size_listing_at=timezone.now())
         except Exception as e:
             logger.exception('[%s] Failed dutree scan', fileset)
             # Append dutree error to error_text, leave success flag as is.
@@ -419,6 +837,90 @@ class FilesetRunner:
             if getproctitle:
                 setproctitle(oldproctitle)
 
+    def _get_snapshot_usage(self, dataset, snapshot, path):
+        """
+        Return the total used size and the (name, size) leaves of the
+        snapshot at path.
+        """
+        if settings.PLANB_SNAPSHOT_LISTING_ENGINE == 'incremental':
+            return get_incremental_usage(dataset, snapshot)
+        elif settings.PLANB_SNAPSHOT_LISTING_ENGINE == 'parallel':
+            return ParallelScanner(
+                path, workers=settings.PLANB_SNAPSHOT_LISTING_WORKERS).scan()
+
+        dutree = Scanner(path).scan(use_apparent_size=False)
+        return dutree.use_size(), [
+            (i.name()[len(path):], i.use_size())
+            for i in dutree.get_leaves()]
+
+    def catalog_run(self, run_id):
+        if not self._fileset_lock.is_acquired():
+            raise ValueError('Cannot use fileset without acquiring lock')
+        fileset = Fileset.objects.get(pk=self._fileset_id)
+        logger.info('[%s] Starting catalog update', fileset)
+        run = BackupRun.objects.get(pk=run_id)
+        assert run.fileset_id == fileset.id
+
+        if getproctitle:
+            oldproctitle = getproctitle()
+
+        snapshots = safe_load(run.attributes)['snapshots']
+        dataset = fileset.get_dataset()
+        try:
+            with dataset.workon(dataset.get_snapshot_path(snapshots[0])):
+                setproctitle('[backing up %d: %s]: catalog' % (
+                    fileset.pk, fileset.friendly_name))
+                count = update_catalog(
+                    dataset, snapshots, fileset.snapshot_list())
+        except Exception:
+            logger.exception('[%s] Failed catalog update', fileset)
+        else:
+            logger.info(
+                '[%s] Completed catalog update of %d snapshots',
+                fileset, count)
+        finally:
+            if getproctitle:
+                setproctitle(oldproctitle)
+
+    def replicate_run(self):
+        """
+        Send the new snapshots to the replication target. The FilesetLock
+        is only held while choosing them: an initial full send may take
+        hours, and the backups go on meanwhile.
+        """
+        if self._fileset_lock.is_acquired():
+            raise ValueError('Cannot replicate with the lock already acquired')
+        fileset = Fileset.objects.get(pk=self._fileset_id)
+        replication = fileset.storage.get_replication()
+        if not replication:
+            logger.warning('[%s] Storage has no replication', fileset)
+            return
+
+        oldproctitle = getproctitle() if getproctitle else None
+        logger.info('[%s] Starting replication', fileset)
+        if getproctitle:
+            setproctitle('[backing up %d: %s]: replicating' % (
+                fileset.pk, fileset.friendly_name))
+        try:
+            with self:
+                # Not renamed or rotated while we look.
+                dataset_name = Fileset.objects.values_list(
+                    'dataset_name', flat=True).get(pk=self._fileset_id)
+                snapshots = replication.get_source_snapshots(dataset_name)
+            # Close the DB connection; the transfer may take a while.
+            connection.close()
+            sent = replication.replicate(dataset_name, snapshots)
+        except Exception:
+            # The next run will resume/catch up. Nothing to clean up.
+            logger.exception('[%s] Failed replication', fileset)
+        else:
+            logger.info(
+                '[%s] Completed replication of %d snapshots',
+                fileset, len(sent))
+        finally:
+            if getproctitle:
+                setproctitle(oldproctitle)
+
     def finalize_run(self, success, resultset):
         if not self._fileset_lock.is_acquired():
             raise ValueError('Cannot use fileset without acquiring lock')
@@ -438,6 +940,71 @@ class FilesetRunner:
         logger.info('[%s] Done', fileset)
         fileset.signal_done(success=True)
 
+    def migrate_run(self, old_storage_alias, dataset_name, storage_alias):
+        """
+        Copy the dataset to the storage_alias pool while backups go on,
+        then switch the fileset over under the FilesetLock.
+        """
+        if self._fileset_lock.is_acquired():
+            raise ValueError('Cannot migrate with the lock already acquired')
+        fileset = Fileset.objects.select_related('hostgroup').get(
+            pk=self._fileset_id)
+        target_storage = pools[storage_alias]
+        migration = ZfsMigration(fileset.storage, target_storage)
+        # In the LAYOUT of the target pool.
+        target_name = target_storage.get_dataset_name(
+            fileset.hostgroup.name, fileset.friendly_name)
+
+        logger.info(
+            '[%s] Starting migration from %s to %s',
+            fileset, old_storage_alias, storage_alias)
+        oldproctitle = getproctitle() if getproctitle else None
+        setproctitle('[migrating %d: %s]: to %s' % (
+            fileset.pk, fileset.friendly_name, storage_alias))
+        try:
+            # Close the DB connection; the transfer may take a while.
+            connection.close()
+            migration.sync(dataset_name, target_name)
+            with self:
+                self._migrate_switch(
+                    migration, old_storage_alias, dataset_name,
+                    storage_alias, target_name)
+        except Exception:
+            logger.exception('[%s] Failed migration', fileset)
+            raise
+        finally:
+            if oldproctitle:
+                setproctitle(oldproctitle)
+
+    def _migrate_switch(
+            self, migration, old_storage_alias, dataset_name, storage_alias,
+            target_name):
+        fileset = Fileset.objects.get(pk=self._fileset_id)
+        if (fileset.storage_alias, fileset.dataset_name) != (
+                old_storage_alias, dataset_name):
+            # Renamed or moved since starting this job.
+            logger.warning(
+                '[%s] Migration to %s cancelled, dataset %s:%s does not '
+                'match current %s:%s', fileset, storage_alias,
+                old_storage_alias, dataset_name, fileset.storage_alias,
+                fileset.dataset_name)
+            return
+
+        new_dataset_name = migration.finish(dataset_name, target_name)
+        Fileset.objects.filter(pk=fileset.pk).update(
+            storage_alias=storage_alias, dataset_name=new_dataset_name)
+        fileset.refresh_from_db()
+        sync_fileset_snapshots(fileset)  # the sizes on the new pool
+        if pools[old_storage_alias].get_replication():
+            # The target pool replicates (if at all) under another name.
+            logger.warning(
+                '[%s] The replica of %s:%s is no longer updated and can be '
+                'destroyed', fileset, old_storage_alias, dataset_name)
+        logger.info(
+            '[%s] Migration to %s:%s complete; %s:%s can be destroyed',
+            fileset, storage_alias, new_dataset_name, old_storage_alias,
+            dataset_name)
+
     def rename_run(self, old_dataset_name, new_dataset_name):
         if not self._fileset_lock.is_acquired():
             raise ValueError('Cannot use fileset without acquiring lock')
@@ -455,4 +1022,6 @@ class FilesetRunner:
             '[%s] Rename from %r to %r',
             fileset, old_dataset_name, new_dataset_name)
         fileset.rename_dataset(new_dataset_name)
+        rename_replica(
+            fileset.storage, old_dataset_name, new_dataset_name, fileset)
         logger.info('[%s] Rename to %r complete', fileset, new_dataset_name)
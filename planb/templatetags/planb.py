@@ -1,18 +1,35 @@
 from django import template
+from django.conf import settings
 from django.urls import reverse
 
-from planb.models import BOGODATE, Fileset
+from django_q.brokers.redis_broker import Redis
+
+from planb.models import BOGODATE, GLOBAL_MESSAGES_CACHE_KEY, Fileset
 
 register = template.Library()
 
 
 class GlobalMessagesNode(template.Node):
     def render(self, context):
+        # Cached until a backup is done or a fileset is enabled/disabled.
+        redis = Redis.get_connection()
+        html = redis.get(GLOBAL_MESSAGES_CACHE_KEY)
+        if html is not None:
+            return html.decode('utf-8')
+
+        html = self.render_messages()
+        redis.set(
+            GLOBAL_MESSAGES_CACHE_KEY, html.encode('utf-8'),
+            ex=settings.PLANB_GLOBAL_MESSAGES_CACHE_TIMEOUT)
+        return html
+
+    def render_messages(self):
         show_at_most = 10
         backup_failures = list(
             Fileset.objects
             .filter(is_enabled=True, first_fail__isnull=False)
             .exclude(first_fail=BOGODATE)
+            .select_related('last_backuprun')
             .order_by('first_fail')[0:(show_at_most + 1)])
         if not backup_failures:
             return ''
@@ -25,7 +42,8 @@ class GlobalMessagesNode(template.Node):
             backup_failures.pop()
 
         for fileset in backup_failures:
-            error = fileset.last_backuprun.error_text.split('\n', 1)[0]
+            run = fileset.last_backuprun
+            error = run.error_text.split('\n', 1)[0] if run else ''
             url = reverse("admin:planb_fileset_change", args=(fileset.pk,))
 
             warnings.append(
@@ -0,0 +1,54 @@
+import math
+
+from django.test import TestCase
+
+from planb.anomaly import get_run_anomalies, get_zscore, update_ewma
+from planb.factories import BackupRunFactory, FilesetFactory
+
+
+class AnomalyTestCase(TestCase):
+    def test_update_ewma(self):
+        self.assertEqual(update_ewma(100, 0, 100, 0.5), (100, 0))
+        self.assertEqual(update_ewma(100, 0, 300, 0.5), (200, 10000))
+        self.assertEqual(get_zscore(200, 10000, 500), 3)
+        self.assertEqual(get_zscore(200, 0, 200), 0)
+        self.assertEqual(get_zscore(200, 0, 199), -math.inf)
+
+    def test_get_run_anomalies(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        # No previous run to compare with.
+        self.assertEqual(
+            get_run_anomalies(fileset, 10000, 5000, 3600), ([], {}))
+
+        fileset.last_successful_backuprun = BackupRunFactory(
+            fileset=fileset, success=True, snapshot_size_mb=5000)
+        fileset.total_size_mb = 10000
+        fileset.trend_runs = 10
+        # Growing 100 +/- 10 MiB, snapshots 50 +/- 10 MiB, 1h +/- 1m.
+        fileset.growth_average, fileset.growth_variance = 100, 100
+        fileset.snapshot_growth_average = 50
+        fileset.snapshot_growth_variance = 100
+        fileset.average_duration, fileset.duration_variance = 3600, 3600
+
+        anomalies, values = get_run_anomalies(fileset, 10100, 5050, 3600)
+        self.assertEqual(anomalies, [])
+        self.assertEqual(values, {
+            'trend_runs': 11,
+            'growth_average': 100, 'growth_variance': 90,
+            'snapshot_growth_average': 50, 'snapshot_growth_variance': 90})
+
+        for args, expected in (
+                ((12000, 5050, 3600), ['growth']),
+                # Unusual, but a small change of the size.
+                ((10300, 5050, 3600), []),
+                ((10100, 3000, 3600), ['shrinkage']),
+                ((10100, 5050, 7200), ['slowdown']),
+                ((12000, 3000, 7200), ['growth', 'shrinkage', 'slowdown'])):
+            self.assertEqual(
+                get_run_anomalies(fileset, *args)[0], expected, args)
+
+        # Not before the averages have settled.
+        fileset.trend_runs = 3
+        anomalies, values = get_run_anomalies(fileset, 12000, 3000, 7200)
+        self.assertEqual(anomalies, [])
+        self.assertEqual(values['trend_runs'], 4)
@@ -0,0 +1,99 @@
+import os
+import shutil
+from tempfile import TemporaryDirectory
+
+from django.test import TestCase
+
+from mock import patch
+
+from planb.catalog import SnapshotCatalog, lookup_catalog, update_catalog
+from planb.factories import FilesetFactory
+
+
+def write(path, data, mtime=1546300800):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    os.utime(path, (mtime, mtime))
+
+
+class SnapshotCatalogTestCase(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.snap1 = os.path.join(self._tmp.name, 'daily-1')
+        write(os.path.join(self.snap1, 'etc/passwd'), b'root')
+        write(os.path.join(self.snap1, 'etc/hosts'), b'127.0.0.1')
+        write(os.path.join(self.snap1, 'home/a/notes'), b'v1')
+        self.snap2 = os.path.join(self._tmp.name, 'daily-2')
+        shutil.copytree(self.snap1, self.snap2)
+        os.unlink(os.path.join(self.snap2, 'etc/hosts'))
+        write(os.path.join(self.snap2, 'home/a/notes'), b'v2', 1546387200)
+        os.rename(
+            os.path.join(self.snap2, 'home/a'),
+            os.path.join(self.snap2, 'home/b'))
+        self.changes = [
+            ('-', False, '/etc/hosts', None),
+            ('M', True, '/etc', None),
+            ('R', True, '/home/a', '/home/b'),
+            ('M', False, '/home/b/notes', None),
+        ]
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def lookup(self, catalog, path):
+        return [
+            (i.path, i.size, i.snapshots) for i in catalog.lookup(path)]
+
+    def check_catalog(self, catalog):
+        self.assertEqual(self.lookup(catalog, ''), [
+            ('/etc/hosts', 9, ['daily-1']),
+            ('/etc/passwd', 4, ['daily-1', 'daily-2', 'weekly-2']),
+            ('/home/a/notes', 2, ['daily-1']),
+            ('/home/b/notes', 2, ['daily-2', 'weekly-2'])])
+        self.assertEqual(self.lookup(catalog, 'etc/passwd/'), [
+            ('/etc/passwd', 4, ['daily-1', 'daily-2', 'weekly-2'])])
+        self.assertEqual(self.lookup(catalog, '/home/b'), [
+            ('/home/b/notes', 2, ['daily-2', 'weekly-2'])])
+        self.assertEqual(self.lookup(catalog, '/home/bb'), [])
+
+        # Rotating daily-1 away drops the versions only found in there.
+        catalog.prune(['daily-2', 'weekly-2'])
+        self.assertEqual(self.lookup(catalog, ''), [
+            ('/etc/passwd', 4, ['daily-2', 'weekly-2']),
+            ('/home/b/notes', 2, ['daily-2', 'weekly-2'])])
+
+    def test_add_by_walk(self):
+        filename = os.path.join(self._tmp.name, 'catalog.sqlite3')
+        with SnapshotCatalog(filename) as catalog:
+            catalog.add_snapshot(['daily-1'], self.snap1)
+            catalog.add_snapshot(['daily-2', 'weekly-2'], self.snap2)
+            self.check_catalog(catalog)
+
+    def test_add_by_diff(self):
+        filename = os.path.join(self._tmp.name, 'catalog.sqlite3')
+        with SnapshotCatalog(filename) as catalog:
+            catalog.add_snapshot(['daily-1'], self.snap1)
+            self.assertEqual(catalog.get_last_snapshot(), 'daily-1')
+            catalog.add_snapshot(
+                ['daily-2', 'weekly-2'], self.snap2, self.changes)
+            self.check_catalog(catalog)
+
+    def test_update_catalog(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        dataset = fileset.get_dataset()
+        write(os.path.join(
+            dataset.get_snapshot_path('daily-1'), 'etc/passwd'), b'root')
+
+        self.assertIsNone(lookup_catalog(dataset, 'etc'))
+        self.assertEqual(update_catalog(dataset, ['daily-1'], []), 1)
+
+        # The lookup runs in the web process: it does not chdir/unmount.
+        with patch.object(dataset, 'workon') as workon, \
+                patch.object(dataset, 'mount') as mount:
+            self.assertEqual(
+                [(i.path, i.snapshots)
+                 for i in lookup_catalog(dataset, 'etc')],
+                [('/etc/passwd', ['daily-1'])])
+        workon.assert_not_called()
+        mount.assert_called_once_with()
@@ -1,7 +1,10 @@
 from io import StringIO
+import os
+from tempfile import TemporaryDirectory
 
+from django.conf import settings
 from django.core import mail
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
 from django.test import TestCase, override_settings
 
 from mock import patch
@@ -9,7 +12,10 @@ from mock import patch
 from planb.factories import (
     BackupRunFactory, FilesetFactory, HostGroupFactory)
 from planb.models import Fileset
+from planb.snapshots import sync_fileset_snapshots
+from planb.storage import pools
 from planb.storage.dummy import DummyStorage
+from planb.storage.zfs import ZfsStorage
 from planb.transport_exec.factories import ExecConfigFactory
 from planb.transport_rsync.factories import RsyncConfigFactory
 
@@ -23,6 +29,24 @@ class CommandTestCase(TestCase):
             *args, **kwargs, no_color=True, stdout=stdout, stderr=stderr)
         return stdout.getvalue(), stderr.getvalue()
 
+    def test_bcatalog(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        BackupRunFactory(
+            fileset=fileset, success=True, attributes='snapshots:\n- daily-1')
+        with self.assertRaises(CommandError):
+            self.run_command('bcatalog', fileset.pk)
+
+        path = os.path.join(
+            fileset.get_dataset().get_snapshot_path('daily-1'), 'notes')
+        with open(path, 'w') as fp:
+            fp.write('hello')
+        os.utime(path, (1546300800, 1546300800))
+        with patch.object(Fileset, 'snapshot_list', return_value=[]):
+            stdout, stderr = self.run_command(
+                'bcatalog', fileset.pk, 'notes', update=True)
+        self.assertEqual(
+            stdout, '2019-01-01 00:00:00        5 B  /notes  daily-1\n')
+
     def test_bclone(self):
         fileset = FilesetFactory()
         RsyncConfigFactory(fileset=fileset)
@@ -34,6 +58,137 @@ class CommandTestCase(TestCase):
             'Cloned {} to {}'.format(fileset, fileset_copy), stdout)
         self.assertEqual(fileset_copy.get_transport().host, 'copy.host.co')
 
+    def test_blargest(self):
+        fileset1 = FilesetFactory(friendly_name='desktop')
+        fileset2 = FilesetFactory(friendly_name='server')
+        old_run = BackupRunFactory(fileset=fileset1, success=True)
+        old_run.set_snapshot_size_listing([('/old/', 10 << 30)])
+        for fileset, leaves in (
+                (fileset1, [('/home/', 3 << 30), ('/*', 1 << 20)]),
+                (fileset2, [('/srv/', 2 << 30), ('/var/', 4 << 30)])):
+            BackupRunFactory(
+                fileset=fileset, success=True).set_snapshot_size_listing(
+                    leaves)
+        # Only the listings of the last runs count.
+        stdout, stderr = self.run_command('blargest', limit=3)
+        self.assertEqual(stdout, ''.join(
+            '  {} GB  {:40s}  {}\n'.format(size, str(fileset), path)
+            for size, fileset, path in (
+                ('4.0', fileset2, '/var/'), ('3.0', fileset1, '/home/'),
+                ('2.0', fileset2, '/srv/'))))
+
+        stdout, stderr = self.run_command(
+            'blargest', limit=3, fileset=[fileset1.pk])
+        self.assertEqual(stdout, ''.join(
+            '  {:>6s}  {:40s}  {}\n'.format(size, str(fileset1), path)
+            for size, path in (('3.0 GB', '/home/'), ('1.0 MB', '/*'))))
+
+    def test_bprovision(self):
+        template = FilesetFactory(
+            storage_alias='dummy', total_size_mb=1024, average_duration=60)
+        RsyncConfigFactory(fileset=template)
+        path = os.path.join(self._tmpdir(), 'hosts')
+        with open(path, 'w') as fp:
+            fp.write('web1 web1.example.com\n\nweb2 web2.example.com\n')
+
+        with patch('planb.management.commands.bprovision.suggest_pool',
+                   side_effect=['zfs', 'dummy']):
+            stdout, stderr = self.run_command(
+                'bprovision', template.pk, path, dry_run=True)
+        self.assertEqual(stdout, 'web1 on zfs\nweb2 on dummy\n')
+        self.assertFalse(Fileset.objects.filter(friendly_name='web1'))
+
+        stdout, stderr = self.run_command('bprovision', template.pk, path)
+        web2 = Fileset.objects.get(friendly_name='web2')
+        self.assertIn('Created {} on dummy'.format(web2), stdout)
+        self.assertEqual(web2.get_transport().host, 'web2.example.com')
+
+        with open(path, 'w') as fp:
+            fp.write('web3\n')
+        with self.assertRaises(CommandError):
+            self.run_command('bprovision', template.pk, path)
+
+    def _tmpdir(self):
+        tmpdir = TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        return tmpdir.name
+
+    @override_settings(
+        PLANB_PLACEMENT_NIGHT_SECONDS=3600, Q_CLUSTER={'workers': 1})
+    def test_brebalance(self):
+        with self.assertRaises(CommandError):
+            self.run_command('brebalance', pool=['zfs'])
+        # Migrations are done with zfs send/recv.
+        with self.assertRaises(CommandError):
+            self.run_command('brebalance', pool=['dummy', 'zfs'])
+
+        fileset = FilesetFactory(
+            storage_alias='zfs', total_size_mb=1024, average_duration=3600)
+        FilesetFactory(
+            storage_alias='zfs', total_size_mb=2048, average_duration=3600)
+        zfs2 = ZfsStorage(
+            dict(settings.PLANB_STORAGE_POOLS['zfs'], POOLNAME='tank2'),
+            alias='zfs2')
+        with patch('planb.management.commands.brebalance.'
+                   'async_rebalance_jobs') as async_rebalance_jobs, \
+                patch.dict(pools, zfs2=zfs2):
+            stdout, stderr = self.run_command('brebalance', enqueue=True)
+        async_rebalance_jobs.assert_called_once_with([(fileset, 'zfs2')])
+        self.assertEqual(stdout, (
+            '{:6d} {:40s} zfs -> zfs2 (1.0 GB, 1h 00m)\n'
+            'Moving 1 filesets, 1.0 GB; imbalance 2.00 -> 0.00\n'
+            '  zfs: ??? used, 200% busy, 2 filesets -> '
+            '??? used, 100% busy, 1 filesets\n'
+            '  zfs2: ??? used, 0% busy, 0 filesets -> '
+            '??? used, 100% busy, 1 filesets\n'
+            'Queued 1 migrations\n').format(fileset.pk, str(fileset)[0:40]))
+
+    def test_bnestdatasets(self):
+        fileset = FilesetFactory(storage_alias='zfs')
+        with self.assertRaises(CommandError):
+            self.run_command('bnestdatasets', 'zfs')
+        with self.assertRaises(CommandError):
+            self.run_command('bnestdatasets', 'nonexistent')
+
+        storage = fileset.storage
+        dataset_name = storage.get_dataset_name(
+            fileset.hostgroup.name, fileset.friendly_name)
+        with patch.dict(storage.config, LAYOUT='nested'):
+            nested = FilesetFactory(storage_alias='zfs')
+            with patch('planb.management.commands.bnestdatasets.'
+                       'async_rename_job') as async_rename_job:
+                stdout, stderr = self.run_command('bnestdatasets', 'zfs')
+        async_rename_job.assert_called_once_with(
+            fileset, fileset.hostgroup.name, fileset.friendly_name)
+        self.assertEqual(stdout, '{} to tank/{}/{}\nQueued 1 renames\n'.format(
+            dataset_name, fileset.hostgroup.name, fileset.friendly_name))
+        self.assertNotIn(nested.dataset_name, stdout)
+
+    def test_brestore(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        with self.assertRaises(CommandError):
+            self.run_command('brestore', fileset.pk, 'daily-1')
+        fileset.get_dataset().snapshot_create('daily-1')
+        sync_fileset_snapshots(fileset)
+        with self.assertRaises(CommandError):
+            self.run_command('brestore', fileset.pk, 'daily-1')
+
+        RsyncConfigFactory(fileset=fileset, host='example.com')
+        with patch('planb.management.commands.brestore.async_restore_job') \
+                as async_restore_job:
+            stdout, stderr = self.run_command(
+                'brestore', fileset.pk, 'daily-1', 'etc', queue=True,
+                shards=2)
+        async_restore_job.assert_called_once_with(
+            fileset, 'daily-1', 'etc', dest=None, shards=2, bwlimit=None)
+        self.assertIn('Queued restore of', stdout)
+
+        with patch('planb.transport_rsync.restore.RsyncRestore.run',
+                   return_value=2048):
+            stdout, stderr = self.run_command(
+                'brestore', fileset.pk, 'daily-1', dest='/mnt')
+        self.assertIn(':/mnt\nRestored 2.0 KB\n', stdout)
+
     def test_blist(self):
         stdout, stderr = self.run_command('blist')
         self.assertEqual(stdout, '\n')
@@ -77,9 +232,10 @@ class CommandTestCase(TestCase):
             hostgroup__name='local', hostgroup__notify_email='test@local',
             total_size_mb=94950, last_ok='2019-11-29T13:47Z',
             last_run='2019-11-29T13:47Z')
-        BackupRunFactory(
+        run = BackupRunFactory(
             fileset=fileset, success=True, total_size_mb=94950,
-            snapshot_size_mb=84950, snapshot_size_listing=TEST_DUTREE_LISTING)
+            snapshot_size_mb=84950)
+        run.set_snapshot_size_listing(TEST_DUTREE_LISTING)
 
         stdout, stderr = self.run_command('breport', output='email')
         message = mail.outbox[0]
@@ -195,17 +351,19 @@ notes: ""
 '''
 
 
-TEST_DUTREE_LISTING = '''/.local/share/baloo/index: 13,719,351,296
-/.local/share/*: 7,878,635,520
-"/.steam/steam/steamapps/common/Left 4 Dead 2/left4dead2/": 7,099,121,664
-"/.steam/steam/steamapps/common/Left 4 Dead 2/*": 6,514,282,496
-/.steam/steam/steamapps/common/*: 5,675,253,760
-"/Downloads/": 5,122,678,784
-"/Music/": 13,076,504,576
-"/Pictures/": 6,761,598,976
-/dev/: 6,166,724,608
-/download/: 5,009,948,672
-/*: 9,679,134,720'''
+TEST_DUTREE_LISTING = [
+    ('/.local/share/baloo/index', 13719351296),
+    ('/.local/share/*', 7878635520),
+    ('/.steam/steam/steamapps/common/Left 4 Dead 2/left4dead2/', 7099121664),
+    ('/.steam/steam/steamapps/common/Left 4 Dead 2/*', 6514282496),
+    ('/.steam/steam/steamapps/common/*', 5675253760),
+    ('/Downloads/', 5122678784),
+    ('/Music/', 13076504576),
+    ('/Pictures/', 6761598976),
+    ('/dev/', 6166724608),
+    ('/download/', 5009948672),
+    ('/*', 9679134720),
+]
 
 
 TEST_SLIST = '''; (nogroup)
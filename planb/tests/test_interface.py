@@ -1,10 +1,24 @@
+import io
+import json
+import os
+import tarfile
+
+from django.conf import settings
 from django.template import Context, Template
 from django.test import TestCase
 from django.utils import timezone
 
+from mock import patch
+
+from planb.catalog import update_catalog
 from planb.factories import (
     BackupRunFactory, FilesetFactory, HostGroupFactory, UserFactory)
-from planb.models import BOGODATE
+from planb.models import BOGODATE, Fileset, clear_global_messages_cache
+from planb.signals import backup_done
+from planb.snapshots import sync_fileset_snapshots
+from planb.storage import pools
+from planb.storage.zfs import ZfsStorage
+from planb.status import clear_status_cache
 
 
 class InterfaceTestCase(TestCase):
@@ -51,10 +65,20 @@ class InterfaceTestCase(TestCase):
             response,
             'A rename task has been queued for all filesets in the hostgroup')
 
+        # The quota is applied to the storage when it is changed.
+        with patch('planb.admin.apply_quota') as apply_quota:
+            self.client.post(
+                '/planb/hostgroup/{}/change/'.format(hostgroup.pk),
+                dict(data, quota_gb=5))
+        hostgroup.refresh_from_db()
+        apply_quota.assert_called_once_with(hostgroup)
+        self.assertEqual(apply_quota.call_args[0][0].quota_gb, 5)
+
         # Test rename task spawn after fileset name change.
         data = {
             'friendly_name': 'my-host',
             'hostgroup': hostgroup.pk,
+            'storage_alias': fileset.storage_alias,
             'daily_retention': 1,
             'weekly_retention': 1,
             'monthly_retention': 1,
@@ -65,10 +89,193 @@ class InterfaceTestCase(TestCase):
         self.assertContains(
             response, 'A rename task has been queued for the fileset')
 
+        # Test migrate task spawn after storage change, between ZFS pools
+        # only.
+        Fileset.objects.filter(pk=fileset.pk).update(storage_alias='zfs')
+        data.update(friendly_name=fileset.friendly_name)
+        zfs2 = ZfsStorage(
+            dict(settings.PLANB_STORAGE_POOLS['zfs'], POOLNAME='tank2'),
+            alias='zfs2')
+        with patch('planb.admin.async_migrate_job') as async_migrate_job, \
+                patch.dict(pools, zfs2=zfs2):
+            response = self.client.post(
+                '/planb/fileset/{}/change/'.format(fileset.pk),
+                dict(data, storage_alias='dummy'), follow=True)
+            self.assertContains(
+                response, 'Filesets can only be moved between ZFS storage.')
+            response = self.client.post(
+                '/planb/fileset/{}/change/'.format(fileset.pk),
+                dict(data, storage_alias='zfs2'), follow=True)
+        self.assertContains(
+            response, 'A migration task to zfs2 has been queued for the '
+            'fileset')
+        fileset.refresh_from_db()
+        self.assertEqual(fileset.storage_alias, 'zfs')
+        async_migrate_job.assert_called_once_with(fileset, 'zfs2')
+
+    def test_admin_add_fileset_placement(self):
+        self.client.force_login(UserFactory(is_staff=True, is_superuser=True))
+        hostgroup = HostGroupFactory()
+        response = self.client.get('/planb/fileset/add/')
+        self.assertContains(
+            response, '<option value="" selected>(automatic)</option>')
+
+        data = {
+            'friendly_name': 'new-host', 'hostgroup': hostgroup.pk,
+            'storage_alias': '', 'daily_retention': 1, 'weekly_retention': 1,
+            'monthly_retention': 1, 'yearly_retention': 1}
+        with patch('planb.forms.suggest_pool', return_value='dummy') as m:
+            response = self.client.post('/planb/fileset/add/', data)
+        self.assertEqual(response.status_code, 302)
+        m.assert_called_once_with()
+        self.assertEqual(
+            Fileset.objects.get(friendly_name='new-host').storage_alias,
+            'dummy')
+
+        with patch('planb.forms.suggest_pool', return_value=None):
+            response = self.client.post('/planb/fileset/add/', dict(
+                data, friendly_name='other-host'))
+        self.assertContains(
+            response, 'No storage has room for automatic placement.')
+
+    def test_admin_catalog(self):
+        user = UserFactory(is_staff=True, is_superuser=True)
+        self.client.force_login(user)
+        fileset = FilesetFactory(storage_alias='dummy')
+
+        url = '/planb/fileset/{}/catalog/'.format(fileset.pk)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, {'path': 'etc'})
+        self.assertContains(response, 'There is no catalog for this fileset.')
+
+        dataset = fileset.get_dataset()
+        os.makedirs(os.path.join(dataset.get_snapshot_path('daily-1'), 'etc'))
+        with open(os.path.join(
+                dataset.get_snapshot_path('daily-1'), 'etc/passwd'), 'w'):
+            pass
+        update_catalog(dataset, ['daily-1'], [])
+        response = self.client.get(url, {'path': 'etc'})
+        self.assertContains(response, '<code>/etc/passwd</code>')
+
+    def test_admin_restore(self):
+        user = UserFactory(is_staff=True, is_superuser=True)
+        self.client.force_login(user)
+        fileset = FilesetFactory(storage_alias='dummy')
+        fileset.get_dataset().snapshot_create('daily-1')
+        sync_fileset_snapshots(fileset)
+
+        response = self.client.post('/planb/fileset/', {
+            'action': 'restore_fileset', '_selected_action': [fileset.pk]})
+        url = '/planb/fileset/{}/restore/'.format(fileset.pk)
+        self.assertRedirects(response, url)
+        response = self.client.get(url)
+        self.assertContains(response, '<option value="daily-1">')
+
+        with patch('planb.admin.async_restore_job') as async_restore_job:
+            response = self.client.post(url, {
+                'snapshot': 'daily-1', 'subpath': '../etc', 'dest': '',
+                'shards': 2, 'bwlimit': '1M'})
+            self.assertContains(response, 'Path cannot contain')
+            response = self.client.post(url, {
+                'snapshot': 'daily-1', 'subpath': '/etc/', 'dest': '',
+                'shards': 2, 'bwlimit': '1M'})
+        self.assertRedirects(
+            response, '/planb/fileset/{}/change/'.format(fileset.pk))
+        async_restore_job.assert_called_once_with(
+            fileset, 'daily-1', 'etc', dest=None, shards=2, bwlimit='1M')
+
+    def test_snapshot_download(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        dataset = fileset.get_dataset()
+        dataset.snapshot_create('daily-1')
+        sync_fileset_snapshots(fileset)
+        os.makedirs(os.path.join(dataset.get_snapshot_path('daily-1'), 'etc'))
+        path = os.path.join(dataset.get_snapshot_path('daily-1'), 'etc/passwd')
+        with open(path, 'w') as fp:
+            fp.write('root')
+
+        url = '/planb/fileset/{}/download/daily-1/'.format(fileset.pk)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(UserFactory(is_staff=True, is_superuser=True))
+        response = self.client.get(
+            '/planb/fileset/{}/download/daily-2/'.format(fileset.pk))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(url, {'path': '../etc'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'compression': 'rar'})
+        self.assertEqual(response.status_code, 400)
+        # The snapshot data is controlled by the host: no symlinks out.
+        os.symlink('/', os.path.join(
+            dataset.get_snapshot_path('daily-1'), 'root'))
+        response = self.client.get(url, {'path': 'root/etc/passwd'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(url, {'path': 'etc/passwd'})
+        self.assertEqual(b''.join(response.streaming_content), b'root')
+
+        response = self.client.get(url, {'path': 'etc', 'compression': 'gzip'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(
+            response['Content-Disposition'],
+            'attachment; filename="{}-daily-1-etc.tar.gz"'.format(
+                fileset.friendly_name))
+        data = b''.join(response.streaming_content)
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+            self.assertEqual(tar.getnames(), ['etc', 'etc/passwd'])
+
+    def test_fileset_status(self):
+        clear_status_cache()
+        fileset = FilesetFactory(storage_alias='dummy', total_size_mb=2)
+        BackupRunFactory(fileset=fileset, success=True, snapshot_size_mb=1)
+        response = self.client.get('/planb/status/')
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(UserFactory(is_staff=True, is_superuser=True))
+        response = self.client.get('/planb/status/')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        status = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(status), 1)
+        self.assertEqual(status[0]['id'], fileset.pk)
+        self.assertEqual(status[0]['total_size'], 2 << 20)
+        self.assertEqual(status[0]['snapshot_size'], 1 << 20)
+        self.assertFalse(status[0]['is_queued'])
+
+        # Unchanged, also after it expired.
+        etag = response['ETag']
+        response = self.client.get('/planb/status/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        clear_status_cache()
+        response = self.client.get('/planb/status/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Updated for the changed fileset only.
+        other = FilesetFactory(storage_alias='dummy')
+        Fileset.objects.filter(pk=fileset.pk).update(is_queued=True)
+        with patch('planb.views.async_backup_job'):
+            self.client.post('/planb/fileset/{}/enqueue/'.format(other.pk))
+        response = self.client.get('/planb/status/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        status = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(
+            [(i['id'], i['is_queued']) for i in status],
+            [(fileset.pk, False), (other.pk, True)])
+
+        other.delete()
+        clear_status_cache()
+        response = self.client.get('/planb/status/')
+        status = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(
+            [(i['id'], i['is_queued']) for i in status], [(fileset.pk, True)])
+
     def test_global_messages_templatetag(self):
         context = Context()
         template = Template('{% load planb %}{% global_messages %}')
 
+        clear_global_messages_cache()
         self.assertEqual(template.render(context), '')
 
         # Hack to trigger email updates doesn't show messages.
@@ -82,6 +289,7 @@ class InterfaceTestCase(TestCase):
             fileset = FilesetFactory(
                 hostgroup=hostgroup, first_fail=first_fail)
             BackupRunFactory(fileset=fileset)
+            backup_done.send(sender=Fileset, fileset=fileset, success=False)
 
         self.assertEqual(
             template.render(context).count('Backup failure since'), 3)
@@ -90,9 +298,32 @@ class InterfaceTestCase(TestCase):
             fileset = FilesetFactory(
                 hostgroup=hostgroup, first_fail=first_fail)
             BackupRunFactory(fileset=fileset)
+        backup_done.send(sender=Fileset, fileset=fileset, success=False)
 
-        output = template.render(context)
+        with self.assertNumQueries(1):
+            output = template.render(context)
         self.assertIn(
             'There are lots of failed backups. Listing only the oldest 10.',
             output)
         self.assertEqual(output.count('Backup failure since'), 10)
+
+        # Cached until a backup is done or a fileset is toggled.
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(context), output)
+        Fileset.objects.filter(first_fail=first_fail).update(first_fail=None)
+        self.assertEqual(template.render(context), output)
+        backup_done.send(sender=Fileset, fileset=fileset, success=True)
+        self.assertEqual(template.render(context), '')
+
+        # Toggling a fileset clears it once the change is committed.
+        fileset.first_fail = first_fail
+        fileset.is_enabled = False
+        fileset.save()
+        with patch('planb.models.transaction.on_commit') as on_commit:
+            fileset.is_enabled = True
+            fileset.save()
+        self.assertEqual(template.render(context), '')
+        on_commit.assert_called_once_with(clear_global_messages_cache)
+        on_commit.call_args[0][0]()
+        self.assertEqual(template.render(context).count(
+            'Backup failure since'), 1)
@@ -0,0 +1,89 @@
+from datetime import date, timedelta
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from planb.common import histogram
+from planb.factories import BackupRunFactory, FilesetFactory, UserFactory
+from planb.metrics import get_metrics
+from planb.models import BackupRunRollup, Fileset
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        histogram.clear_histogram('storage_command')
+
+    def test_histogram(self):
+        histogram.observe('storage_command', ('zfs', 'list'), 0.2)
+        histogram.observe('storage_command', ('zfs', 'list'), 0.3)
+        histogram.observe('storage_command', ('zfs', 'list'), 1000)
+        counts, sum_ = histogram.get_histogram('storage_command')[
+            ('zfs', 'list')]
+        self.assertEqual(counts, [0, 0, 0, 1, 2, 2, 2, 2, 2, 2, 2, 2, 3])
+        self.assertAlmostEqual(sum_, 1000.5)
+
+    def test_get_metrics(self):
+        now = timezone.now()
+        fileset = FilesetFactory(storage_alias='dummy', total_size_mb=2)
+        BackupRunFactory(
+            fileset=fileset, success=True, duration=60, written_mb=1)
+        Fileset.objects.filter(pk=fileset.pk).update(
+            last_ok=now - timedelta(seconds=100))
+        for i in range(2):
+            BackupRunFactory(fileset=fileset, success=False, duration=1)
+        BackupRunFactory(  # still running
+            fileset=fileset, success=False, duration=None)
+        BackupRunRollup.objects.create(
+            fileset=fileset, date=date(2019, 1, 1), runs=3,
+            successful_runs=2, written_mb=4)
+        FilesetFactory(storage_alias='zfs', is_running=True)
+        FilesetFactory(storage_alias='zfs', is_enabled=False)
+        histogram.observe('storage_command', ('zfs', 'list'), 0.2)
+
+        # A fixed number of queries, whatever the number of filesets.
+        with self.assertNumQueries(5):
+            metrics = get_metrics().split('\n')
+
+        label = 'fileset="{}",pool="dummy"'.format(fileset.unique_name)
+        for line in (
+                '# TYPE planb_fileset_failed_runs gauge',
+                'planb_fileset_failed_runs{%s} 2' % (label,),
+                'planb_fileset_total_size_bytes{%s} 2097152' % (label,),
+                'planb_fileset_last_duration_seconds{%s} 60' % (label,),
+                'planb_fileset_last_written_bytes{%s} 1048576' % (label,),
+                'planb_pool_running_jobs{pool="zfs"} 1',
+                'planb_backup_runs_total{pool="dummy",result="failure"} 3',
+                'planb_backup_runs_total{pool="dummy",result="success"} 3',
+                'planb_backup_written_bytes_total{pool="dummy"} 5242880',
+                'planb_storage_command_duration_seconds_bucket'
+                '{command="list",le="0.25",pool="zfs"} 1',
+                'planb_storage_command_duration_seconds_count'
+                '{command="list",pool="zfs"} 1'):
+            self.assertIn(line, metrics)
+        self.assertEqual(len([
+            i for i in metrics if i.startswith('planb_queue_tasks{')]), 4)
+        self.assertEqual(len([
+            i for i in metrics
+            if i.startswith('planb_fileset_total_size_bytes')]), 2)
+        age = [
+            i for i in metrics
+            if i.startswith('planb_fileset_last_success_age_seconds')]
+        self.assertEqual(len(age), 1)
+        self.assertGreaterEqual(int(age[0].rsplit(' ', 1)[1]), 100)
+
+    @override_settings(PLANB_METRICS_TOKEN='secret')
+    def test_metrics_view(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(
+            '/metrics', HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.get(
+            '/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '# TYPE planb_backup_runs_total counter')
+
+        self.client.force_login(UserFactory(is_staff=True, is_superuser=True))
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
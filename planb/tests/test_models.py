@@ -1,10 +1,66 @@
-from django.test import TestCase
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from mock import patch
 
-from planb.factories import FilesetFactory
+from planb.factories import BackupRunFactory, FilesetFactory
+from planb.models import BackupRun
 
 
 class PlanbTestCase(TestCase):
+    def test_backuprun_query_plans(self):
+        # The BackupRun lookups per fileset must use the composite
+        # indexes instead of scanning all runs of the fileset. (EXPLAIN
+        # output of both SQLite and MySQL names the index.)
+        fileset = FilesetFactory(storage_alias='dummy')
+        for i in range(3):
+            BackupRunFactory(fileset=fileset)
+        runs = BackupRun.objects.filter(fileset_id=fileset.pk)
+        ok_runs = runs.filter(success=True)
+        for queryset, index in (
+                # estimate_run_growth
+                (ok_runs.order_by('-started', '-id')
+                 .values_list('duration', flat=True)[0:10],
+                 'planb_run_fileset_ok_idx'),
+                # last successful run, listing reuse
+                (ok_runs.order_by('-started')[0:1],
+                 'planb_run_fileset_ok_idx'),
+                # first successful run
+                (ok_runs.order_by('started')[0:1],
+                 'planb_run_fileset_ok_idx'),
+                # last run
+                (runs.order_by('-started')[0:1], 'planb_run_fileset_idx')):
+            plan = queryset.explain()
+            self.assertIn(index, plan, (str(queryset.query), plan))
+
+    @override_settings(PLANB_DURATION_EWMA_ALPHA=0.5)
+    def test_duration_estimate(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        # The first run sets the average.
+        self.assertEqual(fileset.get_duration_estimate(100), (100, 0.0))
+
+        BackupRunFactory(fileset=fileset, success=True, duration=100)
+        fileset.refresh_from_db()
+        fileset.average_duration = 100
+        self.assertEqual(fileset.get_duration_estimate(100), (100, 0.0))
+        # A step change moves half way, with the spread in the variance.
+        fileset.average_duration, fileset.duration_variance = (
+            fileset.get_duration_estimate(300))
+        self.assertEqual(fileset.average_duration, 200)
+        self.assertEqual(fileset.duration_variance, 10000.0)
+        self.assertEqual(fileset.p90_duration, 328)
+        self.assertEqual(fileset.get_duration_estimate(300), (250, 7500.0))
+
+    def test_has_recent_backup(self):
+        fileset = FilesetFactory(
+            storage_alias='dummy', average_duration=3600,
+            last_ok=(timezone.now() - timedelta(hours=2)))
+        self.assertTrue(fileset._has_recent_backup())
+        # With runs that vary a lot, it is due sooner.
+        fileset.duration_variance = (20 * 3600) ** 2
+        self.assertFalse(fileset._has_recent_backup())
+
     def test_rename_fileset(self):
         fileset = FilesetFactory(storage_alias='zfs')
         old_name = fileset.storage.get_dataset_name(
@@ -0,0 +1,134 @@
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from planb.factories import BackupRunFactory, FilesetFactory
+from planb.models import BackupRun, BackupRunRollup, Fileset
+from planb.placement import (
+    PoolLoad, get_imbalance, get_pool_loads, plan_moves, rank_pools,
+    suggest_pool)
+
+GiB = 1 << 30
+
+
+@override_settings(
+    PLANB_PLACEMENT_HORIZON_DAYS=100, PLANB_PLACEMENT_MIN_FREE=0.1,
+    PLANB_PLACEMENT_NIGHT_SECONDS=3600, Q_CLUSTER={'workers': 2},
+    PLANB_REBALANCE_TOLERANCE=0.1, PLANB_REBALANCE_MAX_MOVES=4,
+    PLANB_REBALANCE_MAX_SIZE=(1 << 40))
+class PlacementTestCase(TestCase):
+    def test_score(self):
+        load = PoolLoad('a', (60 * GiB, 40 * GiB))
+        self.assertEqual(load.get_score(), 0.4)
+        # Growth of 100 MiB per day for 100 days.
+        load.growth = 100 << 20
+        self.assertAlmostEqual(load.get_score(), 40 / 100 - 10000 / 102400)
+        # Half of the window is taken.
+        load.busy = 3600
+        self.assertAlmostEqual(
+            load.get_score(), (40 / 100 - 10000 / 102400) / 2)
+        # Does not fit anymore.
+        self.assertIsNone(load.get_score(25 * GiB))
+        # Unknown space.
+        self.assertEqual(PoolLoad('b', None, busy=7200).get_score(), 0.05)
+
+    def test_rank_pools(self):
+        loads = {
+            'full': PoolLoad('full', (95 * GiB, 5 * GiB)),
+            'busy': PoolLoad('busy', (10 * GiB, 90 * GiB), busy=6480),
+            'empty': PoolLoad('empty', (50 * GiB, 50 * GiB)),
+        }
+        self.assertEqual(
+            [load.alias for score, load in rank_pools(0, loads)],
+            ['empty', 'busy'])
+        self.assertEqual(suggest_pool(0, loads), 'empty')
+
+        # Spreading a batch over the pools.
+        placed = []
+        for i in range(4):
+            alias = suggest_pool(10 * GiB, loads)
+            loads[alias].add(10 * GiB, 1800)
+            placed.append(alias)
+        self.assertEqual(placed, ['empty', 'empty', 'empty', 'busy'])
+        self.assertIsNone(suggest_pool(75 * GiB, loads))
+
+    def test_get_pool_loads(self):
+        fileset = FilesetFactory(storage_alias='dummy', average_duration=600)
+        FilesetFactory(storage_alias='dummy', average_duration=300)
+        FilesetFactory(storage_alias='dummy', is_enabled=False)
+        now = timezone.now()
+        for days, total_size_mb in ((40, 1000), (20, 1100), (0, 1400)):
+            run = BackupRunFactory(
+                fileset=fileset, success=True, total_size_mb=total_size_mb)
+            BackupRun.objects.filter(pk=run.pk).update(
+                started=(now - timedelta(days=days)))
+
+        load = get_pool_loads(now)['dummy']
+        self.assertIsNone(load.space)
+        self.assertEqual((load.busy, load.filesets), (900, 2))
+        self.assertEqual(load.growth, (300 << 20) / 30)
+
+        # Compacted runs count too.
+        BackupRunRollup.objects.create(
+            fileset=fileset, date=(now - timedelta(days=25)).date(),
+            runs=1, successful_runs=1, total_size_mb=900)
+        load = get_pool_loads(now)['dummy']
+        self.assertEqual(load.growth, (500 << 20) / 30)
+
+        # From the oldest to the newest size: shrinking is no growth.
+        BackupRun.objects.filter(total_size_mb=1400).update(total_size_mb=950)
+        load = get_pool_loads(now)['dummy']
+        self.assertEqual(load.growth, (50 << 20) / 30)
+        BackupRun.objects.filter(total_size_mb=950).update(total_size_mb=800)
+        load = get_pool_loads(now)['dummy']
+        self.assertEqual(load.growth, 0)
+
+    def test_plan_moves(self):
+        def make_candidates(alias, *sizes):
+            return [
+                (Fileset(pk=i, storage_alias=alias, total_size_mb=(size << 10),
+                         average_duration=0), 0)
+                for i, size in enumerate(sizes)]
+
+        def make_loads():
+            return {
+                'a': PoolLoad('a', (80 * GiB, 20 * GiB), filesets=4),
+                'b': PoolLoad('b', (20 * GiB, 80 * GiB)),
+            }
+
+        # One large move beats several small ones.
+        loads = make_loads()
+        self.assertAlmostEqual(get_imbalance(loads), 0.6)
+        moves = plan_moves(loads, make_candidates('a', 1, 5, 10, 30))
+        self.assertEqual(
+            [(i.fileset.pk, i.source.alias, i.target.alias) for i in moves],
+            [(3, 'a', 'b')])
+        self.assertAlmostEqual(get_imbalance(loads), 0)
+        self.assertEqual((loads['a'].filesets, loads['b'].filesets), (3, 1))
+
+        # Limited in size; the rest is for the next run.
+        loads = make_loads()
+        moves = plan_moves(
+            loads, make_candidates('a', 1, 5, 10, 30), max_size=(20 * GiB))
+        self.assertEqual([i.fileset.pk for i in moves], [2, 1, 0])
+        moves = plan_moves(
+            make_loads(), make_candidates('a', 1, 5, 10, 30), max_moves=1,
+            max_size=(20 * GiB))
+        self.assertEqual([i.fileset.pk for i in moves], [2])
+
+        # Nothing to gain.
+        self.assertEqual(
+            plan_moves(make_loads(), make_candidates('b', 1, 5)), [])
+
+        # Evening out the nightly busy time.
+        loads = {'c': PoolLoad('c', None), 'd': PoolLoad('d', None)}
+        candidates = [
+            (Fileset(pk=i, storage_alias='c', total_size_mb=1024,
+                     average_duration=3600), 0)
+            for i in range(2)]
+        for fileset, growth in candidates:
+            loads['c'].add(0, fileset.average_duration)
+        moves = plan_moves(loads, candidates)
+        self.assertEqual([str(i.target.alias) for i in moves], ['d'])
+        self.assertEqual((loads['c'].busy, loads['d'].busy), (3600, 3600))
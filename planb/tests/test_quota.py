@@ -0,0 +1,94 @@
+from django.test import TestCase, override_settings
+
+from mock import patch
+
+from planb.factories import BackupRunFactory, FilesetFactory, HostGroupFactory
+from planb.common.subprocess2 import CalledProcessError
+from planb.quota import (
+    QuotaExceeded, apply_quota, check_quota, estimate_run_growth,
+    get_hostgroup_usage)
+from planb.storage import pools
+
+MiB = 1 << 20
+
+
+@override_settings(PLANB_QUOTA_GROWTH_RUNS=3, PLANB_QUOTA_WARN=0.9)
+class QuotaTestCase(TestCase):
+    def test_estimate_run_growth(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        self.assertEqual(estimate_run_growth(fileset), 0)
+        for total_size_mb in (100, 900, 1000, 1200, 1100):
+            BackupRunFactory(
+                fileset=fileset, success=True, total_size_mb=total_size_mb)
+        BackupRunFactory(fileset=fileset, success=False, total_size_mb=0)
+        # The 800 increase is older than the last 3 runs.
+        self.assertEqual(estimate_run_growth(fileset), 200 * MiB)
+
+    def test_get_hostgroup_usage(self):
+        hostgroup = HostGroupFactory()
+        FilesetFactory(
+            hostgroup=hostgroup, storage_alias='dummy', total_size_mb=100)
+        FilesetFactory(
+            hostgroup=hostgroup, storage_alias='dummy', total_size_mb=200)
+        FilesetFactory(
+            hostgroup=hostgroup, storage_alias='zfs', total_size_mb=400)
+        FilesetFactory(storage_alias='dummy', total_size_mb=800)
+        self.assertEqual(get_hostgroup_usage(hostgroup), 700 * MiB)
+
+        # A nested storage knows the usage of the whole group.
+        with patch.object(
+                pools['zfs'], 'get_namespace_usage', return_value=MiB):
+            self.assertEqual(get_hostgroup_usage(hostgroup), 301 * MiB)
+
+    def test_check_quota(self):
+        hostgroup = HostGroupFactory()
+        fileset = FilesetFactory(
+            hostgroup=hostgroup, storage_alias='dummy', total_size_mb=850)
+        for total_size_mb in (700, 800):
+            BackupRunFactory(
+                fileset=fileset, success=True, total_size_mb=total_size_mb)
+
+        # No quota.
+        check_quota(fileset)
+
+        hostgroup.quota_gb = 1
+        hostgroup.save()
+        with self.assertLogs('planb.quota', level='WARNING') as log:
+            check_quota(fileset)
+        self.assertEqual(log.output, [
+            'WARNING:planb.quota:[{}] Quota of {} almost reached: 950.0 MB '
+            'expected after the run, quota is 1.0 GB'.format(
+                fileset, hostgroup)])
+
+        BackupRunFactory(fileset=fileset, success=True, total_size_mb=1300)
+        with self.assertRaises(QuotaExceeded) as cm:
+            check_quota(fileset)
+        self.assertEqual(str(cm.exception), (
+            'Quota of {} exceeded: 850.0 MB used, 1.3 GB expected after '
+            'the run, quota is 1.0 GB'.format(hostgroup)))
+
+        # Only checked: the quota is applied when it is saved.
+        with patch.object(fileset.storage, 'set_namespace_quota') as m, \
+                self.assertRaises(QuotaExceeded):
+            check_quota(fileset)
+        m.assert_not_called()
+
+    def test_apply_quota(self):
+        hostgroup = HostGroupFactory(quota_gb=1)
+        storage = pools['zfs']
+        with patch.object(storage, 'set_namespace_quota') as m:
+            # Along with a new fileset: it may have created the parent.
+            FilesetFactory(storage_alias='dummy', hostgroup=hostgroup)
+            FilesetFactory(storage_alias='zfs', hostgroup=hostgroup)
+            m.assert_called_once_with(hostgroup.name, 1 << 30)
+
+            # On the storage of all filesets, for the (changed) quota.
+            m.reset_mock()
+            m.return_value = True
+            hostgroup.quota_gb = None
+            self.assertTrue(apply_quota(hostgroup))
+            m.assert_called_once_with(hostgroup.name, None)
+
+            m.side_effect = CalledProcessError(1, 'zfs', b'', b'denied')
+            with self.assertLogs('planb.quota', level='WARNING'):
+                self.assertFalse(apply_quota(hostgroup))
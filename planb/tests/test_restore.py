@@ -0,0 +1,111 @@
+import os
+from tempfile import TemporaryDirectory
+
+from django.test import TestCase, override_settings
+
+from mock import patch
+
+from planb.common.subprocess2 import CalledProcessError
+from planb.factories import FilesetFactory
+from planb.transport_rsync.factories import RsyncConfigFactory
+from planb.transport_rsync.models import TransportChoices
+from planb.transport_rsync.restore import RsyncRestore, parse_bwlimit
+
+
+def write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        fp.write(b'x' * size)
+
+
+class RsyncRestoreTestCase(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        fileset = FilesetFactory(storage_alias='dummy')
+        self.config = RsyncConfigFactory(
+            fileset=fileset, host='example.com', src_dir='/srv')
+        self.source = fileset.get_dataset().get_snapshot_path('daily-1')
+        write(os.path.join(self.source, 'home/a'), 40000)
+        write(os.path.join(self.source, 'home/b'), 25000)
+        write(os.path.join(self.source, 'home/c'), 20000)
+        write(os.path.join(self.source, 'home/d'), 1000)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def fake_rsync(self, exitcode):
+        path = os.path.join(self._tmp.name, 'rsync')
+        with open(path, 'w') as fp:
+            fp.write(
+                '#!/bin/sh\nprintf "      1,000  50%%\\r     2,000 100%%\\n"'
+                '\nexit {}\n'.format(exitcode))
+        os.chmod(path, 0o755)
+        return path
+
+    def test_parse_bwlimit(self):
+        self.assertEqual(parse_bwlimit('10M'), 10240)
+        self.assertEqual(parse_bwlimit('512'), 512)
+        self.assertEqual(parse_bwlimit(0), 0)
+        with self.assertRaises(ValueError):
+            parse_bwlimit('10 MB')
+
+    def test_bad_subpath(self):
+        with self.assertRaises(ValueError):
+            RsyncRestore(self.config, 'daily-1', 'home/../../etc')
+
+    def test_get_shards(self):
+        restore = RsyncRestore(self.config, 'daily-1', '/home/', shards=2)
+        self.assertEqual(sorted(restore.get_shards(self.source)), [
+            (41000, ['home/a', 'home/d']), (45000, ['home/b', 'home/c'])])
+
+        restore = RsyncRestore(self.config, 'daily-1', 'home/a', shards=2)
+        self.assertEqual(
+            restore.get_shards(self.source), [(40000, ['home/a'])])
+
+        # The snapshot data is controlled by the host: no symlinks out.
+        os.symlink('/', os.path.join(self.source, 'root'))
+        restore = RsyncRestore(self.config, 'daily-1', 'root/etc', shards=2)
+        with self.assertRaises(ValueError):
+            restore.get_shards(self.source)
+
+    @override_settings(PLANB_RSYNC_BIN='/usr/bin/rsync')
+    def test_get_command(self):
+        restore = RsyncRestore(self.config, 'daily-1', bwlimit='2M')
+        cmd = restore.get_command(self.source, '/tmp/files', 1024)
+        self.assertEqual(cmd[:7], (
+            '/usr/bin/rsync', '-a', '-r', '--numeric-ids', '--info=progress2',
+            '--from0', '--files-from=/tmp/files'))
+        self.assertIn('--bwlimit=1024', cmd)
+        self.assertNotIn('--delete', cmd)
+        self.assertEqual(
+            cmd[-2:], (self.source + '/', 'root@example.com:/srv'))
+
+        self.config.transport = TransportChoices.RSYNC
+        restore = RsyncRestore(self.config, 'daily-1', dest='/mnt/restore')
+        cmd = restore.get_command(self.source, '/tmp/files', 1024)
+        self.assertEqual(cmd[-1], 'example.com::/mnt/restore')
+        self.assertFalse([i for i in cmd if i.startswith('--rsh=')])
+
+    def test_run(self):
+        reports = []
+        restore = RsyncRestore(self.config, 'daily-1', 'home', shards=3)
+        with override_settings(PLANB_RSYNC_BIN=self.fake_rsync(0)):
+            total = restore.run(
+                progress=(lambda *args: reports.append(args)), interval=0.1)
+        self.assertEqual(total, 86000)
+        self.assertEqual(reports[-1], (3 * 2000, total))
+
+        # A limit below the number of shards is not 0 (unlimited).
+        restore = RsyncRestore(
+            self.config, 'daily-1', 'home', shards=3, bwlimit='2')
+        with override_settings(PLANB_RSYNC_BIN=self.fake_rsync(0)), \
+                patch.object(
+                    restore, 'get_command',
+                    wraps=restore.get_command) as get_command:
+            restore.run()
+        self.assertEqual(
+            [call[0][2] for call in get_command.call_args_list], [1, 1, 1])
+
+        with override_settings(PLANB_RSYNC_BIN=self.fake_rsync(12)):
+            with self.assertRaises(CalledProcessError):
+                restore.run()
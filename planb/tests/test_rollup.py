@@ -0,0 +1,59 @@
+from datetime import datetime
+
+from django.test import TestCase, override_settings
+from django.utils.timezone import make_aware
+
+from planb.factories import BackupRunFactory, FilesetFactory
+from planb.models import BackupRun, BackupRunRollup, Fileset
+from planb.rollup import compact_fileset_runs, compact_runs
+
+
+@override_settings(PLANB_BACKUPRUN_KEEP=2)
+class RollupTestCase(TestCase):
+    def make_run(self, fileset, started, **kwargs):
+        run = BackupRunFactory(fileset=fileset, **kwargs)
+        BackupRun.objects.filter(pk=run.pk).update(
+            started=make_aware(datetime(*started)))
+        return run
+
+    def test_compact_runs(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        self.make_run(
+            fileset, (2019, 1, 1, 1), success=True, duration=10,
+            total_size_mb=100, snapshot_size_mb=50, written_mb=1)
+        self.make_run(
+            fileset, (2019, 1, 1, 13), success=False, duration=5,
+            total_size_mb=0, snapshot_size_mb=0)
+        ok = self.make_run(
+            fileset, (2019, 1, 2, 1), success=True, duration=20,
+            total_size_mb=120, snapshot_size_mb=60, written_mb=1)
+        for hour in (1, 13):
+            self.make_run(
+                fileset, (2019, 1, 3, hour), success=False, duration=1)
+        other = FilesetFactory(storage_alias='dummy')
+        self.make_run(other, (2019, 1, 1, 1))
+
+        # The last successful run is still referenced.
+        self.assertEqual(compact_runs(), 2)
+        rollup = BackupRunRollup.objects.get()
+        self.assertEqual(
+            (rollup.fileset, str(rollup.date), rollup.runs,
+             rollup.successful_runs, rollup.duration, rollup.total_size_mb,
+             rollup.snapshot_size_mb, rollup.written_mb),
+            (fileset, '2019-01-01', 2, 1, 15, 100, 50, 1))
+        self.assertEqual(fileset.backuprun_set.count(), 3)
+        self.assertEqual(other.backuprun_set.count(), 1)
+
+        # Until there is a new one.
+        new = self.make_run(
+            fileset, (2019, 1, 4, 1), success=True, total_size_mb=130)
+        fileset = Fileset.objects.get(pk=fileset.pk)
+        self.assertEqual(fileset.last_successful_backuprun, new)
+        self.assertEqual(compact_fileset_runs(fileset), 2)
+        self.assertFalse(BackupRun.objects.filter(pk=ok.pk).exists())
+        self.assertEqual(
+            [(str(i.date), i.runs, i.total_size_mb)
+             for i in fileset.rollups.order_by('date')],
+            [('2019-01-01', 2, 100), ('2019-01-02', 1, 120),
+             ('2019-01-03', 1, 0)])
+        self.assertEqual(compact_fileset_runs(fileset), 0)
@@ -0,0 +1,92 @@
+from datetime import datetime
+
+from django.test import TestCase
+from django.utils import timezone
+
+from mock import patch
+
+from planb.factories import FilesetFactory
+from planb.models import Fileset, FilesetLock, Snapshot
+from planb.snapshots import (
+    get_created, reconcile_snapshots, sync_fileset_snapshots)
+from planb.storage import pools
+
+
+class SnapshotsTestCase(TestCase):
+    def test_get_created(self):
+        self.assertEqual(
+            get_created('daily-201901020304'),
+            datetime(2019, 1, 2, 3, 4, tzinfo=timezone.utc))
+        self.assertIsNone(get_created('manual'))
+        self.assertIsNone(get_created('daily-today'))
+
+    def test_sync_fileset_snapshots(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        dataset = fileset.get_dataset()
+        dataset.snapshot_create('daily-201901010000')
+        dataset.snapshot_create('weekly-201901010000')
+        self.assertEqual(sync_fileset_snapshots(fileset), (2, 0))
+        self.assertEqual(sync_fileset_snapshots(fileset), (0, 0))
+        snapshot = fileset.snapshots.get(name='weekly-201901010000')
+        self.assertEqual(snapshot.type, 'weekly')
+        self.assertEqual(
+            snapshot.created, datetime(2019, 1, 1, tzinfo=timezone.utc))
+        self.assertIsNone(snapshot.used)
+
+        # The sizes are updated, gone snapshots removed.
+        created = datetime(2019, 1, 1, 0, 1, tzinfo=timezone.utc)
+        self.assertEqual(sync_fileset_snapshots(fileset, [
+            (fileset.dataset_name, 'daily-201901010000', created, 1, 2),
+            (fileset.dataset_name, 'daily-201901020000', None, 3, 4)]),
+            (1, 1))
+        self.assertEqual(
+            list(fileset.snapshots.values_list(
+                'name', 'created', 'used', 'referenced')), [
+                ('daily-201901010000', created, 1, 2),
+                ('daily-201901020000',
+                 datetime(2019, 1, 2, tzinfo=timezone.utc), 3, 4)])
+
+        # Reads need no storage (nor queries, when prefetched).
+        fileset = (
+            Fileset.objects.prefetch_related('snapshots').get(pk=fileset.pk))
+        with patch.object(fileset.storage, 'snapshot_list') as m, \
+                self.assertNumQueries(0):
+            self.assertEqual(fileset.snapshot_list_display(), [
+                'daily-201901010000', 'daily-201901020000'])
+            self.assertEqual(fileset.snapshot_count, 2)
+        m.assert_not_called()
+
+    def test_reconcile_snapshots(self):
+        filesets = [FilesetFactory(storage_alias='dummy') for i in range(3)]
+        for fileset in filesets:
+            fileset.get_dataset().snapshot_create('daily-201901010000')
+        Snapshot.objects.create(
+            fileset=filesets[2], name='daily-201812310000', type='daily')
+
+        # A fileset that is backing up is left to its run.
+        lock = FilesetLock(filesets[1].pk)
+        lock.acquire(blocking=False)
+        try:
+            with patch('planb.snapshots.pools', {'dummy': pools['dummy']}):
+                self.assertEqual(reconcile_snapshots(), (2, 1))
+        finally:
+            lock.release()
+        self.assertEqual(
+            [fileset.snapshot_list() for fileset in filesets],
+            [['daily-201901010000'], [], ['daily-201901010000']])
+
+        # As is one that finished a run after the listing.
+        storage = pools['dummy']
+
+        def get_snapshots(dataset_name=None):
+            snapshots = list(type(storage).get_snapshots(storage))
+            Fileset.objects.filter(pk=filesets[0].pk).update(
+                last_run=timezone.now())
+            return [i for i in snapshots if i[1] != 'daily-201901010000']
+
+        with patch('planb.snapshots.pools', {'dummy': storage}), \
+                patch.object(storage, 'get_snapshots', get_snapshots):
+            self.assertEqual(reconcile_snapshots(), (0, 1))
+        self.assertEqual(
+            [fileset.snapshot_list() for fileset in filesets],
+            [['daily-201901010000'], [], []])
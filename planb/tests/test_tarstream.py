@@ -0,0 +1,53 @@
+import io
+import os
+import tarfile
+from tempfile import TemporaryDirectory
+
+from django.test import TestCase
+
+from planb.tarstream import CHUNK_SIZE, iter_compressed, iter_tar
+
+
+class TarStreamTestCase(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.path = os.path.join(self._tmp.name, 'home')
+        os.makedirs(os.path.join(self.path, 'a/empty'))
+        with open(os.path.join(self.path, 'a/big'), 'wb') as fp:
+            fp.write(os.urandom(CHUNK_SIZE * 2 + 100))
+        with open(os.path.join(self.path, 'notes'), 'w') as fp:
+            fp.write('hello')
+        os.utime(os.path.join(self.path, 'notes'), (1546300800, 1546300800))
+        os.symlink('notes', os.path.join(self.path, 'link'))
+        os.mkfifo(os.path.join(self.path, 'fifo'))
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def check_tar(self, data, mode):
+        self.assertEqual(len(data) % tarfile.RECORDSIZE, 0)
+        with tarfile.open(fileobj=io.BytesIO(data), mode=mode) as tar:
+            self.assertEqual(tar.getnames(), [
+                'home', 'home/a', 'home/a/big', 'home/a/empty', 'home/link',
+                'home/notes'])
+            with open(os.path.join(self.path, 'a/big'), 'rb') as fp:
+                self.assertEqual(
+                    tar.extractfile('home/a/big').read(), fp.read())
+            notes = tar.getmember('home/notes')
+            self.assertEqual(notes.mtime, 1546300800)
+            self.assertEqual(tar.extractfile(notes).read(), b'hello')
+            self.assertEqual(tar.getmember('home/link').linkname, 'notes')
+
+    def test_iter_tar(self):
+        chunks = list(iter_tar(self.path, 'home'))
+        self.assertLessEqual(max(len(i) for i in chunks), CHUNK_SIZE)
+        self.check_tar(b''.join(chunks), 'r:')
+
+    def test_iter_compressed(self):
+        data = b''.join(iter_compressed(iter_tar(self.path, 'home'), 'gzip'))
+        self.assertEqual(data[:2], b'\x1f\x8b')
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+            self.assertIn('home/a/big', tar.getnames())
+
+        with self.assertRaises(ValueError):
+            list(iter_compressed([], 'rar'))
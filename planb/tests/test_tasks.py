@@ -1,16 +1,25 @@
 from contextlib import contextmanager
 import datetime
+import os
 
+from django.core.exceptions import ObjectDoesNotExist
 from django.test import TestCase, override_settings
 from django.utils.timezone import make_aware
 
-from mock import Mock, patch
+from django_q.brokers.redis_broker import Redis
+from mock import ANY, Mock, patch
+from yaml import safe_load
 
-from planb.factories import BackupRunFactory, FilesetFactory
-from planb.models import Fileset
+from planb.factories import BackupRunFactory, FilesetFactory, HostGroupFactory
+from planb.models import Fileset, SnapshotListingEntry
+from planb.storage import pools
+from planb.storage.replication import ZfsReplication
 from planb.tasks import (
-    FilesetRunner, conditional_run, dutree_run, finalize_run, manual_run,
-    rename_run, unconditional_run)
+    MIGRATIONS_KEY, DutreeExecutor, FilesetRunner, MigrationExecutor,
+    async_rebalance_jobs, async_rename_hostgroup_job, conditional_run,
+    dutree_next, dutree_run, finalize_run, manual_run, migrate_run,
+    rename_namespace_run, rename_run, replicate_run, restore_run,
+    unconditional_run)
 from planb.signals import backup_done
 from planb.transport_rsync.factories import RsyncConfigFactory
 
@@ -99,6 +108,83 @@ class TaskTestCase(TestCase):
             self.assertEqual(call[0], RSYNC_BIN)
             self.assertEqual(call[-1], fileset.get_dataset().get_data_path())
 
+        # The last runs are cached on the fileset.
+        run = fileset.backuprun_set.get()
+        fileset.refresh_from_db()
+        self.assertEqual(fileset.last_backuprun, run)
+        self.assertEqual(fileset.last_successful_backuprun, run)
+        self.assertEqual(fileset.first_ok, run.started)
+        # And so are the snapshots.
+        self.assertEqual(
+            fileset.snapshot_list(),
+            sorted(safe_load(run.attributes)['snapshots']))
+
+    def test_unconditional_run_anomalies(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        RsyncConfigFactory(fileset=fileset)
+        BackupRunFactory(fileset=fileset, success=True, snapshot_size_mb=5000)
+        Fileset.objects.filter(pk=fileset.pk).update(
+            average_duration=3600, trend_runs=10)
+        # The dummy snapshot is (next to) empty now.
+        with self.assertLogs('planb.tasks', level='WARNING') as log, \
+                patch('planb.transport_rsync.models.check_output'):
+            unconditional_run(fileset.pk)
+        self.assertEqual(log.output, [
+            message(fileset, 'Unusual run: shrinkage', level='WARNING')])
+        run = fileset.backuprun_set.latest('started')
+        self.assertEqual(run.get_anomalies(), ['shrinkage'])
+
+        with self.signal_handler(backup_done) as handler:
+            finalize_run(Mock(args=[fileset.pk], success=True, result=None))
+            self.assertEqual(
+                handler.call_args[1]['anomalies'], ['shrinkage'])
+
+    def test_unconditional_run_quota(self):
+        fileset = FilesetFactory(storage_alias='dummy', total_size_mb=2048)
+        fileset.hostgroup.quota_gb = 1
+        fileset.hostgroup.save()
+        RsyncConfigFactory(fileset=fileset)
+        # The transport is not started.
+        with self.assertLogs('planb.tasks', level='INFO'), \
+                patch('planb.transport_rsync.models.check_output') as c:
+            unconditional_run(fileset.pk)
+        c.assert_not_called()
+        run = fileset.backuprun_set.get()
+        self.assertFalse(run.success)
+        self.assertIn('Quota of {} exceeded'.format(
+            fileset.hostgroup), run.error_text)
+        fileset.refresh_from_db()
+        self.assertEqual(fileset.last_backuprun, run)
+        self.assertIsNone(fileset.last_successful_backuprun)
+        self.assertIsNone(fileset.first_ok)
+
+    @override_settings(PLANB_SNAPSHOT_LISTING_MAX_AGE=86400)
+    def test_unconditional_run_reuses_listing(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        RsyncConfigFactory(fileset=fileset)
+        # Without a previous summary, dutree is spawned.
+        with patch('planb.tasks.async_task') as a, \
+                patch('planb.transport_rsync.models.check_output'):
+            unconditional_run(fileset.pk)
+            a.assert_called_once()
+            self.assertEqual(a.call_args[0][0], 'planb.tasks.dutree_next')
+        self.assertEqual(
+            fileset.backuprun_set.get().snapshot_size_listing,
+            'summary_pending: 0')
+
+        # With a recent summary, it is reused and no walk is needed.
+        fileset.backuprun_set.get().set_snapshot_size_listing([('/*', 1024)])
+        Fileset.objects.filter(pk=fileset.pk).update(
+            snapshot_size_listing_at=make_aware(datetime.datetime.now()))
+        with patch('planb.tasks.async_task') as a, \
+                patch('planb.transport_rsync.models.check_output'):
+            unconditional_run(fileset.pk)
+            a.assert_not_called()
+        run = fileset.backuprun_set.latest('started')
+        self.assertEqual(run.snapshot_size_listing, '')
+        self.assertEqual(run.snapshot_size_listing_as_list(), [('/*', 1024)])
+        self.assertEqual(SnapshotListingEntry.objects.count(), 2)
+
     def test_dutree_run(self):
         # Dutree is spawned at the end of the unconditional_run.
         fileset = FilesetFactory(storage_alias='dummy')
@@ -115,6 +201,188 @@ class TaskTestCase(TestCase):
                 log.output, [
                     message(fileset, 'Starting dutree scan'),
                     message(fileset, 'Completed dutree scan')])
+        fileset.refresh_from_db()
+        self.assertIsNotNone(fileset.snapshot_size_listing_at)
+
+    @override_settings(PLANB_SNAPSHOT_LISTING_ENGINE='incremental')
+    def test_dutree_run_incremental(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        run = BackupRunFactory(
+            fileset=fileset,
+            attributes='do_snapshot_size_listing: true\nsnapshots:\n- daily')
+        dutree_run(fileset.pk, run.pk)
+        run.refresh_from_db()
+        # Only the root, as the dummy snapshot is empty.
+        self.assertEqual(run.snapshot_size_listing, '')
+        self.assertEqual(run.snapshot_size_listing_as_list(), [('/', 0)])
+        self.assertTrue(os.path.exists(os.path.join(
+            fileset.get_dataset().get_metadata_path(),
+            'planb-usagetree.json.gz')))
+
+    def test_dutree_next(self):
+        # The fileset with the oldest listing goes first.
+        fileset1 = FilesetFactory(
+            storage_alias='dummy',
+            snapshot_size_listing_at=make_aware(datetime.datetime(2019, 1, 2)))
+        fileset2 = FilesetFactory(
+            storage_alias='dummy',
+            snapshot_size_listing_at=make_aware(datetime.datetime(2019, 1, 1)))
+        runs = [
+            BackupRunFactory(
+                fileset=fileset, success=True,
+                snapshot_size_listing='summary_pending: 0',
+                attributes='snapshots:\n- daily')
+            for fileset in (fileset1, fileset2)]
+
+        with self.assertLogs('planb.tasks', level='INFO') as log:
+            dutree_next()
+            self.assertEqual(log.output[0], message(
+                fileset2, 'Starting dutree scan'))
+        for run in runs:
+            run.refresh_from_db()
+        self.assertEqual(runs[0].snapshot_size_listing, 'summary_pending: 0')
+        self.assertNotEqual(
+            runs[1].snapshot_size_listing, 'summary_pending: 0')
+
+        # A busy pool is skipped; when nothing can run, the task requeues
+        # itself.
+        with override_settings(PLANB_DUTREE_MAX_IO_LATENCY=0.1), \
+                patch.object(
+                    fileset1.storage.__class__, 'get_io_latency',
+                    return_value=0.5), \
+                patch.object(DutreeExecutor, 'max_wait', 0), \
+                patch('planb.tasks.async_task') as a:
+            self.assertFalse(DutreeExecutor().run_next())
+            self.assertEqual(a.call_args[0][0], 'planb.tasks.dutree_next')
+
+        self.assertTrue(DutreeExecutor().run_next())
+        self.assertFalse(DutreeExecutor().run_next())
+
+    def test_replicate_run(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        with self.assertLogs('planb.tasks', level='INFO') as log:
+            replicate_run(fileset.pk)
+            self.assertEqual(
+                log.output, [
+                    message(
+                        fileset, 'Storage has no replication',
+                        level='WARNING')])
+
+        replication = Mock()
+        replication.get_source_snapshots.return_value = ['daily-1']
+
+        def replicate(dataset_name, snapshots):
+            # The lock is only held to choose the snapshots.
+            lock = fileset.with_lock(fileset.pk)
+            self.assertTrue(lock.acquire(blocking=False))
+            lock.release()
+            return ['daily-1']
+
+        replication.replicate.side_effect = replicate
+        with patch.object(
+                fileset.storage.__class__, 'get_replication',
+                return_value=replication), \
+                self.assertLogs('planb.tasks', level='INFO') as log:
+            replicate_run(fileset.pk)
+            replication.replicate.assert_called_with(
+                fileset.dataset_name, ['daily-1'])
+            self.assertEqual(
+                log.output, [
+                    message(fileset, 'Starting replication'),
+                    message(
+                        fileset, 'Completed replication of 1 snapshots')])
+
+    def test_migrate_run(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        dataset_name = fileset.dataset_name
+        # Named for the LAYOUT of the target pool.
+        target_name = 'tank/{}/{}'.format(
+            fileset.hostgroup.name, fileset.friendly_name)
+
+        # Renamed in the meantime.
+        with patch('planb.tasks.ZfsMigration') as ZfsMigration, \
+                patch.dict(pools['zfs'].config, LAYOUT='nested'), \
+                self.assertLogs('planb.tasks', level='INFO') as log:
+            migrate_run(fileset.pk, 'dummy', 'old-name', 'zfs')
+        ZfsMigration.return_value.sync.assert_called_once_with(
+            'old-name', target_name)
+        ZfsMigration.return_value.finish.assert_not_called()
+        self.assertEqual(log.output[-1], message(
+            fileset, 'Migration to zfs cancelled, dataset dummy:old-name '
+            'does not match current dummy:{}'.format(dataset_name),
+            level='WARNING'))
+
+        with patch('planb.tasks.ZfsMigration') as ZfsMigration, \
+                patch('planb.tasks.sync_fileset_snapshots') as sync, \
+                patch.dict(pools['zfs'].config, LAYOUT='nested'), \
+                self.assertLogs('planb.tasks', level='INFO') as log:
+            ZfsMigration.return_value.finish.return_value = 'tank/new'
+            migrate_run(fileset.pk, 'dummy', dataset_name, 'zfs')
+        ZfsMigration.return_value.finish.assert_called_once_with(
+            dataset_name, target_name)
+        self.assertEqual(
+            sync.call_args[0][0].dataset_name, 'tank/new')
+        self.assertEqual(log.output, [
+            message(fileset, 'Starting migration from dummy to zfs'),
+            message(fileset, (
+                'Migration to zfs:tank/new complete; dummy:{} can be '
+                'destroyed'.format(dataset_name)))])
+        fileset.refresh_from_db()
+        self.assertEqual(
+            (fileset.storage_alias, fileset.dataset_name), ('zfs', 'tank/new'))
+
+    def test_migrate_next(self):
+        redis = Redis.get_connection()
+        redis.delete(MIGRATIONS_KEY)
+        fileset = FilesetFactory(storage_alias='dummy')
+        with patch('planb.tasks.async_task') as async_task:
+            async_rebalance_jobs([(fileset, 'zfs')])
+        async_task.assert_called_once_with(
+            'planb.tasks.migrate_next', broker=ANY)
+
+        # One migration at a time per pool.
+        busy = redis.lock('migrate:zfs')
+        self.assertTrue(busy.acquire(blocking=False))
+        try:
+            with patch.object(FilesetRunner, 'migrate_run') as migrate_run:
+                self.assertFalse(MigrationExecutor().run_next())
+            migrate_run.assert_not_called()
+        finally:
+            busy.release()
+
+        with patch.object(FilesetRunner, 'migrate_run') as migrate_run, \
+                patch('planb.tasks.async_task') as async_task:
+            self.assertTrue(MigrationExecutor().run_next())
+        migrate_run.assert_called_once_with(
+            'dummy', fileset.dataset_name, 'zfs')
+        # Nothing left to spawn, and the pools are free again.
+        async_task.assert_not_called()
+        self.assertEqual(redis.llen(MIGRATIONS_KEY), 0)
+        slots = MigrationExecutor()._acquire_pool_slots('dummy', 'zfs')
+        self.assertEqual(len(slots), 2)
+        for slot in slots:
+            slot.release()
+        self.assertFalse(MigrationExecutor().run_next())
+
+    def test_restore_run(self):
+        fileset = FilesetFactory(storage_alias='dummy')
+        with self.assertRaises(ObjectDoesNotExist):
+            restore_run(fileset.pk, 'daily-1', '')
+
+        RsyncConfigFactory(fileset=fileset, host='example.com')
+
+        def run(restore, progress, interval):
+            progress(1024, 2048)
+            return 2048
+
+        with self.assertLogs('planb.tasks', level='INFO') as log, \
+                patch('planb.tasks.RsyncRestore.run', run):
+            restore_run(fileset.pk, 'daily-1', 'etc', dest='/mnt')
+        restore = '{}@daily-1:/etc to root@example.com:/mnt'.format(fileset)
+        self.assertEqual(log.output, [
+            message(fileset, 'Starting restore of {}'.format(restore)),
+            message(fileset, 'Restored 1.0 KB of 2.0 KB'),
+            message(fileset, 'Completed restore of {}'.format(restore))])
 
     def test_rename_run(self):
         # The rename task checks if the path has changed since the task was
@@ -145,6 +413,83 @@ class TaskTestCase(TestCase):
             fileset.refresh_from_db()
             self.assertEqual(fileset.dataset_name, 'new_name')
 
+    def test_rename_run_replica(self):
+        # The replica is renamed along, so the next replication continues
+        # with an incremental send.
+        fileset = FilesetFactory(storage_alias='zfs')
+        old_name = fileset.dataset_name
+        replication = ZfsReplication(
+            fileset.storage, {'POOLNAME': 'tank2', 'COMMAND': ('zfs',)})
+        target = {'tank2/' + old_name[5:]: ['daily-1']}
+
+        def check_output(cmd):
+            if cmd[:2] == ('zfs', 'rename'):
+                target[cmd[-1]] = target.pop(cmd[-2])
+            elif 'receive_resume_token' in cmd:
+                return b'-\n'
+            elif cmd[-1] in target:
+                return '\n'.join(
+                    cmd[-1] + '@' + i for i in target[cmd[-1]]).encode()
+            elif cmd[-1].startswith('tank/'):
+                return b'tank/x@daily-1\ntank/x@daily-2\n'
+            return b''
+
+        with patch.object(
+                fileset.storage.__class__, 'get_replication',
+                return_value=replication), \
+                patch('planb.storage.replication.check_output',
+                      side_effect=check_output), \
+                patch('planb.storage.replication.check_pipe') as pipe, \
+                self.assertLogs('planb.tasks', level='INFO'):
+            rename_run(fileset.pk, old_name, 'tank/new-name')
+            self.assertEqual(list(target), ['tank2/new-name'])
+            replicate_run(fileset.pk)
+        pipe.assert_called_once_with(
+            ('/bin/echo', '/bin/echo', 'send', '-i', '@daily-1',
+             'tank/new-name@daily-2'),
+            ('zfs', 'recv', '-s', '-u', 'tank2/new-name'))
+
+    def test_rename_hostgroup(self):
+        storage = pools['zfs']
+        hostgroup = HostGroupFactory(name='old-group')
+        with patch.dict(storage.config, LAYOUT='nested'):
+            nested = FilesetFactory(
+                hostgroup=hostgroup, storage_alias='zfs',
+                friendly_name='nested')
+            flat = FilesetFactory(
+                hostgroup=hostgroup, storage_alias='dummy',
+                friendly_name='flat')
+            other = FilesetFactory(storage_alias='zfs')
+            self.assertEqual(nested.dataset_name, 'tank/old-group/nested')
+
+            # One task for the nested storage, one per fileset otherwise.
+            hostgroup.name = 'new-group'
+            hostgroup.save()
+            with patch('planb.tasks.async_task') as async_task, \
+                    patch('planb.tasks.async_rename_job') as async_rename_job:
+                async_rename_hostgroup_job(hostgroup, 'old-group')
+            async_rename_job.assert_called_once_with(
+                flat, 'new-group', 'flat')
+            self.assertEqual(
+                async_task.call_args[0], (
+                    'planb.tasks.rename_namespace_run', 'zfs', 'old-group',
+                    'new-group'))
+
+            with patch.object(storage, 'rename_namespace') as rename, \
+                    self.assertLogs('planb.tasks', level='INFO') as log:
+                rename_namespace_run('zfs', 'old-group', 'new-group')
+            rename.assert_called_once_with('old-group', 'new-group')
+            self.assertEqual(log.output, [
+                message('zfs', (
+                    "Rename from 'tank/old-group' to 'tank/new-group' for 1 "
+                    "filesets")),
+                message('zfs', "Rename to 'tank/new-group' complete")])
+            nested.refresh_from_db()
+            self.assertEqual(nested.dataset_name, 'tank/new-group/nested')
+            other_dataset_name = other.dataset_name
+            other.refresh_from_db()
+            self.assertEqual(other.dataset_name, other_dataset_name)
+
     @contextmanager
     def signal_handler(self, signal):
         handler = Mock()
@@ -169,7 +514,7 @@ class TaskTestCase(TestCase):
                         level='ERROR')])
             handler.assert_called_with(
                 sender=Fileset, fileset=fileset, success=False,
-                signal=backup_done)
+                anomalies=[], signal=backup_done)
 
         task = Mock(args=[fileset.pk], success=True, result=None)
         with self.assertLogs('planb.tasks', level='INFO') as log, \
@@ -178,4 +523,4 @@ class TaskTestCase(TestCase):
             self.assertEqual(log.output, [message(fileset, 'Done')])
             handler.assert_called_with(
                 sender=Fileset, fileset=fileset, success=True,
-                signal=backup_done)
+                anomalies=[], signal=backup_done)
@@ -0,0 +1,94 @@
+import os
+import shutil
+from tempfile import TemporaryDirectory
+
+from django.test import TestCase
+
+from dutree import Scanner
+
+from planb.usagetree import ParallelScanner, UsageTree, scan_tree, summarize
+
+
+def write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        fp.write(b'x' * size)
+
+
+class UsageTreeTestCase(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.old = os.path.join(self._tmp.name, 'old')
+        write(os.path.join(self.old, 'etc/passwd'), 2000)
+        write(os.path.join(self.old, 'home/a/big'), 400000)
+        write(os.path.join(self.old, 'home/a/small'), 100)
+        write(os.path.join(self.old, 'home/b/medium'), 90000)
+        write(os.path.join(self.old, 'var/log/syslog'), 300000)
+        write(os.path.join(self.old, 'var/log/old/syslog.1'), 5000)
+        write(os.path.join(self.old, 'rootfile'), 1000)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_summarize_like_dutree(self):
+        dutree = Scanner(self.old).scan(use_apparent_size=False)
+        expected = [
+            (i.name()[len(self.old):], i.use_size())
+            for i in dutree.get_leaves()]
+
+        dirs, files, min_file_size = scan_tree(self.old)
+        total, leaves = summarize(dirs, files)
+        self.assertEqual(total, dutree.use_size())
+        self.assertEqual(leaves, expected)
+
+    def test_apply_diff(self):
+        new = os.path.join(self._tmp.name, 'new')
+        shutil.copytree(self.old, new)
+        tree = UsageTree.from_path('daily-1', self.old)
+
+        os.unlink(os.path.join(new, 'etc/passwd'))
+        write(os.path.join(new, 'home/a/small'), 50000)
+        write(os.path.join(new, 'srv/www/index.html'), 70000)
+        os.rename(os.path.join(new, 'var/log'), os.path.join(new, 'var/log2'))
+        shutil.rmtree(os.path.join(new, 'home/b'))
+
+        tree.apply_diff('daily-2', [
+            ('-', False, '/etc/passwd', None),
+            ('M', True, '/etc', None),
+            ('M', False, '/home/a/small', None),
+            ('+', True, '/srv', None),
+            ('+', True, '/srv/www', None),
+            ('+', False, '/srv/www/index.html', None),
+            ('R', True, '/var/log', '/var/log2'),
+            ('M', True, '/var', None),
+            ('-', False, '/home/b/medium', None),
+            ('-', True, '/home/b', None),
+            ('M', True, '/home', None),
+        ], self.old, new)
+
+        dirs, files, min_file_size = scan_tree(new)
+        self.assertEqual(tree.snapshot, 'daily-2')
+        self.assertEqual(tree.dirs, dirs)
+        self.assertEqual(tree.files, files)
+        self.assertEqual(tree.summarize(), summarize(dirs, files))
+
+    def test_save_load(self):
+        filename = os.path.join(self._tmp.name, 'tree.json.gz')
+        self.assertIsNone(UsageTree.load(filename))
+
+        UsageTree.from_path('daily-1', self.old).save(filename)
+        tree = UsageTree.load(filename)
+        self.assertEqual(tree.snapshot, 'daily-1')
+        self.assertEqual(
+            (tree.dirs, tree.files, tree.min_file_size), scan_tree(self.old))
+
+    def test_parallel_scanner(self):
+        for i in range(40):
+            write(os.path.join(
+                self.old, 'many/{}/{}/file'.format(i % 7, i)), 1000 * i)
+
+        dirs, files, min_file_size = scan_tree(self.old)
+        for workers in (1, 4):
+            self.assertEqual(
+                ParallelScanner(self.old, workers=workers).scan(),
+                summarize(dirs, files))
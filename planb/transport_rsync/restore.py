@@ -0,0 +1,213 @@
+"""
+Push (part of) a snapshot back to the host of an rsync transport.
+
+Large restores are split into shards: the entries of the restored
+directory are divided over a number of parallel rsync streams by size.
+The bandwidth limit is divided over the streams.
+"""
+import logging
+import os
+import re
+import threading
+from stat import S_ISDIR
+from subprocess import PIPE, Popen
+from tempfile import NamedTemporaryFile, TemporaryFile
+
+from django.conf import settings
+from django.db import connections
+
+from planb.common.subprocess2 import CalledProcessError, argsjoin
+from planb.storage.base import get_real_subpath
+
+from .models import TransportChoices
+from .rsync import RSYNC_EXITCODES, RSYNC_HARMLESS_EXITCODES
+
+logger = logging.getLogger(__name__)
+
+_bwlimit_re = re.compile(r'^(\d+)([KMG]?)$')
+_progress2_re = re.compile(br'^\s*([0-9,]+)\s+\d+%')
+
+
+def parse_bwlimit(value):
+    """
+    Return the rsync --bwlimit value (like '10M') in KiB/s; 0 is no limit.
+    """
+    match = _bwlimit_re.match(str(value).upper())
+    if not match:
+        raise ValueError('Bad bandwidth limit {!r}'.format(value))
+    number, unit = match.groups()
+    return int(number) << (10 * ' KMG'.index(unit or 'K') - 10)
+
+
+def apparent_size(path):
+    """
+    Return the total size of the contents of path, which is what rsync
+    needs to transfer.
+    """
+    total = 0
+    todo = [path]
+    while todo:
+        path = todo.pop()
+        st = os.lstat(path)
+        total += st.st_size
+        if S_ISDIR(st.st_mode):
+            todo.extend(entry.path for entry in os.scandir(path))
+    return total
+
+
+class RsyncRestore(object):
+    def __init__(
+            self, config, snapshot, subpath='', dest=None, shards=1,
+            bwlimit=None):
+        self.config = config
+        self.snapshot = snapshot
+        self.subpath = subpath.strip('/')
+        if '..' in self.subpath.split('/'):
+            raise ValueError('Bad path {!r}'.format(subpath))
+        # By default, put things back where they came from.
+        self.dest = dest or self.config.src_dir
+        self.shards = max(1, shards)
+        self.bwlimit = parse_bwlimit(
+            settings.PLANB_RESTORE_BWLIMIT if bwlimit is None else bwlimit)
+
+    def __str__(self):
+        return '{}@{}:/{} to {}'.format(
+            self.config.fileset, self.snapshot, self.subpath,
+            self.get_target())
+
+    def get_target(self):
+        if self.config.transport == TransportChoices.RSYNC:
+            return '{o.host}::{dest}'.format(o=self.config, dest=self.dest)
+        return '{o.user}@{o.host}:{dest}'.format(o=self.config, dest=self.dest)
+
+    def get_shards(self, source):
+        """
+        Return a list of (size, [relpaths]), dividing the entries of the
+        restored path over at most self.shards streams of similar size.
+        The relpaths are relative to source, the snapshot data path.
+
+        Raises ValueError if the path is outside of the snapshot through a
+        symlink in the (host controlled) snapshot data.
+        """
+        path = get_real_subpath(source, self.subpath)
+        subpath = os.path.relpath(path, os.path.realpath(source))
+        if self.shards == 1 or not os.path.isdir(path):
+            return [(apparent_size(path), [subpath])]
+
+        entries = sorted((
+            (apparent_size(entry.path), os.path.join(subpath, entry.name))
+            for entry in os.scandir(path)), reverse=True)
+        # Largest first, to the least loaded stream.
+        shards = [(0, []) for i in range(min(self.shards, len(entries)))]
+        for size, relpath in entries:
+            shards.sort(key=(lambda x: x[0]))
+            shards[0] = (shards[0][0] + size, shards[0][1] + [relpath])
+        return shards or [(0, [subpath])]
+
+    def get_command(self, source, files_from, bwlimit):
+        remote_shell = self.config.get_rsync_flags()[1]
+        args = (
+            settings.PLANB_RSYNC_BIN,
+            # Only add and overwrite, never --delete on a restore.
+            '-a', '-r', '--numeric-ids', '--info=progress2',
+            '--from0', '--files-from={}'.format(files_from),
+            '--bwlimit={}'.format(bwlimit))
+        if self.config.transport == TransportChoices.SSH:
+            args += (
+                '--rsh={} {}'.format(
+                    remote_shell or 'ssh',
+                    self.config.get_transport_ssh_options()),
+                self.config.get_transport_ssh_rsync_path())
+        return args + (source + '/', self.get_target())
+
+    def run(self, progress=None, interval=10):
+        """
+        Run the restore; calls progress(done_bytes, total_bytes) every
+        interval seconds.
+        """
+        dataset = self.config.fileset.get_dataset()
+        source = dataset.get_snapshot_path(self.snapshot)
+        with dataset.workon(source):
+            shards = self.get_shards(source)
+            total = sum(size for size, relpaths in shards)
+            logger.info(
+                'Restoring %s: %d bytes in %d streams',
+                self, total, len(shards))
+
+            # As with the backup: the DB connection could time out.
+            connections.close_all()
+            streams = [
+                _RsyncStream(
+                    self.get_command, source, relpaths,
+                    # Never 0 (unlimited) for a small limit.
+                    max(1, self.bwlimit // len(shards)) if self.bwlimit
+                    else 0)
+                for size, relpaths in shards]
+            try:
+                for stream in streams:
+                    stream.start()
+                while any(stream.is_alive() for stream in streams):
+                    if progress:
+                        progress(sum(i.done for i in streams), total)
+                    for stream in streams:
+                        stream.join(interval / len(streams))
+            finally:
+                for stream in streams:
+                    stream.kill()
+
+        if progress:
+            progress(sum(i.done for i in streams), total)
+        for stream in streams:
+            stream.check()
+        return total
+
+
+class _RsyncStream(threading.Thread):
+    def __init__(self, get_command, source, relpaths, bwlimit):
+        super().__init__()
+        self.done = 0
+        self._files_from = NamedTemporaryFile()
+        self._files_from.write(
+            b'\0'.join(os.fsencode(i) for i in relpaths) + b'\0')
+        self._files_from.flush()
+        self.cmd = get_command(source, self._files_from.name, bwlimit)
+        self._stderr = TemporaryFile()
+        self._fp = None
+        self.returncode = None
+
+    def run(self):
+        logger.info('Running restore: %s', argsjoin(self.cmd))
+        try:
+            self._fp = Popen(
+                self.cmd, stdin=None, stdout=PIPE, stderr=self._stderr)
+        except OSError as e:
+            self._stderr.write(str(e).encode('utf-8'))
+            self.returncode = 127
+            return
+        # The progress2 lines are separated by CRs.
+        rest = b''
+        for data in iter((lambda: self._fp.stdout.read1(8192)), b''):
+            lines = re.split(br'[\r\n]', rest + data)
+            rest = lines.pop()
+            for line in lines:
+                match = _progress2_re.match(line)
+                if match:
+                    self.done = int(match.group(1).replace(b',', b''))
+        self.returncode = self._fp.wait()
+
+    def kill(self):
+        if self._fp and self._fp.returncode is None:
+            self._fp.kill()
+        if self.ident is not None:
+            self.join()
+        self._files_from.close()
+
+    def check(self):
+        if self.returncode not in (0,) + RSYNC_HARMLESS_EXITCODES:
+            self._stderr.seek(0)
+            logger.warning(
+                'Restore failed with %s: %s', self.returncode,
+                RSYNC_EXITCODES.get(
+                    self.returncode, 'Return code not matched'))
+            raise CalledProcessError(
+                self.returncode, self.cmd, b'', self._stderr.read())
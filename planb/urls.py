@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.views.generic.base import RedirectView
 
-from .views import EnqueueJob
+from .views import EnqueueJob, FilesetStatus, Metrics, SnapshotDownload
 
 from django.conf.urls import url
 
@@ -17,7 +17,11 @@ urlpatterns = [
     # Use / as the admin path (only if this is the only app in the project)
     # (point people to the right url.. fails to work if STATIC_URL is '/')
     url(r'^admin(/.*)$', RedirectView.as_view(url='/', permanent=False)),
+    url(r'^planb/status/$', FilesetStatus.as_view(), name='status'),
+    url(r'^metrics$', Metrics.as_view(), name='metrics'),
     url(r'^planb/fileset/(?P<fileset_id>\d+)/enqueue/$',
         EnqueueJob.as_view(), name='enqueue'),
+    url(r'^planb/fileset/(?P<fileset_id>\d+)/download/(?P<snapshot>[^/]+)/$',
+        SnapshotDownload.as_view(), name='snapshot_download'),
     url(r'', admin.site.urls),
 ]
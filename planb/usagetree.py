@@ -0,0 +1,380 @@
+"""
+Disk usage trees: the used size per directory of a snapshot, summarized
+into the same "PATH: SIZE" leaves that dutree produces.
+
+The tree of the previous run is stored in the dataset metadata directory
+(next to 'data'). When the storage can tell which paths changed between
+two snapshots (zfs diff), only those paths are stat'ed, instead of
+walking the entire snapshot again.
+
+For a plain walk, the ParallelScanner scans directories concurrently and
+forgets the details of subtrees as soon as they are known to be too small
+to be listed.
+"""
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import gzip
+import json
+import logging
+import os
+from stat import S_ISDIR
+
+from planb.common.subprocess2 import CalledProcessError
+
+logger = logging.getLogger(__name__)
+
+USAGE_TREE_FILENAME = 'planb-usagetree.json.gz'
+
+
+def path_usage(path):
+    """
+    Return the used (block) size of a single path, not following links.
+    """
+    try:
+        return os.lstat(path).st_blocks << 9
+    except FileNotFoundError:
+        return 0
+
+
+def parent_of(relpath):
+    """
+    Return the parent of '/a/b' ('/a'). The root is ''.
+    """
+    return relpath.rsplit('/', 1)[0]
+
+
+def _scan_dir(path, relpath, todo, files, min_file_size):
+    """
+    Return the usage of the entries of a single directory, adding its
+    subdirectories to todo and its large files to files.
+    """
+    size = 0
+    try:
+        entries = os.scandir(path + relpath)
+    except OSError as e:
+        logger.warning('Cannot scan %r: %s', path + relpath, e)
+        return 0
+
+    for entry in entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue  # vanished
+        use_size = st.st_blocks << 9
+        size += use_size
+        if S_ISDIR(st.st_mode):
+            todo.append(relpath + '/' + entry.name)
+        elif use_size and use_size >= min_file_size:
+            files[relpath + '/' + entry.name] = use_size
+    return size
+
+
+def scan_tree(path, fraction=100):
+    """
+    Walk path and return (dirs, files, min_file_size).
+
+    dirs is {relpath: size} for every directory, where size is the usage
+    of the direct entries (files and the subdirectory inodes themselves),
+    like dutree counts them. files is {relpath: size} of the files of at
+    least min_file_size (1/fraction of the total): the ones that may be
+    listed by themselves.
+    """
+    dirs = {}
+    files = {}
+    total = 0
+    todo = ['']
+    while todo:
+        relpath = todo.pop()
+        dirs[relpath] = _scan_dir(
+            path, relpath, todo, files, total // fraction)
+        total += dirs[relpath]
+
+    min_file_size = total // fraction
+    files = dict(
+        (key, value) for key, value in files.items()
+        if value >= min_file_size)
+    return dirs, files, min_file_size
+
+
+def subtree_totals(dirs):
+    """
+    Take {relpath: size} of dirs and return ({relpath: total size including
+    subdirectories}, {relpath: [subdirectory relpaths]}).
+    """
+    totals = dict((key, max(0, value)) for key, value in dirs.items())
+    children = {}
+    # Deepest first, so every subtree is complete before it is added to
+    # its parent.
+    for relpath in sorted(dirs, key=(lambda x: x.count('/')), reverse=True):
+        if relpath:
+            parent = parent_of(relpath)
+            totals[parent] = totals.get(parent, 0) + totals[relpath]
+            children.setdefault(parent, []).append(relpath)
+    return totals, children
+
+
+def summarize(dirs, files=None, fraction=20):
+    """
+    Take {relpath: size} of dirs and (large) files and return (total,
+    leaves), where leaves are (name, size) tuples of all paths taking up
+    at least 1/fraction of the total, like dutree.get_leaves(): 'PATH/'
+    for a directory with everything in it, 'FILE' for a large file and
+    'PATH/*' for the rest of a directory after its large entries are
+    listed separately.
+    """
+    totals, children = subtree_totals(dirs)
+    total = totals.get('', 0)
+    threshold = total // fraction
+    large_files = {}
+    for relpath, size in (files or {}).items():
+        if size >= threshold:
+            large_files.setdefault(parent_of(relpath), []).append(
+                (relpath, size))
+    leaves = []
+
+    def visit(relpath):
+        # Return the size that is not listed and must be added to the
+        # parent "rest".
+        subdirs = children.get(relpath, ())
+        large = [child for child in subdirs if totals[child] >= threshold]
+        if not large and relpath not in large_files:
+            leaves.append((relpath, relpath + '/', totals[relpath]))
+            return 0
+
+        rest = totals[relpath]
+        for child in large:
+            rest -= totals[child]
+            rest += visit(child)
+        for child, size in large_files.get(relpath, ()):
+            leaves.append((child, child, size))
+            rest -= size
+        if rest >= threshold or (rest and not relpath):
+            # The '\xff' makes "rest" sort after the other entries.
+            leaves.append((relpath + '/\xff', relpath + '/*', rest))
+            rest = 0
+        return rest
+
+    visit('')
+    leaves.sort()
+    return total, [(name, size) for sortkey, name, size in leaves]
+
+
+class UsageTree(object):
+    def __init__(self, snapshot, dirs, files, min_file_size):
+        self.snapshot = snapshot
+        self.dirs = dirs
+        self.files = files
+        self.min_file_size = min_file_size
+
+    @classmethod
+    def from_path(cls, snapshot, path):
+        return cls(snapshot, *scan_tree(path))
+
+    @classmethod
+    def load(cls, filename):
+        try:
+            with gzip.open(filename, 'rt', encoding='utf-8') as fp:
+                data = json.load(fp)
+            return cls(
+                data['snapshot'], data['dirs'], data['files'],
+                data['min_file_size'])
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning('Ignoring broken usage tree %r: %s', filename, e)
+            return None
+
+    def save(self, filename):
+        tmpname = filename + '.tmp'
+        with gzip.open(tmpname, 'wt', encoding='utf-8') as fp:
+            json.dump({
+                'snapshot': self.snapshot, 'dirs': self.dirs,
+                'files': self.files, 'min_file_size': self.min_file_size,
+            }, fp)
+        os.rename(tmpname, filename)
+
+    def _subtree(self, values, relpath):
+        return [i for i in values if i == relpath or i.startswith(
+            relpath + '/')]
+
+    def _add(self, relpath, is_dir, size):
+        parent = parent_of(relpath)
+        self.dirs[parent] = self.dirs.get(parent, 0) + size
+        if is_dir:
+            self.dirs.setdefault(relpath, 0)
+        elif size >= self.min_file_size and size > 0:
+            self.files[relpath] = size
+        else:
+            self.files.pop(relpath, None)
+
+    def _remove(self, relpath, size):
+        parent = parent_of(relpath)
+        self.dirs[parent] = self.dirs.get(parent, 0) - size
+        self.files.pop(relpath, None)
+
+    def _move(self, relpath, new_relpath):
+        for values in (self.dirs, self.files):
+            for key in self._subtree(values, relpath):
+                new_key = new_relpath + key[len(relpath):]
+                values[new_key] = values.get(new_key, 0) + values.pop(key)
+
+    def _drop(self, relpath):
+        for values in (self.dirs, self.files):
+            for key in self._subtree(values, relpath):
+                del values[key]
+
+    def apply_diff(self, snapshot, changes, old_path, new_path):
+        """
+        Update the tree from the changes between the snapshot at old_path
+        and the one at new_path. The changes are (change, is_dir, relpath,
+        new_relpath) tuples, with change one of '+', '-', 'M' or 'R'.
+        """
+        removed = []
+        for change, is_dir, relpath, new_relpath in changes:
+            if change in '-MR':
+                self._remove(relpath, path_usage(old_path + relpath))
+            if change == 'R':
+                self._add(
+                    new_relpath, is_dir, path_usage(new_path + new_relpath))
+                if is_dir:
+                    self._move(relpath, new_relpath)
+            elif change in '+M':
+                self._add(relpath, is_dir, path_usage(new_path + relpath))
+            elif is_dir:
+                removed.append(relpath)
+
+        for relpath in removed:
+            self._drop(relpath)
+        self.snapshot = snapshot
+
+    def summarize(self):
+        return summarize(self.dirs, self.files)
+
+
+class _PendingDir(object):
+    __slots__ = ('relpath', 'parent', 'pending', 'own', 'done')
+
+    def __init__(self, relpath, parent):
+        self.relpath = relpath
+        self.parent = parent
+        self.pending = 0    # subdirectories still being scanned
+        self.own = 0        # size of the direct entries
+        self.done = []      # (relpath, total, kept relpaths) of subdirs
+
+
+class ParallelScanner(object):
+    """
+    Walk a path with a pool of threads and return the same (total, leaves)
+    as summarize(), without keeping every directory in memory.
+
+    Sizes are aggregated bottom-up. When all subdirectories of a directory
+    are done, the ones smaller than 1/fraction of the size seen so far are
+    folded into it: the total only grows, so they would not be listed
+    anyway. Memory use is bounded by the directories in progress (depth x
+    width) plus the large ones.
+    """
+    def __init__(self, path, workers=4, fraction=20):
+        self.path = path
+        self.workers = workers
+        self.fraction = fraction
+
+    def scan(self):
+        self._dirs = {}
+        self._files = {}
+        self._total = 0
+        todo = deque([_PendingDir('', None)])
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while todo or running:
+                # Depth first and only a few in flight, so the todo list
+                # stays proportional to depth and width.
+                while todo and len(running) < self.workers * 2:
+                    node = todo.pop()
+                    running[executor.submit(self._scan_dir, node)] = node
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    self._add_scanned(node, future.result(), todo)
+
+        dirs, files = self._dirs, self._files
+        del self._dirs, self._files
+        return summarize(dirs, files, fraction=self.fraction)
+
+    def _scan_dir(self, node):
+        # Runs in a worker thread: only touch local data.
+        subdirs = []
+        files = {}
+        size = _scan_dir(self.path, node.relpath, subdirs, files, 0)
+        return size, subdirs, files
+
+    def _add_scanned(self, node, result, todo):
+        size, subdirs, files = result
+        self._total += size
+        min_file_size = self._total // self.fraction
+        for relpath, file_size in files.items():
+            if file_size >= min_file_size:
+                self._files[relpath] = file_size
+
+        node.own = size
+        node.pending = len(subdirs)
+        for relpath in subdirs:
+            todo.append(_PendingDir(relpath, node))
+        if not subdirs:
+            self._finish(node)
+
+    def _finish(self, node):
+        while node:
+            threshold = self._total // self.fraction
+            total = node.own
+            kept = [node.relpath]
+            for relpath, subtotal, subkept in node.done:
+                total += subtotal
+                if subtotal < threshold:
+                    node.own += subtotal
+                    for key in subkept:
+                        del self._dirs[key]
+                else:
+                    kept.extend(subkept)
+            self._dirs[node.relpath] = node.own
+            node.done = None
+
+            parent = node.parent
+            if parent:
+                parent.done.append((node.relpath, total, kept))
+                parent.pending -= 1
+                if parent.pending:
+                    break
+            node = parent
+
+
+def get_incremental_usage(dataset, snapshot):
+    """
+    Return (total, leaves) for the snapshot of dataset, updating the
+    stored usage tree from the previous run using the snapshot diff.
+
+    If there is no usable previous tree (first run, snapshot rotated away,
+    storage without diff support), the snapshot is walked entirely.
+    """
+    filename = os.path.join(
+        dataset.get_metadata_path(), USAGE_TREE_FILENAME)
+    new_path = dataset.get_snapshot_path(snapshot)
+    tree = UsageTree.load(filename)
+
+    if tree and tree.snapshot != snapshot:
+        try:
+            changes = dataset.get_snapshot_diff(tree.snapshot, snapshot)
+        except (CalledProcessError, NotImplementedError) as e:
+            logger.info(
+                'No diff from %s@%s, walking everything: %s',
+                dataset.name, tree.snapshot, e)
+            tree = None
+        else:
+            old_path = dataset.get_snapshot_path(tree.snapshot)
+            tree.apply_diff(snapshot, changes, old_path, new_path)
+
+    if not tree:
+        tree = UsageTree.from_path(snapshot, new_path)
+
+    tree.save(filename)
+    return tree.summarize()
@@ -1,9 +1,20 @@
+import os
+
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.contrib import messages
-from django.http import HttpResponseRedirect
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseBadRequest,
+    HttpResponseRedirect, StreamingHttpResponse)
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.views.generic.base import View
 
+from .metrics import get_metrics
 from .models import Fileset
+from .status import get_status_json, get_status_version, update_status
+from .tarstream import COMPRESSIONS, get_compressor, iter_compressed, iter_tar
 from .tasks import async_backup_job
 
 
@@ -33,7 +44,100 @@ class EnqueueJob(View):
 
         # Spawn a single run.
         Fileset.objects.filter(pk=fileset.pk).update(is_queued=True)
+        update_status(fileset.pk)
         task_id = async_backup_job(fileset)
         messages.add_message(
             self.request, messages.INFO,
             'Spawned job %s as requested.' % (task_id,))
+
+
+class FilesetStatus(View):
+    """
+    The status of all filesets as JSON, for monitoring. See planb.status;
+    send the ETag back in If-None-Match to get a 304 if nothing changed.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.has_perm('planb.view_fileset'):
+            raise PermissionDenied()
+        return super().dispatch(request, *args, **kwargs)
+
+    @method_decorator(condition(
+        etag_func=lambda request: get_status_version()))
+    def get(self, request):
+        return HttpResponse(
+            get_status_json(), content_type='application/json')
+
+
+class Metrics(View):
+    """
+    Metrics in the Prometheus text format, see planb.metrics. Scrapers may
+    send the PLANB_METRICS_TOKEN as bearer token instead of logging in.
+    """
+    def get(self, request):
+        token = settings.PLANB_METRICS_TOKEN
+        if not (token and constant_time_compare(
+                request.META.get('HTTP_AUTHORIZATION', ''),
+                'Bearer {}'.format(token))) and (
+                    not request.user.has_perm('planb.view_fileset')):
+            raise PermissionDenied()
+        return HttpResponse(
+            get_metrics(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class SnapshotDownload(View):
+    """
+    Download (a path in) a snapshot: a single file as is, anything else as
+    a tar archive that is generated while it is sent.
+    """
+    def get_fileset(self, fileset_id, snapshot):
+        if not self.request.user.has_perm('planb.change_fileset'):
+            raise PermissionDenied()
+        try:
+            fileset = Fileset.objects.get(id=fileset_id)
+        except Fileset.DoesNotExist:
+            raise Http404()
+        if snapshot not in fileset.snapshot_list_display():
+            raise Http404()
+        return fileset
+
+    def get(self, request, fileset_id, snapshot):
+        fileset = self.get_fileset(fileset_id, snapshot)
+        subpath = request.GET.get('path', '').strip('/')
+        compression = request.GET.get('compression', '')
+        try:
+            get_compressor(compression)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        # Not workon(): it changes the working directory of the (threaded)
+        # web server process. Resolve the path only after mounting, so
+        # symlinks (and ..) out of the snapshot are seen.
+        dataset = fileset.get_dataset()
+        dataset.mount()
+        try:
+            path = dataset.get_snapshot_subpath(snapshot, subpath)
+        except ValueError:
+            return HttpResponseBadRequest('Bad path')
+        name = '{}-{}'.format(fileset.friendly_name, snapshot)
+        if subpath:
+            name = '{}-{}'.format(
+                name, os.path.basename(subpath).replace('"', '_'))
+
+        if not os.path.lexists(path):
+            raise Http404()
+        if not compression and os.path.isfile(path):
+            # Lets the server use sendfile (wsgi.file_wrapper).
+            return FileResponse(
+                open(path, 'rb'), as_attachment=True,
+                filename=os.path.basename(subpath))
+
+        extension, content_type = COMPRESSIONS[compression]
+        response = StreamingHttpResponse(
+            iter_compressed(
+                iter_tar(path, os.path.basename(subpath) or name),
+                compression),
+            content_type=content_type)
+        response['Content-Disposition'] = (
+            'attachment; filename="{}{}"'.format(name, extension))
+        return response
@@ -73,7 +73,9 @@ if __name__ == '__main__':
             ('share/planb', [
                 'example_settings.py', 'wsgi.py',
                 'rc.d/planb-queue.service',
-                'rc.d/planb-queue-dutree.service'])],
+                'rc.d/planb-queue-dutree.service',
+                'rc.d/planb-queue-replication.service',
+                'rc.d/planb-queue-restore.service'])],
         packages=find_packages() + [
             'planb.fixtures', 'planb.static', 'planb.templates'],
         include_package_data=True,  # see MANIFEST.in